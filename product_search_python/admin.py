@@ -17,6 +17,9 @@
 """Defines the routing for the app's admin request handlers
 (those that require administrative access)."""
 
+# imported first, to note the start of the instance
+import warmup
+
 from admin_handlers import *
 
 import webapp2
@@ -25,7 +28,11 @@ application = webapp2.WSGIApplication(
     [
         ('/admin/manage', AdminHandler),
         ('/admin/create_product', CreateProductHandler),
-        ('/admin/delete_product', DeleteProductHandler)
+        ('/admin/delete_product', DeleteProductHandler),
+        ('/admin/update_ratings_info', UpdateRatingsHandler),
+        ('/admin/flush_reindex', FlushReindexHandler),
+        ('/admin/compact_ratings', CompactRatingsHandler),
+        ('/admin/import_reviews', ImportReviewsHandler)
     ],
     debug=True)
 
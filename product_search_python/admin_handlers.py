@@ -25,13 +25,19 @@ import urllib
 import uuid
 
 from base_handler import BaseHandler
+import cache
 import categories
 import config
 import docs
 import errors
+import importer
 import models
+import ratings
+import reindex
+import reset
+import storeindex
 import stores
-import utils
+import warmup
 
 from google.appengine.api import users
 from google.appengine.ext.deferred import defer
@@ -41,88 +47,97 @@ from google.appengine.api import search
 
 def reinitAll(sample_data=True):
   """
-  Deletes all product entities and documents, essentially resetting the app
-  state, then loads in static sample data if requested. Hardwired for the
-  expected product types in the sample data.
-  (Re)loads store location data from stores.py as well.
-  This function is intended to be run 'offline' (e.g., via a Task Queue task).
+  Deletes all product and review entities and product documents, essentially
+  resetting the app state, then loads in static sample data if requested.
+  The deletion is done by a sharded reset, whose shards run in parallel
+  tasks (see reset.py); the sample data is loaded once they have all
+  finished.  Syncs the store location data with stores.py as well.
+  Returns the ResetJob entity, which records the progress of the reset.
   As an extension to this functionality, the channel ID could be used to notify
   when done."""
 
-  # delete all the product and review entities
-  review_keys = models.Review.query().fetch(keys_only=True)
-  ndb.delete_multi(review_keys)
-  prod_keys = models.Product.query().fetch(keys_only=True)
-  ndb.delete_multi(prod_keys)
-  # delete all the associated product documents in the doc and
-  # store indexes
-  docs.Product.deleteAllInProductIndex()
-  docs.Store.deleteAllInIndex()
-  # load in sample data if indicated
+  # sync the store index with the sample store data (or, if no sample data is
+  # to be loaded, empty it) in its own task; only the stores that differ are
+  # written.
+  defer(loadStoreLocationData, None if sample_data else [])
+  # delete all the product and review entities, and the product documents
+  on_done = None
   if sample_data:
-    logging.info('Loading product sample data')
-    # Load from csv sample files.
-    # The following are hardwired to the format of the sample data files
-    # for the two example product types ('books' and 'hd televisions')-- see
-    # categories.py
-    datafile = os.path.join('data', config.SAMPLE_DATA_BOOKS)
-    # books
-    reader = csv.DictReader(
-        open(datafile, 'r'),
-        ['pid', 'name', 'category', 'price',
-         'publisher', 'title', 'pages', 'author',
-         'description', 'isbn'])
-    importData(reader)
-    datafile = os.path.join('data', config.SAMPLE_DATA_TVS)
-    # tvs
-    reader = csv.DictReader(
-        open(datafile, 'r'),
-        ['pid', 'name', 'category', 'price',
-         'size', 'brand', 'tv_type',
-         'description'])
-    importData(reader)
-
-    # next create docs from store location info
-    loadStoreLocationData()
-
+    on_done = (loadSampleData, ())
+  return reset.startReset(on_done=on_done)
+
+
+def loadSampleData():
+  """Load the sample product data.  Hardwired for the expected product types
+  in the sample data."""
+  logging.info('Loading product sample data')
+  # Load from csv sample files, each in its own chain of import tasks.
+  # The following are hardwired to the format of the sample data files
+  # for the two example product types ('books' and 'hd televisions')-- see
+  # categories.py
+  datafile = os.path.join('data', config.SAMPLE_DATA_BOOKS)
+  # books
+  importer.startImport(
+      datafile,
+      ['pid', 'name', 'category', 'price',
+       'publisher', 'title', 'pages', 'author',
+       'description', 'isbn'])
+  datafile = os.path.join('data', config.SAMPLE_DATA_TVS)
+  # tvs
+  importer.startImport(
+      datafile,
+      ['pid', 'name', 'category', 'price',
+       'size', 'brand', 'tv_type',
+       'description'])
   logging.info('Re-initialization complete.')
 
-def loadStoreLocationData():
-    # create documents from store location info
-    # currently logs but otherwise swallows search errors.
-    slocs = stores.stores
-    for s in slocs:
-      logging.info("s: %s", s)
-      geopoint = search.GeoPoint(s[3][0], s[3][1])
-      fields = [search.TextField(name=docs.Store.STORE_NAME, value=s[1]),
-                search.TextField(name=docs.Store.STORE_ADDRESS, value=s[2]),
-                search.GeoField(name=docs.Store.STORE_LOCATION, value=geopoint)
-              ]
-      d = search.Document(doc_id=s[0], fields=fields)
-      try:
-        add_result = search.Index(config.STORE_INDEX_NAME).put(d)
-      except search.Error:
-        logging.exception("Error adding document:")
+def loadStoreLocationData(store_data=None):
+  """Sync the store index with the given store data (by default, the sample
+  store data in stores.py), a list of (store id, name, address, [lat, lon])
+  tuples.  The existing store documents are read and compared with the data,
+  and only the stores that were added, changed or removed are written, in
+  batches of up to the Search API maximum.  This can be run on its own as a
+  deferred task; a search.Error fails the task, so that it is retried.
+  Returns the number of documents written and deleted."""
+  if store_data is None:
+    store_data = stores.stores
+  wanted = dict(
+      (s[0], storeindex.StoreInfo(s[0], s[1], s[2], float(s[3][0]),
+                                  float(s[3][1])))
+      for s in store_data)
+  existing = dict((store.store_id, store) for store in storeindex.loadStores())
+  changed = [store for sid, store in wanted.iteritems()
+             if existing.get(sid) != store]
+  removed = [sid for sid in existing if sid not in wanted]
+  index = docs.Store.getIndex()
+  for batch in importer.batches(changed, importer.MAX_BATCH_SIZE):
+    index.put([storeindex.buildStoreDoc(store) for store in batch])
+  for batch in importer.batches(removed, importer.MAX_BATCH_SIZE):
+    index.delete(batch)
+  logging.info('store sync: %s stores added or changed, %s removed, %s '
+               'unchanged', len(changed), len(removed),
+               len(wanted) - len(changed))
+  if changed or removed:
+    # have the instances rebuild their store indexes
+    storeindex.invalidate()
+  return len(changed) + len(removed)
 
 
 def importData(reader):
   """Import via the csv reader iterator using the specified batch size as set in
-  the config file.  We want to ensure the batch is not too large-- we allow 100
-  rows/products max per batch."""
-  MAX_BATCH_SIZE = 100
-  rows = []
-  # index in batches
-  # ensure the batch size in the config file is not over the max or < 1.
-  batchsize = utils.intClamp(config.IMPORT_BATCH_SIZE, 1, MAX_BATCH_SIZE)
-  logging.debug('batchsize: %s', batchsize)
-  for row in reader:
-    if len(rows) == batchsize:
-      docs.Product.buildProductBatch(rows)
-      rows = [row]
-    else:
-      rows.append(row)
-  if rows:
-    docs.Product.buildProductBatch(rows)
+  the config file (see the importer module).  The rows are streamed from the
+  reader, and the indexing of each batch overlaps with the datastore write of
+  the previous one."""
+  return importer.importRows(reader)
+
+
+def updateRatings():
+  """Re-index, in batch, the documents of the products that have had an
+  average ratings change since the last update, as recorded in the dirty log
+  (see reindex.py).  Products are logged if config.BATCH_RATINGS_UPDATE is
+  True, or as a fallback for the coalesced reindexes; if neither is in use,
+  the associated documents are updated right away."""
+  return reindex.flushDirtyLog()
 
 
 class AdminHandler(BaseHandler):
@@ -130,12 +145,19 @@ class AdminHandler(BaseHandler):
 
   def buildAdminPage(self, notification=None):
     # If necessary, build the app's product categories now.  This is done only
-    # if there are no Category entities in the datastore.
-    models.Category.buildAllCategories()
+    # if the category info is not cached and there are no Category entities in
+    # the datastore.
+    models.Category.getCategoryInfo()
     tdict = {
         'sampleb': config.SAMPLE_DATA_BOOKS,
         'samplet': config.SAMPLE_DATA_TVS,
-        'update_sample': config.DEMO_UPDATE_BOOKS_DATA}
+        'update_sample': config.DEMO_UPDATE_BOOKS_DATA,
+        'cache_stats': cache.getStats(),
+        'reindex_stats': reindex.getStats(),
+        'reindex_window': config.REINDEX_COALESCE_WINDOW,
+        'reset': reset.getProgress(),
+        'warmup_stats': warmup.getStats(),
+        'cache_ttl': config.SEARCH_CACHE_TTL}
     if notification:
       tdict['notification'] = notification
     self.render_template('admin.html', tdict)
@@ -145,8 +167,8 @@ class AdminHandler(BaseHandler):
     action = self.request.get('action')
     if action == 'reinit':
       # reinitialise the app data to the sample data
-      defer(reinitAll)
-      self.buildAdminPage(notification="Reinitialization performed.")
+      reinitAll()
+      self.buildAdminPage(notification="Reinitialization started.")
     elif action == 'demo_update':
       # update the sample data, from (hardwired) book update
       # data. Demonstrates updating some existing products, and adding some new
@@ -159,28 +181,68 @@ class AdminHandler(BaseHandler):
           ['pid', 'name', 'category', 'price',
            'publisher', 'title', 'pages', 'author',
            'description', 'isbn'])
-      for row in reader:
-        docs.Product.buildProduct(row)
+      docs.Product.buildProductUpserts(list(reader))
       self.buildAdminPage(notification="Demo update performed.")
 
     elif action == 'update_ratings':
       self.update_ratings()
       self.buildAdminPage(notification="Ratings update performed.")
+    elif action == 'sweep_flagged':
+      # reindex the products flagged before the dirty log was in use
+      defer(reindex.sweepFlagged)
+      self.buildAdminPage(notification="Flagged product sweep started.")
+    elif action == 'sync_stores':
+      # sync the store index with stores.py, writing only the changes
+      defer(loadStoreLocationData)
+      self.buildAdminPage(notification="Store sync started.")
     else:
       self.buildAdminPage()
 
   def update_ratings(self):
-    """Find the products that have had an average ratings change, and need their
-    associated documents updated (re-indexed) to reflect that change; and
-    re-index those docs in batch. There will only
-    be such products if config.BATCH_RATINGS_UPDATE is True; otherwise the
-    associated documents will be updated right away."""
-    # get the pids of the products that need review info updated in their
-    # associated documents.
-    pkeys = models.Product.query(
-        models.Product.needs_review_reindex == True).fetch(keys_only=True)
-    # re-index these docs in batch
-    models.Product.updateProdDocsWithNewRating(pkeys)
+    updateRatings()
+
+
+class UpdateRatingsHandler(BaseHandler):
+  """Run by cron to re-index, in batch, the documents of products that have
+  had an average ratings change."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    updateRatings()
+
+
+class FlushReindexHandler(BaseHandler):
+  """Run by cron to re-index the documents of products with new reviews, whose
+  reindexes have been coalesced (see reindex.py)."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    reindex.flushDirty()
+
+
+class CompactRatingsHandler(BaseHandler):
+  """Run by cron to fold any remaining sharded review ratings into their
+  products, and reindex the products' documents (see ratings.py)."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    if config.RATING_SHARDS:
+      ratings.compactAllShards()
+
+
+class ImportReviewsHandler(BaseHandler):
+  """Start a bulk import of the reviews in the given file in the app's data
+  directory: either CSV with a header row naming the review fields, or one
+  JSON object per line (see importer.py)."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    datafile = os.path.join(
+        'data', os.path.basename(self.request.get('datafile')))
+    if not os.path.isfile(datafile):
+      return self.abort(404, 'no such data file')
+    job = importer.startReviewImport(datafile)
+    self.response.write('Started review import job %s.' % job.key.id())
 
 
 class DeleteProductHandler(BaseHandler):
@@ -24,11 +24,20 @@ import json
 
 from google.appengine.api import users
 
+import warmup
+
 
 class BaseHandler(webapp2.RequestHandler):
   """The other handlers inherit from this class.  Provides some helper methods
   for rendering a template and generating template links."""
 
+  def dispatch(self):
+    try:
+      super(BaseHandler, self).dispatch()
+    finally:
+      # the first request of the instance records its cold start time
+      warmup.requestDone(self.request.path)
+
   @classmethod
   def logged_in(cls, handler_method):
     """
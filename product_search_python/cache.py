@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A memcache-backed cache for product search results and facet links.
+Cache keys are built from the normalized request params plus the current
+'generation' of the product index.  Every write to the product index bumps the
+generation (see bumpGeneration), so entries computed before the write are
+never looked up again, and simply expire.
+"""
+
+import hashlib
+import logging
+import time
+
+import config
+
+from google.appengine.api import memcache
+
+_NAMESPACE = 'search_cache'
+_GENERATION_KEY = 'generation'
+_HITS_KEY = 'hits'
+_MISSES_KEY = 'misses'
+
+
+def _initialGeneration():
+  """The generation to start from if there is none in memcache (e.g., if it
+  has been evicted).  It is based on the current time so that it is not
+  likely to collide with a generation that was used before the eviction."""
+  return int(time.time() * 1000)
+
+
+def getGeneration():
+  """Return the current product index generation."""
+  generation = memcache.get(_GENERATION_KEY, namespace=_NAMESPACE)
+  if generation is None:
+    generation = _initialGeneration()
+    if not memcache.add(_GENERATION_KEY, generation, namespace=_NAMESPACE):
+      # another request set it first
+      generation = memcache.get(_GENERATION_KEY, namespace=_NAMESPACE)
+  return generation
+
+
+def bumpGeneration():
+  """Start a new product index generation, invalidating all cached entries.
+  Called whenever the product index is modified."""
+  generation = memcache.incr(
+      _GENERATION_KEY, namespace=_NAMESPACE,
+      initial_value=_initialGeneration())
+  if generation is None:
+    logging.error('Could not bump the search cache generation.')
+  return generation
+
+
+def normalizeQuery(query):
+  """Normalize a query string for use in a cache key, by collapsing
+  whitespace."""
+  if not query:
+    return ''
+  return ' '.join(query.split())
+
+
+def _makeKey(kind, key_params, generation):
+  """Build a memcache key from the given kind of entry, the (hashable and
+  repr-able) tuple of request params, and the index generation."""
+  digest = hashlib.sha1(repr(key_params)).hexdigest()
+  return '%s:%s:%s' % (kind, generation, digest)
+
+
+def get(kind, key_params, generation=None):
+  """Look up the entry of the given kind for the given params tuple, in the
+  given index generation (by default, the current one).  Returns None on a
+  miss."""
+  if config.SEARCH_CACHE_TTL <= 0:
+    return None
+  if generation is None:
+    generation = getGeneration()
+  key = _makeKey(kind, key_params, generation)
+  value = memcache.get(key, namespace=_NAMESPACE)
+  # count the hit or miss without waiting for the memcache RPC
+  memcache.Client().incr_async(
+      _MISSES_KEY if value is None else _HITS_KEY, namespace=_NAMESPACE,
+      initial_value=0)
+  return value
+
+
+def put(kind, key_params, value, generation=None, ttl=None):
+  """Cache the given value for the given kind and params tuple, in the given
+  index generation (by default, the current one).  Callers should pass the
+  generation that they read *before* computing the value, so that a value
+  computed across an index write is not stored under the new generation.
+  ttl is the entry lifetime in seconds, and defaults to
+  config.SEARCH_CACHE_TTL."""
+  if ttl is None:
+    ttl = config.SEARCH_CACHE_TTL
+  if ttl <= 0:
+    return
+  if generation is None:
+    generation = getGeneration()
+  key = _makeKey(kind, key_params, generation)
+  if not memcache.set(key, value, time=ttl, namespace=_NAMESPACE):
+    logging.warn('Could not cache %s entry.', kind)
+
+
+def getStats():
+  """Return a dict with the current hit and miss counts of the cache."""
+  counts = memcache.get_multi([_HITS_KEY, _MISSES_KEY], namespace=_NAMESPACE)
+  return {'hits': counts.get(_HITS_KEY, 0),
+          'misses': counts.get(_MISSES_KEY, 0)}
+
+
+def resetStats():
+  """Reset the hit and miss counts."""
+  memcache.delete_multi([_HITS_KEY, _MISSES_KEY], namespace=_NAMESPACE)
+
+
+def _pageCursorKey(query_params, offset):
+  """Build the memcache key for the page cursor of the given search, at the
+  given result offset."""
+  digest = hashlib.sha1(repr(query_params)).hexdigest()
+  return 'page_cursor:%s:%s' % (digest, offset)
+
+
+def setPageCursor(query_params, offset, web_safe_cursor):
+  """Remember the (web-safe) search cursor that starts the results page at
+  the given offset, for the search identified by the query_params tuple.
+  This lets us build 'previous' links for pages beyond the Search API's
+  offset limit, since cursors only page forward."""
+  memcache.set(_pageCursorKey(query_params, offset), web_safe_cursor,
+               time=config.PAGE_CURSOR_TTL, namespace=_NAMESPACE)
+
+
+def getPageCursor(query_params, offset):
+  """Return the remembered web-safe cursor for the results page at the given
+  offset, or None."""
+  return memcache.get(_pageCursorKey(query_params, offset),
+                      namespace=_NAMESPACE)
@@ -23,6 +23,8 @@ from google.appengine.api import search
 televisions = {'name': 'hd televisions', 'children': []}
 books = {'name': 'books', 'children': []}
 
+# The category tree.  Categories may be nested to any depth; a search
+# restricted to a category also matches the products of its subcategories.
 ctree =  {'name': 'root', 'children': [books, televisions]}
 
 # [The core fields that all products share are: product id, name, description,
@@ -38,3 +40,9 @@ product_dict =  {'hd televisions': {'size': search.NumberField,
                            'title': search.TextField,
                            'isbn': search.TextField}
                 }
+
+# The category-specific fields (from product_dict above) that we compute
+# sidebar facets for.
+facet_fields = {'hd televisions': ['brand', 'tv_type'],
+                'books': ['publisher']
+               }
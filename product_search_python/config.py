@@ -25,12 +25,28 @@ PRODUCT_INDEX_NAME = 'productsearch1'  # The document index name.
 
 STORE_INDEX_NAME = 'stores1'
 
+# The search backend: 'appengine' for the Search API, or 'local' for the
+# in-process index in localsearch.py, which holds the indexes in instance
+# memory (for tests and offline tools; its contents are not shared between
+# instances, nor persisted).
+SEARCH_BACKEND = 'appengine'
+
 # set BATCH_RATINGS_UPDATE to False to update documents with changed ratings
 # info right away.  If True, updates will only occur when triggered by
 # an admin request or a cron job.  See cron.yaml for an example.
 BATCH_RATINGS_UPDATE = False
 # BATCH_RATINGS_UPDATE = True
 
+# If BATCH_RATINGS_UPDATE is False, the document reindexes for the new reviews
+# of a product are coalesced, so that each product's document is reindexed at
+# most once per this many seconds (see reindex.py and cron.yaml).  Set to 0 to
+# reindex right away after every review.
+REINDEX_COALESCE_WINDOW = 60
+
+# The number of review ids that each instance reserves at a time (see
+# idpool.py), so that adding a review doesn't wait on an id allocation.
+REVIEW_ID_BATCH_SIZE = 100
+
 # The max and min (integer) ratings values allowed.
 RATING_MIN = 1
 RATING_MAX = 5
@@ -38,10 +54,83 @@ RATING_MAX = 5
 # the number of search results to display per page
 DOC_LIMIT = 3
 
+# the number of reviews to display per page
+REVIEWS_PAGE_SIZE = 20
+# How long, in seconds, to cache the first page of a product's reviews.  A new
+# review is merged into the cached page (see Review.refreshFirstPage).
+REVIEWS_CACHE_TTL = 3600
+# How long, in seconds, to cache a first page read from the reviews query
+# alone.  The query is only eventually consistent, so the page may be missing
+# reviews added moments ago.
+REVIEWS_MISS_CACHE_TTL = 30
+
 SAMPLE_DATA_BOOKS = 'sample_data_books.csv'
 SAMPLE_DATA_TVS = 'sample_data_tvs.csv'
 DEMO_UPDATE_BOOKS_DATA = 'sample_data_books_update.csv'
 
 # the size of the import batches, when reading from the csv file.  Must not
-# exceed 100.
-IMPORT_BATCH_SIZE = 5
+# exceed 200, the maximum number of documents that can be indexed at once.
+IMPORT_BATCH_SIZE = 200
+# How long, in seconds, an import task runs before it checkpoints and
+# continues in a new task.  Must leave a margin below the 10 minute task
+# deadline.
+IMPORT_TASK_TIME_LIMIT = 8 * 60
+# the number of rows in each batch of a bulk review import.  Each batch's
+# reviews are written with one put_multi, and each product with reviews in the
+# batch gets one rating update and one document reindex per batch.  Must not
+# exceed 499.
+REVIEW_IMPORT_BATCH_SIZE = 400
+
+# The number of shards into which a reset of the app's data splits each kind,
+# and the product index, to delete them in parallel tasks (see reset.py).
+RESET_SHARDS = 16
+# How long, in seconds, a reset shard task runs before it continues in a new
+# task.
+RESET_TASK_TIME_LIMIT = 8 * 60
+
+# The maximum number of matching documents to look at when computing the
+# sidebar facet counts (ratings, category, price and attribute facets).  If a
+# query matches more documents than this, the counts shown are estimates.  Must
+# not exceed 1000.
+FACET_SAMPLE_LIMIT = 1000
+# the maximum number of values to display for each attribute facet
+FACET_MAX_VALUES = 10
+# The price ranges used for the price facet, as (low, high) pairs.  A high
+# value of None means 'and above'.
+FACET_PRICE_RANGES = [(0, 10), (10, 25), (25, 50), (50, 100), (100, 500),
+                      (500, None)]
+
+# How long, in seconds, to cache product search results and facet links in
+# memcache.  Cached entries are never served after a change to the product
+# index, so this mainly bounds memcache usage.  Set to 0 to disable caching.
+SEARCH_CACHE_TTL = 300
+
+# How often, in seconds, an instance checks memcache for changes to the
+# category info (made by other instances) before using its own copy.
+CATEGORY_CACHE_CHECK_INTERVAL = 30
+
+# Set STORE_INDEX_IN_MEMORY to False to answer store location queries with
+# Search API geo queries, rather than from each instance's in-memory spatial
+# index of the stores (see storeindex.py).  The geo query is also the fallback
+# if the in-memory index can't be built.
+STORE_INDEX_IN_MEMORY = True
+# How often, in seconds, an instance checks memcache for changes to the store
+# data before using its own store index.
+STORE_INDEX_CHECK_INTERVAL = 30
+# the default, and the maximum, number of stores returned by a store location
+# query
+STORE_RESULTS_LIMIT = 20
+STORE_RESULTS_MAX = 100
+# the maximum number of locations in one nearest stores batch request
+STORE_BATCH_MAX_POINTS = 100
+
+# How long, in seconds, to remember the search cursors of visited results
+# pages, which are used to link back to pages beyond the search offset limit.
+PAGE_CURSOR_TTL = 3600
+
+# The number of shards over which to spread the rating counts of each product's
+# new reviews (see ratings.py).  The shards are folded into the product's
+# average rating, and its document reindexed, in batch, so that a product can
+# take more than about one review per second.  Set to 0 to update the product
+# entity with each review instead.  Must not exceed 20.
+RATING_SHARDS = 0
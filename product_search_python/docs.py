@@ -19,7 +19,6 @@ BaseDocumentManager provides some common utilities, and the Product subclass
 adds some Product-document-specific helper methods.
 """
 
-import collections
 import copy
 import datetime
 import logging
@@ -27,19 +26,50 @@ import re
 import string
 import urllib
 
+import cache
 import categories
 import config
 import errors
+import facets
+import localsearch
 import models
+import utils
 
 from google.appengine.api import search
 from google.appengine.ext import ndb
 
 
+class DocsFuture(object):
+  """The pending result of a BaseDocumentManager.getDocsAsync call.  Its
+  get_result method returns a dict of doc id -> search.Document, for the
+  requested ids that were found in the index."""
+
+  def __init__(self, rpcs):
+    # a list of (doc id, get_range rpc) pairs
+    self._rpcs = rpcs
+    self._result = None
+
+  def get_result(self):
+    if self._result is None:
+      self._result = {}
+      for doc_id, rpc in self._rpcs:
+        try:
+          response = rpc.get_result()
+        except search.InvalidRequest:  # catches ill-formed doc ids
+          continue
+        # If the doc id is not in the index, the next doc in the index will
+        # be returned instead, so we need to check for that case.
+        if response.results and response.results[0].doc_id == doc_id:
+          self._result[doc_id] = response.results[0]
+    return self._result
+
+
 class BaseDocumentManager(object):
   """Abstract class. Provides helper methods to manage search.Documents."""
 
   _INDEX_NAME = None
+  # the maximum number of documents that can be indexed in one put call
+  _MAX_PUT_BATCH_SIZE = 200
   _VISIBLE_PRINTABLE_ASCII = frozenset(
     set(string.printable) - set(string.whitespace))
 
@@ -78,43 +108,64 @@ class BaseDocumentManager(object):
 
   @classmethod
   def getIndex(cls):
+    if config.SEARCH_BACKEND == 'local':
+      return localsearch.getIndex(cls._INDEX_NAME)
     return search.Index(name=cls._INDEX_NAME)
 
   @classmethod
   def deleteAllInIndex(cls):
-    """Delete all the docs in the given index."""
+    """Delete all the docs in the given index, in a single request.  (To
+    delete a large index, use a sharded reset instead; see reset.py.)"""
     docindex = cls.getIndex()
 
     try:
       while True:
-        # until no more documents, get a list of documents,
-        # constraining the returned objects to contain only the doc ids,
-        # extract the doc ids, and delete the docs.
+        # until no more documents, get a list of (up to the maximum of 1000)
+        # documents, constraining the returned objects to contain only the doc
+        # ids, extract the doc ids, and delete the docs, up to 200 per call,
+        # with the calls in parallel.
         document_ids = [document.doc_id
-                        for document in docindex.get_range(ids_only=True)]
+                        for document in docindex.get_range(
+                            ids_only=True, limit=1000)]
         if not document_ids:
           break
-        docindex.delete(document_ids)
+        rpcs = [docindex.delete_async(document_ids[i:i + 200])
+                for i in xrange(0, len(document_ids), 200)]
+        for rpc in rpcs:
+          rpc.get_result()
     except search.Error:
       logging.exception("Error removing documents:")
 
   @classmethod
   def getDoc(cls, doc_id):
-    """Return the document with the given doc id. One way to do this is via
-    the get_range method, as shown here.  If the doc id is not in the
-    index, the first doc in the index will be returned instead, so we need
-    to check for that case."""
+    """Return the document with the given doc id, or None if there is no such
+    document.  See getDocs."""
     if not doc_id:
       return None
-    try:
-      index = cls.getIndex()
-      response = index.get_range(
-          start_id=doc_id, limit=1, include_start_object=True)
-      if response.results and response.results[0].doc_id == doc_id:
-        return response.results[0]
-      return None
-    except search.InvalidRequest: # catches ill-formed doc ids
-      return None
+    return cls.getDocs([doc_id]).get(doc_id)
+
+  @classmethod
+  def getDocsAsync(cls, doc_ids):
+    """Start fetching the documents with the given doc ids, and return a
+    DocsFuture for the result.  There is no multi-get by id in the Search API,
+    so each (distinct) document is fetched via the get_range method, starting
+    at its id.  The get_range calls are all issued at once, so the whole fetch
+    costs about one index round trip, however many ids are given."""
+    index = cls.getIndex()
+    rpcs = []
+    for doc_id in sorted(set(doc_id for doc_id in doc_ids if doc_id)):
+      try:
+        rpcs.append((doc_id, index.get_range_async(
+            start_id=doc_id, limit=1, include_start_object=True)))
+      except search.InvalidRequest: # catches ill-formed doc ids
+        continue
+    return DocsFuture(rpcs)
+
+  @classmethod
+  def getDocs(cls, doc_ids):
+    """Return a dict of doc id -> search.Document for those of the given doc
+    ids that are in the index."""
+    return cls.getDocsAsync(doc_ids).get_result()
 
   @classmethod
   def removeDocById(cls, doc_id):
@@ -132,6 +183,23 @@ class BaseDocumentManager(object):
     except search.Error:
       logging.exception("Error adding documents.")
 
+  @classmethod
+  def addMulti(cls, documents):
+    """Index any number of documents, split into batches no larger than the
+    Search API allows for one put call.  The batches are indexed concurrently.
+    Returns the list of put results, in the same order as the given documents,
+    or None if there was an indexing error."""
+    index = cls.getIndex()
+    try:
+      rpcs = [index.put_async(documents[i:i + cls._MAX_PUT_BATCH_SIZE])
+              for i in xrange(0, len(documents), cls._MAX_PUT_BATCH_SIZE)]
+      results = []
+      for rpc in rpcs:
+        results.extend(rpc.get_result())
+      return results
+    except search.Error:
+      logging.exception("Error adding documents.")
+
 
 class Store(BaseDocumentManager):
 
@@ -157,6 +225,8 @@ class Product(BaseDocumentManager):
   PID = 'pid'
   DESCRIPTION = 'description'
   CATEGORY = 'category'
+  # the category and its ancestors; multi-valued
+  CATEGORY_PATH = 'category_path'
   PRODUCT_NAME = 'name'
   PRICE = 'price'
   AVG_RATING = 'ar' #average rating
@@ -194,6 +264,7 @@ class Product(BaseDocumentManager):
   @classmethod
   def deleteAllInProductIndex(cls):
     cls.deleteAllInIndex()
+    cache.bumpGeneration()
 
   @classmethod
   def getSortMenu(cls):
@@ -223,6 +294,15 @@ class Product(BaseDocumentManager):
     for elt in cls._SORT_OPTIONS:
       cls._SORT_DICT[elt[0]] = elt[2]
 
+  @classmethod
+  def categoryQuery(cls, category):
+    """Return the query clause that restricts a search to the given category
+    and its subcategories.  Documents indexed before the category path field
+    was added don't have it, so they are matched on their category field."""
+    # both fields are atomic, so the category string is put in quotes.
+    return '(%s:"%s" OR %s:"%s")' % (
+        cls.CATEGORY_PATH, category, cls.CATEGORY, category)
+
   @classmethod
   def getDocFromPid(cls, pid):
     """Given a pid, get its doc. We're using the pid as the doc id, so we can
@@ -234,6 +314,7 @@ class Product(BaseDocumentManager):
     """Given a doc's pid, remove the doc matching it from the product
     index."""
     cls.removeDocById(pid)
+    cache.bumpGeneration()
 
   @classmethod
   def updateRatingInDoc(cls, doc_id, avg_rating):
@@ -248,6 +329,22 @@ class Product(BaseDocumentManager):
       raise errors.OperationFailedError(
           'Could not retrieve doc associated with id %s' % (doc_id,))
 
+  @classmethod
+  def updateRatingsInDocs(cls, doc_ratings):
+    """Given a dict of doc id -> average rating, fetch the associated docs in
+    batch, and return the list of docs updated with the new ratings (but not
+    yet reindexed).  Ids with no associated doc are logged and skipped."""
+    docs_by_id = cls.getDocs(doc_ratings.keys())
+    modified = []
+    for doc_id, avg_rating in doc_ratings.iteritems():
+      doc = docs_by_id.get(doc_id)
+      if not doc:
+        logging.error('Could not retrieve doc associated with id %s', doc_id)
+        continue
+      cls(doc).setAvgRating(avg_rating)
+      modified.append(doc)
+    return modified
+
   @classmethod
   def updateRatingsInfo(cls, doc_id, avg_rating):
     """Given a models.Product entity, update and reindex the associated
@@ -255,7 +352,9 @@ class Product(BaseDocumentManager):
 
     ndoc = cls.updateRatingInDoc(doc_id, avg_rating)
     # reindex the returned updated doc
-    return cls.add(ndoc)
+    res = cls.add(ndoc)
+    cache.bumpGeneration()
+    return res
 
 # 'accessor' convenience methods
 
@@ -292,59 +391,116 @@ class Product(BaseDocumentManager):
     return self.getFieldVal(self.PRICE)
 
   @classmethod
-  def generateRatingsBuckets(cls, query_string):
-    """Builds a dict of ratings 'buckets' and their counts, based on the
-    value of the 'avg_rating" field for the documents retrieved by the given
-    query.  See the 'generateRatingsLinks' method.  This information will
-    be used to generate sidebar links that allow the user to drill down in query
-    results based on rating.
+  def generateFacets(cls, query_string):
+    """Computes the facet counts (ratings, category, price range, and
+    category-specific attributes) for the documents matched by the given query,
+    in a single bounded search.  See the facets module.  This information will
+    be used to generate sidebar links that allow the user to drill down in
+    query results."""
+    return facets.computeFacets(cls.getIndex(), query_string)
 
-    For demonstration purposes only; this will be expensive for large data
-    sets.
-    """
-
-    # do the query on the *full* search results
-    # to generate the facet information, imitating what may in future be
-    # provided by the FTS API.
-    try:
-      sq = search.Query(
-          query_string=query_string.strip())
-      search_results = cls.getIndex().search(sq)
-    except search.Error:
-      logging.exception('An error occurred on search.')
-      return None
+  @classmethod
+  def _buildFacetLink(cls, phash, **updates):
+    """Build a /psearch link from a copy of the given params, with the given
+    param updates applied."""
+    pcopy = phash.copy()
+    pcopy.update(updates)
+    return '/psearch?' + urllib.urlencode(pcopy)
 
-    ratings_buckets = collections.defaultdict(int)
-    # populate the buckets
-    for res in search_results:
-      ratings_buckets[int((cls(res)).getAvgRating() or 0)] += 1
-    return ratings_buckets
+  @classmethod
+  def generateFacetLinks(cls, query, phash):
+    """Builds the sidebar facet links for the given query.  Returns a list of
+    (facet title, link list) pairs, where each link list holds (link, text)
+    html snippet info, and a flag indicating whether the counts are estimates.
+    Each link runs the query, additionally filtered by the indicated facet
+    value.  Returns (None, False) if the facets could not be computed.
+    Results are cached per index generation; see the cache module."""
+    return cls.generateFacetLinksAsync(query, phash).get_result()
 
   @classmethod
-  def generateRatingsLinks(cls, query, phash):
-    """Given a dict of ratings 'buckets' and their counts,
-    builds a list of html snippets, to be displayed in the sidebar when
-    showing results of a query. Each is a link that runs the query, additionally
-    filtered by the indicated ratings interval."""
+  def generateFacetLinksAsync(cls, query, phash):
+    """Like generateFacetLinks, but starts the facet search and returns a
+    future for the facet links, so that the caller can do other work (such as
+    the main search) while the facet search runs."""
+
+    generation = cache.getGeneration()
+    cache_params = (cache.normalizeQuery(query), sorted(phash.items()))
+    cached = cache.get('facets', cache_params, generation)
+    if cached is not None:
+      return utils.LazyResult(lambda: cached)
+    facets_future = facets.computeFacetsAsync(cls.getIndex(), query)
+
+    def _links():
+      facet_counts = facets_future.get_result()
+      if not facet_counts:
+        return (None, False)
+      res = cls._buildFacetLinks(facet_counts, phash)
+      cache.put('facets', cache_params, res, generation)
+      return res
+    return utils.LazyResult(_links)
 
-    ratings_buckets = cls.generateRatingsBuckets(query)
-    if not ratings_buckets:
-      return None
+  @classmethod
+  def _buildFacetLinks(cls, facet_counts, phash):
+    """Build the facet links info (see generateFacetLinks) from the given
+    FacetCounts and query params."""
+    est = '~' if facet_counts.is_estimate else ''
+    sections = []
+
+    # ratings links
+    ratings_counts = facet_counts.getCounts(facets.RATING)
     rlist = []
     for k in range(config.RATING_MIN, config.RATING_MAX+1):
-      try:
-        v = ratings_buckets[k]
-      except KeyError:
-        return
+      v = ratings_counts.get(k, 0)
       # build html
       if k < 5:
-        htext = '%s-%s (%s)' % (k, k+1, v)
+        htext = '%s-%s (%s%s)' % (k, k+1, est, v)
+      else:
+        htext = '%s (%s%s)' % (k, est, v)
+      rlist.append((cls._buildFacetLink(phash, rating=k), htext))
+    sections.append(('Rating', rlist))
+
+    # category links, if the query is not already restricted to a category
+    if not phash.get('category'):
+      cat_counts = facet_counts.getCounts(facets.CATEGORY)
+      clist = [(cls._buildFacetLink(phash, category=c.encode('utf-8')),
+                '%s (%s%s)' % (c, est, v))
+               for c, v in sorted(cat_counts.iteritems(),
+                                  key=lambda elt: -elt[1])]
+      if clist:
+        sections.append(('Category', clist))
+
+    # price range links, in the order of the configured ranges
+    price_counts = facet_counts.getCounts(facets.PRICE)
+    plist = []
+    for low, high in config.FACET_PRICE_RANGES:
+      v = price_counts.get((low, high))
+      if not v:
+        continue
+      if high is None:
+        prange = '%s-' % (low,)
+        htext = '%s+ (%s%s)' % (low, est, v)
       else:
-        htext = '%s (%s)' % (k, v)
-      phash['rating'] = k
-      hlink = '/psearch?' + urllib.urlencode(phash)
-      rlist.append((hlink, htext))
-    return rlist
+        prange = '%s-%s' % (low, high)
+        htext = '%s-%s (%s%s)' % (low, high, est, v)
+      plist.append((cls._buildFacetLink(phash, price=prange), htext))
+    if plist:
+      sections.append(('Price', plist))
+
+    # category-specific attribute links.  These add a field restriction to
+    # the query string.
+    for fname in facets.attributeFields():
+      attr_counts = facet_counts.getCounts(fname)
+      top = sorted(attr_counts.iteritems(),
+                   key=lambda elt: -elt[1])[:config.FACET_MAX_VALUES]
+      alist = []
+      for val, v in top:
+        aquery = '%s %s:"%s"' % (
+            phash.get('query', ''), fname, val.encode('utf-8'))
+        alist.append((cls._buildFacetLink(phash, query=aquery.strip()),
+                      '%s (%s%s)' % (val, est, v)))
+      if alist:
+        sections.append((fname.replace('_', ' ').capitalize(), alist))
+    return (sections, facet_counts.is_estimate)
 
   @classmethod
   def _buildCoreProductFields(
@@ -375,6 +531,10 @@ class Product(BaseDocumentManager):
               search.NumberField(name=cls.AVG_RATING, value=0.0),
               search.NumberField(name=cls.PRICE, value=price)
              ]
+    # index the category's ancestor path as a multi-valued atom field, so
+    # that a search restricted to a category includes its subcategories.
+    fields.extend(search.AtomField(name=cls.CATEGORY_PATH, value=cname)
+                  for cname in models.Category.getCategoryPath(category))
     return fields
 
   @classmethod
@@ -476,13 +636,11 @@ class Product(BaseDocumentManager):
       raise errors.OperationFailedError(e2.error_message)
 
   @classmethod
-  def buildProductBatch(cls, rows):
-    """Build product documents and their related datastore entities, in batch,
-    given a list of params dicts.  Should be used for new products, as does not
-    handle updates of existing product entities. This method does not require
-    that the doc ids be tied to the product ids, and obtains the doc ids from
-    the results of the document add."""
-
+  def prepareProductBatch(cls, rows):
+    """Given a list of params dicts, build the product documents and their
+    related datastore entities (sans doc_id), without indexing or storing
+    them.  Rows that can't be built are logged and skipped.  Returns a
+    (document list, entity list) pair, whose elements correspond."""
     docs = []
     dbps = []
     for row in rows:
@@ -497,11 +655,23 @@ class Product(BaseDocumentManager):
         dbps.append(dbp)
       except errors.OperationFailedError:
         logging.error('error creating document from data: %s', row)
+    return (docs, dbps)
+
+  @classmethod
+  def buildProductBatch(cls, rows):
+    """Build product documents and their related datastore entities, in batch,
+    given a list of params dicts.  Should be used for new products, as does not
+    handle updates of existing product entities. This method does not require
+    that the doc ids be tied to the product ids, and obtains the doc ids from
+    the results of the document add."""
+
+    docs, dbps = cls.prepareProductBatch(rows)
     try:
       add_results = cls.add(docs)
     except search.Error:
       logging.exception('Add failed')
       return
+    cache.bumpGeneration()
     if len(add_results) != len(dbps):
       # this case should not be reached; if there was an issue,
       # search.Error should have been thrown, above.
@@ -514,6 +684,65 @@ class Product(BaseDocumentManager):
     # persist the entities
     ndb.put_multi(dbps)
 
+  @classmethod
+  def buildProductUpserts(cls, rows):
+    """Create/update product documents and their related datastore entities,
+    in batch, given a list of params dicts.  Unlike buildProductBatch, this
+    handles updates of existing products.  The existing product entities are
+    loaded with one get_multi call; since they hold the current average
+    ratings, the docs can be built with their ratings info retained without
+    fetching the existing docs.  All the docs are then indexed in batch, and
+    the entities written in concurrent transactions, one per product, which
+    re-get the product so that any ratings info written since it was loaded
+    is kept.  Rows that can't be built are logged and skipped.  Returns the
+    list of product entities."""
+
+    plist = []
+    for row in rows:
+      try:
+        plist.append(cls._normalizeParams(row))
+      except errors.OperationFailedError:
+        logging.error('error creating document from data: %s', row)
+    if not plist:
+      return []
+    curr_prods = ndb.get_multi(
+        [ndb.Key(models.Product, params['pid']) for params in plist])
+
+    pdocs = []
+    built = []
+    for params, prod in zip(plist, curr_prods):
+      try:
+        d = cls._createDocument(**params)
+      except errors.OperationFailedError:
+        logging.error('error creating document from data: %s', params)
+        continue
+      if prod:  #  retain ratings info from the existing product
+        cls(d).setAvgRating(prod.avg_rating)
+      pdocs.append(d)
+      built.append(params)
+
+    # This will reindex any docs whose doc ids already exist
+    add_results = cls.addMulti(pdocs)
+    if add_results is None:
+      raise errors.OperationFailedError('could not index documents')
+    cache.bumpGeneration()
+
+    # now update the entities, in concurrent transactions.  Each one checks
+    # whether the product entity exists; if so, it updates it from the params
+    # but preserves its ratings-related info.
+    @ndb.transactional_tasklet
+    def _txUpsert(params, doc_id):
+      prod = yield models.Product.get_by_id_async(params['pid'])
+      if not prod:
+        prod = models.Product(id=params['pid'])
+      prod.update_core(params, doc_id)
+      yield prod.put_async()
+      raise ndb.Return(prod)
+
+    futures = [_txUpsert(params, add_result.id)
+               for params, add_result in zip(built, add_results)]
+    return [f.get_result() for f in futures]
+
   @classmethod
   def buildProduct(cls, params):
     """Create/update a product document and its related datastore entity.  The
@@ -531,6 +760,7 @@ class Product(BaseDocumentManager):
 
     # This will reindex if a doc with that doc id already exists
     doc_ids = cls.add(d)
+    cache.bumpGeneration()
     try:
       doc_id = doc_ids[0].id
     except IndexError:
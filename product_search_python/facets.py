@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Computes facet counts for product search results: ratings, category, price
+range, and the category-specific attribute facets listed in
+categories.facet_fields.  All facets are computed from a single search, which
+returns only the fields needed for counting, and which looks at no more than
+config.FACET_SAMPLE_LIMIT documents.  If the query matches more documents than
+that, the counts are scaled up from the sample and are marked as estimates.
+"""
+
+import collections
+import logging
+
+import categories
+import config
+import docs
+import utils
+
+from google.appengine.api import search
+
+# facet names
+RATING = 'rating'
+CATEGORY = 'category'
+PRICE = 'price'
+
+# the Search API will not return more than this many results for one query.
+MAX_SAMPLE_LIMIT = 1000
+
+
+class FacetCounts(object):
+  """The facet value counts for a query.  Counts are exact if all of the
+  matching documents were sampled; otherwise they are estimates, scaled up to
+  the number of documents found."""
+
+  def __init__(self, number_found, sample_size):
+    self.number_found = number_found
+    self.sample_size = sample_size
+    self._counts = collections.defaultdict(lambda: collections.defaultdict(int))
+
+  @property
+  def is_estimate(self):
+    return self.sample_size < self.number_found
+
+  def add(self, facet, value):
+    """Count one occurrence of the given facet value."""
+    self._counts[facet][value] += 1
+
+  def facetNames(self):
+    return self._counts.keys()
+
+  def getCounts(self, facet):
+    """Return a dict of facet value -> count for the given facet.  If the
+    counts were computed from a sample, they are scaled to the full result
+    set."""
+    counts = self._counts.get(facet, {})
+    if not self.is_estimate or not self.sample_size:
+      return dict(counts)
+    scale = float(self.number_found) / self.sample_size
+    return dict((k, int(round(v * scale))) for k, v in counts.iteritems())
+
+
+def getSampleLimit():
+  """The number of documents to look at when computing facets.  Uses the
+  config setting, clamped to what the Search API allows."""
+  return utils.intClamp(config.FACET_SAMPLE_LIMIT, 1, MAX_SAMPLE_LIMIT)
+
+
+def attributeFields():
+  """The (de-duplicated) names of all the category-specific attribute fields
+  that we facet on."""
+  fields = []
+  for fnames in categories.facet_fields.itervalues():
+    for fname in fnames:
+      if fname not in fields:
+        fields.append(fname)
+  return fields
+
+
+def facetFields():
+  """The document fields that need to be returned in order to compute all the
+  facets."""
+  return [docs.Product.AVG_RATING, docs.Product.CATEGORY,
+          docs.Product.PRICE] + attributeFields()
+
+
+def priceRangeFor(price):
+  """Return the (low, high) entry of config.FACET_PRICE_RANGES that the given
+  price falls in, or None.  A high value of None means 'and above'."""
+  if price is None:
+    return None
+  for low, high in config.FACET_PRICE_RANGES:
+    if price >= low and (high is None or price < high):
+      return (low, high)
+  return None
+
+
+def buildFacetQuery(query_string):
+  """Build the search query used to gather facet information.  Only the facet
+  fields are returned, and no more than the sample limit of documents."""
+  sample_limit = getSampleLimit()
+  return search.Query(
+      query_string=query_string.strip(),
+      options=search.QueryOptions(
+          limit=sample_limit,
+          # ask for number_found to be exact at least up to the sample size,
+          # so that we can tell whether the counts are exact.
+          number_found_accuracy=sample_limit,
+          returned_fields=facetFields()))
+
+
+def countFacets(search_results):
+  """Count the facet values over the documents in the given search results,
+  and return a FacetCounts object."""
+  attr_fields = attributeFields()
+  counts = FacetCounts(
+      search_results.number_found, len(search_results.results))
+  for res in search_results:
+    pdoc = docs.Product(res)
+    counts.add(RATING, int(pdoc.getAvgRating() or 0))
+    category = pdoc.getCategory()
+    if category:
+      counts.add(CATEGORY, category)
+    price_range = priceRangeFor(pdoc.getPrice())
+    if price_range:
+      counts.add(PRICE, price_range)
+    for fname in attr_fields:
+      val = pdoc.getFieldVal(fname)
+      if val:
+        counts.add(fname, val)
+  return counts
+
+
+def computeFacetsAsync(index, query_string):
+  """Start the facet search for the given query string against the given
+  index, and return a future whose result is the FacetCounts, or None if the
+  search fails."""
+  try:
+    rpc = index.search_async(buildFacetQuery(query_string))
+  except search.Error:
+    logging.exception('An error occurred on facet search.')
+    return utils.LazyResult(lambda: None)
+
+  def _count():
+    try:
+      search_results = rpc.get_result()
+    except search.Error:
+      logging.exception('An error occurred on facet search.')
+      return None
+    return countFacets(search_results)
+  return utils.LazyResult(_count)
+
+
+def computeFacets(index, query_string):
+  """Compute the facet counts for the given query string against the given
+  index, in one search call.  Returns None if the search fails."""
+  return computeFacetsAsync(index, query_string).get_result()
@@ -17,22 +17,38 @@
 """Contains the non-admin ('user-facing') request handlers for the app."""
 
 
+import json
 import logging
 import urllib
 import wsgiref
 
 from base_handler import BaseHandler
+import cache
 import config
 import docs
+import idpool
 import models
+import ratings
+import storeindex
 import utils
+import warmup
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import search
 from google.appengine.api import users
 from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
 
 
+class WarmupHandler(BaseHandler):
+  """Handles warmup requests, which App Engine sends to new instances before
+  routing traffic to them.  Imports the app modules, loads the templates, and
+  loads the sort options and the category info (see warmup.py)."""
+
+  def get(self):
+    warmup.warmUp()
+
+
 class IndexHandler(BaseHandler):
   """Displays the 'home' page."""
 
@@ -82,20 +98,33 @@ class ShowProductHandler(BaseHandler):
           {'title': 'Error', 'msg': msg,
            'goto_url': url, 'linktext': linktext})
       return
-    doc = docs.Product.getDocFromPid(pid)
+    # The document fetch, and the product rating and first review page lookups,
+    # are independent, so run them all at once.  The index rpc is issued
+    # right away; the datastore and memcache rpcs are batched and issued when
+    # we first wait on their results, so wait on those first.
+    docs_future = docs.Product.getDocsAsync([pid])
+    rating_future = ratings.getCurrentRatingAsync(pid)
+    reviews_future = models.Review.getPageAsync(pid)
+    current_rating = rating_future.get_result()
+    reviews, _ = reviews_future.get_result()
+    doc = docs_future.get_result().get(pid)
     if not doc:
       error_message = ('Document not found for pid %s.' % pid)
-      return self.abort(404, error_message)
       logging.error(error_message)
+      return self.abort(404, error_message)
     pdoc = docs.Product(doc)
     pname = pdoc.getName()
     app_url = wsgiref.util.application_uri(self.request.environ)
     rlink = '/reviews?' + urllib.urlencode({'pid': pid, 'pname': pname})
+    avg_rating, num_reviews = current_rating or (0, 0)
     template_values = {
         'app_url': app_url,
         'pid': pid,
         'pname': pname,
         'review_link': rlink,
+        'avg_rating': avg_rating,
+        'num_reviews': num_reviews,
+        'rlist': [[r.username, r.rating, r.comment] for r in reviews],
         'comment': params['comment'],
         'rating': params['rating'],
         'category': pdoc.getCategory(),
@@ -105,6 +134,10 @@ class ShowProductHandler(BaseHandler):
     self.render_template('product.html', template_values)
 
 
+# the pool of ids for new reviews
+_review_ids = idpool.IdPool(models.Review, config.REVIEW_ID_BATCH_SIZE)
+
+
 class CreateReviewHandler(BaseHandler):
   """Process the submission of a new review."""
 
@@ -125,7 +158,11 @@ class CreateReviewHandler(BaseHandler):
 
   def post(self):
     """Create a new review entity from the submitted information."""
-    self.createReview(self.parseParams())
+    try:
+      self.createReview(self.parseParams())
+    finally:
+      # an id refill started by this request can't complete after it ends
+      _review_ids.settle()
 
   def createReview(self, params):
     """Create a new review entity from the information in the params dict."""
@@ -192,7 +229,8 @@ class CreateReviewHandler(BaseHandler):
       logging.error(error_message)
       return self.abort(404, error_message)
 
-    rid = models.Review.allocate_ids(size=1)[0]
+    # take a pre-allocated id, rather than making an allocate_ids call
+    rid = _review_ids.allocateId()
     key = ndb.Key(models.Review._get_kind(), rid)
 
     def _tx():
@@ -214,6 +252,9 @@ class ProductSearchHandler(BaseHandler):
   """The handler for doing a product search."""
 
   _DEFAULT_DOC_LIMIT = 3  #default number of search results to display per page.
+  # Pages up to this offset can be linked to by offset.  Pages beyond it are
+  # reached with search cursors, which the Search API does not limit, and which
+  # don't require the backend to skip over all the preceding results.
   _OFFSET_LIMIT = 1000
 
   def parseParams(self):
@@ -224,7 +265,9 @@ class ProductSearchHandler(BaseHandler):
         'category': '',
         'sort': '',
         'rating': '',
-        'offset': '0'
+        'price': '',
+        'offset': '0',
+        'cursor': ''
     }
     for k, v in params.iteritems():
       # Possibly replace default values.
@@ -251,14 +294,66 @@ class ProductSearchHandler(BaseHandler):
     params = self.parseParams()
     self.doProductSearch(params)
 
+  def _searchCacheParams(self, params):
+    """Build the normalized tuple of search params that identifies a search
+    results page in the cache."""
+    try:
+      offsetval = int(params.get('offset', 0))
+    except ValueError:
+      offsetval = 0
+    return (cache.normalizeQuery(params.get('query', '')),
+            params.get('category', ''), params.get('sort', ''),
+            params.get('rating', ''), params.get('price', ''),
+            offsetval, params.get('cursor', ''), self._getDocLimit())
+
   def doProductSearch(self, params):
-    """Perform a product search and display the results."""
+    """Perform a product search and display the results.  The search results
+    are cached, keyed on the normalized search params and the current product
+    index generation (see the cache module).  The category info lookup, the
+    main search, and the facet search all run concurrently.  A breakdown of
+    the time spent waiting on each is logged, and returned in the
+    Server-Timing response header."""
+
+    timer = utils.RequestTimer()
+    with timer.timed('start'):
+      # the defined product categories.  This lookup runs while we search.
+      cat_info_future = models.Category.getCategoryInfoAsync()
+      # the product fields that we can sort on from the UI
+      sort_info = docs.Product.getSortMenu()
+      generation = cache.getGeneration()
+      cache_params = self._searchCacheParams(params)
+      template_values = cache.get('psearch', cache_params, generation)
+    if template_values is None:
+      template_values = self._searchTemplateValues(params, timer)
+      if template_values is not None:
+        cache.put('psearch', cache_params, template_values, generation)
+    with timer.timed('categories'):
+      cat_info = cat_info_future.get_result()
+    if template_values is None:
+      msg = 'There was a search error (see logs).'
+      url = '/'
+      linktext = 'Go to product search page.'
+      self.render_template(
+          'notification.html',
+          {'title': 'Error', 'msg': msg,
+           'goto_url': url, 'linktext': linktext})
+      return
+    template_values.update({'cat_info': cat_info, 'sort_info': sort_info})
+    # render the result page.
+    with timer.timed('render'):
+      self.render_template('index.html', template_values)
+    logging.info('psearch timing: %s', timer)
+    self.response.headers['Server-Timing'] = timer.serverTimingHeader()
+
+  def _searchTemplateValues(self, params, timer):
+    """Perform a product search, and build the template values for displaying
+    the results.  The facet search is started first, and collected after the
+    main search results have been processed.  The time spent waiting on each
+    search is recorded with the given RequestTimer.  Returns None if there was
+    a search error."""
 
-    # the defined product categories
-    cat_info = models.Category.getCategoryInfo()
     # the product fields that we can sort on from the UI, and their mappings to
     # search.SortExpression parameters
-    sort_info = docs.Product.getSortMenu()
     sort_dict = docs.Product.getSortDict()
     query = params.get('query', '')
     user_query = query
@@ -266,42 +361,54 @@ class ProductSearchHandler(BaseHandler):
 
     categoryq = params.get('category')
     if categoryq:
-      # add specification of the category to the query
-      # Because the category field is atomic, put the category string
-      # in quotes for the search.
-      query += ' %s:"%s"' % (docs.Product.CATEGORY, categoryq)
+      # add specification of the category to the query.  The category path
+      # field holds the product's category and its ancestors, so this also
+      # matches the products in subcategories.
+      query += ' ' + docs.Product.categoryQuery(categoryq)
 
     sortq = params.get('sort')
     try:
       offsetval = int(params.get('offset', 0))
     except ValueError:
       offsetval = 0
+    web_safe_cursor = params.get('cursor') or None
 
-    # Check to see if the query parameters include a ratings filter, and
-    # add that to the final query string if so.  At the same time, generate
-    # 'ratings bucket' counts and links-- based on the query prior to addition
-    # of the ratings filter-- for sidebar display.
-    query, rlinks = self._generateRatingsInfo(
+    # Check to see if the query parameters include a ratings or price filter,
+    # and add that to the final query string if so.  At the same time,
+    # start generating facet counts and links-- based on the query prior to
+    # addition of the filters-- for sidebar display.
+    query, facets_future = self._generateFacetInfo(
         params, query, user_query, sortq, categoryq)
     logging.debug('query: %s', query.strip())
 
+    # identifies this search (independently of the page) for the remembered
+    # page cursors.
+    page_params = (cache.normalizeQuery(query), sortq, doc_limit)
+    if not web_safe_cursor and offsetval > self._OFFSET_LIMIT:
+      # Beyond the offset limit, we can only page with a cursor.  Use the
+      # remembered one for this page if there is one, else start over.
+      web_safe_cursor = cache.getPageCursor(page_params, offsetval)
+      if not web_safe_cursor:
+        offsetval = 0
+
     try:
       # build the query and perform the search
       search_query = self._buildQuery(
-          query, sortq, sort_dict, doc_limit, offsetval)
-      search_results = docs.Product.getIndex().search(search_query)
+          query, sortq, sort_dict, doc_limit, offsetval, web_safe_cursor)
+      search_rpc = docs.Product.getIndex().search_async(search_query)
+      with timer.timed('search'):
+        search_results = search_rpc.get_result()
       returned_count = len(search_results.results)
 
-    except search.Error:
+    except (search.Error, ValueError):  # ValueError: a malformed cursor
       logging.exception("Search error:")  # log the exception stack trace
-      msg = 'There was a search error (see logs).'
-      url = '/'
-      linktext = 'Go to product search page.'
-      self.render_template(
-          'notification.html',
-          {'title': 'Error', 'msg': msg,
-           'goto_url': url, 'linktext': linktext})
-      return
+      return None
+
+    # the cursor for the next page of results, if there are more.
+    next_cursor = None
+    if search_results.cursor:
+      next_cursor = search_results.cursor.web_safe_string
+      cache.setPageCursor(page_params, offsetval + doc_limit, next_cursor)
 
     # cat_name = models.Category.getCategoryName(categoryq)
     psearch_response = []
@@ -341,9 +448,11 @@ class ProductSearchHandler(BaseHandler):
     # Build the next/previous pagination links for the result set.
     (prev_link, next_link) = self._generatePaginationLinks(
         offsetval, returned_count,
-        search_results.number_found, params)
+        search_results.number_found, params, page_params, next_cursor)
 
     logging.debug('returned_count: %s', returned_count)
+    with timer.timed('facets'):
+      facet_links, facets_estimated = facets_future.get_result()
     # construct the template values
     template_values = {
         'base_pquery': user_query, 'next_link': next_link,
@@ -354,13 +463,16 @@ class ProductSearchHandler(BaseHandler):
         'returned_count': returned_count,
         'number_found': search_results.number_found,
         'search_response': psearch_response,
-        'cat_info': cat_info, 'sort_info': sort_info,
-        'ratings_links': rlinks}
-    # render the result page.
-    self.render_template('index.html', template_values)
+        'facet_links': facet_links, 'facets_estimated': facets_estimated}
+    return template_values
 
-  def _buildQuery(self, query, sortq, sort_dict, doc_limit, offsetval):
-    """Build and return a search query object."""
+  def _buildQuery(self, query, sortq, sort_dict, doc_limit, offsetval,
+                  web_safe_cursor=None):
+    """Build and return a search query object.  If a web-safe cursor string
+    is given, the query continues from that cursor; otherwise it starts at
+    the given offset.  Queries from the first page, and from cursors, request
+    a cursor for the following page.  (The Search API does not allow both an
+    offset and a cursor to be set.)"""
 
     # computed and returned fields examples.  Their use is not required
     # for the application to function correctly.
@@ -370,6 +482,13 @@ class ProductSearchHandler(BaseHandler):
                 docs.Product.CATEGORY, docs.Product.AVG_RATING,
                 docs.Product.PRICE, docs.Product.PRODUCT_NAME]
 
+    if web_safe_cursor:
+      paging = {'cursor': search.Cursor(web_safe_string=web_safe_cursor)}
+    elif offsetval:
+      paging = {'offset': offsetval}
+    else:
+      paging = {'cursor': search.Cursor()}
+
     if sortq == 'relevance':
       # If sorting on 'relevance', use the Match scorer.
       sortopts = search.SortOptions(match_scorer=search.MatchScorer())
@@ -377,11 +496,11 @@ class ProductSearchHandler(BaseHandler):
           query_string=query.strip(),
           options=search.QueryOptions(
               limit=doc_limit,
-              offset=offsetval,
               sort_options=sortopts,
               snippeted_fields=[docs.Product.DESCRIPTION],
               returned_expressions=[computed_expr],
-              returned_fields=returned_fields
+              returned_fields=returned_fields,
+              **paging
               ))
     else:
       # Otherwise (not sorting on relevance), use the selected field as the
@@ -400,17 +519,30 @@ class ProductSearchHandler(BaseHandler):
           query_string=query.strip(),
           options=search.QueryOptions(
               limit=doc_limit,
-              offset=offsetval,
               sort_options=sortopts,
               snippeted_fields=[docs.Product.DESCRIPTION],
               returned_expressions=[computed_expr],
-              returned_fields=returned_fields
+              returned_fields=returned_fields,
+              **paging
               ))
     return search_query
 
-  def _generateRatingsInfo(self, params, query, user_query, sort, category):
-    """Add a ratings filter to the query as necessary, and build the
-    sidebar ratings buckets content."""
+  def _parsePriceRange(self, prange):
+    """Parse a 'low-high' (or open-ended 'low-') price range param, as
+    generated for the price facet links.  Returns (low, high), with high None
+    if open-ended, or None if the param is not a valid range."""
+    try:
+      low, high = prange.split('-', 1)
+      low = float(low)
+      high = float(high) if high else None
+    except ValueError:
+      return None
+    return (low, high)
+
+  def _generateFacetInfo(self, params, query, user_query, sort, category):
+    """Add ratings and price filters to the query as necessary, and start
+    building the sidebar facet links content.  Returns the query, and a future
+    for the facet links info."""
 
     orig_query = query
     try:
@@ -426,31 +558,55 @@ class ProductSearchHandler(BaseHandler):
                                         docs.Product.AVG_RATING, n+1)
       else:  # max rating
         query += ' %s:%s' % (docs.Product.AVG_RATING, n)
+    price_range = self._parsePriceRange(params.get('price', ''))
+    if price_range:
+      low, high = price_range
+      query += ' %s >= %s' % (docs.Product.PRICE, low)
+      if high is not None:
+        query += ' %s < %s' % (docs.Product.PRICE, high)
     query_info = {'query': user_query.encode('utf-8'), 'sort': sort,
-             'category': category}
-    rlinks = docs.Product.generateRatingsLinks(orig_query, query_info)
-    return (query, rlinks)
+                  'category': category}
+    facets_future = docs.Product.generateFacetLinksAsync(
+        orig_query, query_info)
+    return (query, facets_future)
 
   def _generatePaginationLinks(
-        self, offsetval, returned_count, number_found, params):
+        self, offsetval, returned_count, number_found, params, page_params,
+        next_cursor=None):
     """Generate the next/prev pagination links for the query.  Detect when we're
     out of results in a given direction and don't generate the link in that
-    case."""
+    case.  The next link uses the given next page cursor if there is one.
+    Links to pages beyond the offset limit use the remembered page cursors
+    (see cache.setPageCursor) instead of offsets."""
 
     doc_limit = self._getDocLimit()
     pcopy = params.copy()
-    if offsetval - doc_limit >= 0:
-      pcopy['offset'] = offsetval - doc_limit
-      prev_link = '/psearch?' + urllib.urlencode(pcopy)
-    else:
-      prev_link = None
-    if ((offsetval + doc_limit <= self._OFFSET_LIMIT)
-        and (returned_count == doc_limit)
+    pcopy.pop('cursor', None)
+    prev_link = None
+    prev_offset = offsetval - doc_limit
+    if prev_offset >= 0:
+      pcopy['offset'] = prev_offset
+      if prev_offset <= self._OFFSET_LIMIT:
+        prev_link = '/psearch?' + urllib.urlencode(pcopy)
+      else:
+        prev_cursor = cache.getPageCursor(page_params, prev_offset)
+        if prev_cursor:
+          pcopy['cursor'] = prev_cursor
+          prev_link = '/psearch?' + urllib.urlencode(pcopy)
+    pcopy = params.copy()
+    pcopy.pop('cursor', None)
+    next_link = None
+    next_offset = offsetval + doc_limit
+    if ((returned_count == doc_limit)
         and (offsetval + returned_count < number_found)):
-      pcopy['offset'] = offsetval + doc_limit
-      next_link = '/psearch?' + urllib.urlencode(pcopy)
-    else:
-      next_link = None
+      pcopy['offset'] = next_offset
+      if not next_cursor and next_offset > self._OFFSET_LIMIT:
+        next_cursor = cache.getPageCursor(page_params, next_offset)
+      if next_cursor:
+        pcopy['cursor'] = next_cursor
+        next_link = '/psearch?' + urllib.urlencode(pcopy)
+      elif next_offset <= self._OFFSET_LIMIT:
+        next_link = '/psearch?' + urllib.urlencode(pcopy)
     return (prev_link, next_link)
 
 
@@ -465,13 +621,24 @@ class ShowReviewsHandler(BaseHandler):
     pid = self.request.get('pid')
     pname = self.request.get('pname')
     if pid:
-      # find the product entity corresponding to that pid
-      prod = models.Product.get_by_id(pid)
-      if prod:
-        # get the product's average rating, over all its reviews
-        # get the list of review entities for the product
-        avg_rating = prod.avg_rating
-        reviews = prod.reviews()
+      # the reviews are shown a page at a time; the 'cursor' request parameter
+      # marks the start of pages after the first.
+      cursor = None
+      cursor_param = self.request.get('cursor')
+      if cursor_param:
+        try:
+          cursor = ndb.Cursor(urlsafe=cursor_param)
+        except datastore_errors.BadValueError:
+          return self.abort(400, 'bad cursor')
+      # Get the product's average rating, over all its reviews (including
+      # any sharded ratings that have not been folded in yet), and a page of
+      # review entities for the product, concurrently.
+      rating_future = ratings.getCurrentRatingAsync(pid)
+      reviews_future = models.Review.getPageAsync(pid, cursor)
+      current_rating = rating_future.get_result()
+      if current_rating:
+        avg_rating, _ = current_rating
+        reviews, next_cursor = reviews_future.get_result()
         logging.debug('reviews: %s', reviews)
       else:
         error_message = 'could not get product for pid %s' % pid
@@ -481,57 +648,120 @@ class ShowReviewsHandler(BaseHandler):
 
       # build a template dict with the review and product information
       prod_url = '/product?' + urllib.urlencode({'pid': pid, 'pname': pname})
+      first_url = next_url = None
+      if cursor:
+        first_url = '/reviews?' + urllib.urlencode(
+            {'pid': pid, 'pname': pname})
+      if next_cursor:
+        next_url = '/reviews?' + urllib.urlencode(
+            {'pid': pid, 'pname': pname, 'cursor': next_cursor})
       template_values = {
           'rlist': rlist,
           'prod_url': prod_url,
+          'first_url': first_url,
+          'next_url': next_url,
           'pname': pname,
           'avg_rating': avg_rating}
       # render the template.
       self.render_template('reviews.html', template_values)
 
 
+def _storeDict(dist, store):
+  return {'addr': store.address, 'storename': store.name,
+          'lat': store.lat, 'lon': store.lon, 'distance': int(dist)}
+
+
+def _getStoreIndex():
+  """Return the instance's in-memory store index, or None if it is disabled
+  or can't be built, in which case the caller falls back to geo queries."""
+  if not config.STORE_INDEX_IN_MEMORY:
+    return None
+  try:
+    return storeindex.getStoreIndex()
+  except search.Error:
+    logging.exception('Could not build the store index; falling back to '
+                      'geo queries.')
+    return None
+
+
 class StoreLocationHandler(BaseHandler):
-  """Show the reviews for a given product.  This information is pulled from the
-  datastore Review entities."""
+  """Return the stores nearest to a given location, as JSON(P).  The stores
+  are looked up in the instance's in-memory store index (see storeindex.py),
+  or, if that isn't available, with a Search API geo query."""
 
   def get(self):
-    """Show a list of reviews for the product indicated by the 'pid' request
-    parameter."""
+    """Return the stores nearest to the location given by the 'latitude' and
+    'longitude' request parameters, nearest first.  If the 'distance'
+    parameter is given, only the stores within that many meters are returned.
+    The results are paged with the 'limit' and 'offset' parameters."""
 
-    query = self.request.get('location_query')
-    lat = self.request.get('latitude')
-    lon = self.request.get('longitude')
-    # the location query from the client will have this form:
-    # distance(store_location, geopoint(37.7899528, -122.3908226)) < 40000
-    # logging.info('location query: %s, lat %s, lon %s', query, lat, lon)
     try:
-      index = search.Index(config.STORE_INDEX_NAME)
-      # search using simply the query string:
-      # results = index.search(query)
-      # alternately: sort results by distance
-      loc_expr = 'distance(store_location, geopoint(%s, %s))' % (lat, lon)
-      sortexpr = search.SortExpression(
-            expression=loc_expr,
-            direction=search.SortExpression.ASCENDING, default_value=0)
-      sortopts = search.SortOptions(expressions=[sortexpr])
-      search_query = search.Query(
-          query_string=query.strip(),
-          options=search.QueryOptions(
-              sort_options=sortopts,
-              ))
-      results = index.search(search_query)
+      lat = float(self.request.get('latitude'))
+      lon = float(self.request.get('longitude'))
+      distance = self.request.get('distance')
+      distance = float(distance) if distance else None
+      limit = utils.intClamp(
+          self.request.get('limit') or config.STORE_RESULTS_LIMIT,
+          1, config.STORE_RESULTS_MAX)
+      offset = utils.intClamp(self.request.get('offset') or 0, 0, 1000)
+    except ValueError:
+      return self.abort(400, 'bad location query')
+    store_index = _getStoreIndex()
+    try:
+      if store_index:
+        results = store_index.nearest(lat, lon, limit, offset, distance)
+      else:
+        results = storeindex.geoQuery(lat, lon, limit, offset, distance)
     except search.Error:
       logging.exception("There was a search error:")
       self.render_json([])
       return
-    # logging.info("geo search results: %s", results)
-    response_obj2 = []
-    for res in results:
-      gdoc = docs.Store(res)
-      geopoint = gdoc.getFieldVal(gdoc.STORE_LOCATION)
-      resp = {'addr': gdoc.getFieldVal(gdoc.STORE_ADDRESS),
-              'storename': gdoc.getFieldVal(gdoc.STORE_NAME),
-              'lat': geopoint.latitude, 'lon': geopoint.longitude}
-      response_obj2.append(resp)
-    logging.info("resp: %s", response_obj2)
-    self.render_json(response_obj2)
+    self.render_json([_storeDict(dist, store) for dist, store in results])
+
+
+class NearestStoresHandler(BaseHandler):
+  """Return the nearest stores to each of a list of locations, computing the
+  distances from all the locations to all the stores in one vectorized pass
+  (see storeindex.py).  The 'points' request parameter lists the locations as
+  'lat,lon;lat,lon;...'.  Up to 'k' stores are returned per location, only
+  those within 'distance' meters if that is given.  The response is a list
+  with an entry for each location, in order."""
+
+  def get(self):
+    """Return the nearest stores as JSONP, to the given 'callback'."""
+    self.render_json(self._nearestStores())
+
+  def post(self):
+    """Return the nearest stores as plain JSON.  This is for clients with more
+    locations than fit in a URL."""
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(self._nearestStores()))
+
+  def _nearestStores(self):
+    try:
+      origins = [tuple(float(v) for v in point.split(','))
+                 for point in self.request.get('points').split(';')
+                 if point.strip()]
+      if any(len(origin) != 2 for origin in origins):
+        raise ValueError('not a lat,lon pair')
+      distance = self.request.get('distance')
+      distance = float(distance) if distance else None
+      k = utils.intClamp(self.request.get('k') or config.STORE_RESULTS_LIMIT,
+                         1, config.STORE_RESULTS_MAX)
+    except ValueError:
+      return self.abort(400, 'bad location query')
+    if len(origins) > config.STORE_BATCH_MAX_POINTS:
+      return self.abort(400, 'too many locations')
+    store_index = _getStoreIndex()
+    try:
+      if store_index:
+        results = store_index.nearestMany(origins, k, distance)
+      else:
+        results = [storeindex.geoQuery(lat, lon, k, 0, distance)
+                   for lat, lon in origins]
+    except search.Error:
+      logging.exception("There was a search error:")
+      return []
+    return [{'lat': lat, 'lon': lon,
+             'stores': [_storeDict(dist, store) for dist, store in nearest]}
+            for (lat, lon), nearest in zip(origins, results)]
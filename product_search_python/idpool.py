@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains IdPool, which hands out datastore ids for new entities of a
+model class from ranges reserved in advance with allocate_ids, so that
+creating an entity with a known key doesn't cost an allocate_ids round trip.
+"""
+
+import logging
+import thread
+import threading
+import time
+
+from google.appengine.ext.ndb import eventloop
+
+
+class IdPool(object):
+  """An in-process, thread-safe pool of reserved ids for a model class.  Ids
+  are reserved batch_size at a time.  When the pool runs low, the thread that
+  takes an id starts an async allocate_ids call for the next range, which
+  completes while that request makes its other datastore calls.  ndb runs the
+  allocation in the event loop of the request that started it, and each
+  request gets a new event loop, so a refill can only be waited on by the
+  request that started it; that request should call settle() before it ends.
+  Only if the pool runs dry is a range allocated synchronously.  Ids left in
+  the pool when the instance shuts down are just never used."""
+
+  # a refill that has not completed after this many seconds is given up on
+  _REFILL_TIMEOUT = 10
+
+  def __init__(self, model_class, batch_size=100, low_water=None):
+    self._model_class = model_class
+    self._batch_size = max(int(batch_size), 1)
+    if low_water is None:
+      low_water = self._batch_size // 4
+    self._low_water = low_water
+    # reentrant, in case the event loop runs a refill callback while the
+    # lock is held
+    self._lock = threading.RLock()
+    # reserved ranges, as [next id, last id] lists
+    self._ranges = []
+    self._available = 0
+    # (owning thread id, owning event loop, start time, future) of the refill
+    # in flight, if any
+    self._refill = None
+
+  def allocateId(self):
+    """Return a new id for the model class."""
+    while True:
+      with self._lock:
+        if self._available:
+          rng = self._ranges[0]
+          rid = rng[0]
+          rng[0] += 1
+          if rng[0] > rng[1]:
+            self._ranges.pop(0)
+          self._available -= 1
+          if self._available <= self._low_water:
+            self._dropStaleRefill()
+            if not self._refill:
+              self._startRefill()
+          return rid
+        future = self._takeRefill()
+      # the pool is empty: wait for a range without holding the lock, so that
+      # other threads are not stalled behind the allocation call.
+      if future:
+        id_range = future.get_result()
+      else:
+        id_range = self._model_class.allocate_ids(size=self._batch_size)
+      with self._lock:
+        self._addRange(id_range)
+
+  def settle(self):
+    """Wait for the refill started by the current request, if it is still in
+    flight, and add its range to the pool.  Call this before the request
+    ends, as the refill cannot complete once its event loop is gone."""
+    with self._lock:
+      if not self._ownsRefill():
+        return
+      future = self._refill[3]
+      self._refill = None
+    id_range = future.get_result()
+    with self._lock:
+      self._addRange(id_range)
+
+  def _ownsRefill(self):
+    """Whether the refill in flight, if any, was started by the current
+    request, and so runs in its event loop.  Called with the lock held."""
+    return bool(self._refill and
+                self._refill[0] == thread.get_ident() and
+                self._refill[1] is eventloop.get_event_loop())
+
+  def _dropStaleRefill(self):
+    """Forget the refill in flight if it can no longer complete: it was
+    started by an earlier request on this thread (which has ended, taking its
+    event loop with it), or it has timed out.  Called with the lock held."""
+    if not self._refill:
+      return
+    owner, loop, started, _ = self._refill
+    if owner == thread.get_ident() and loop is not eventloop.get_event_loop():
+      logging.warn('dropping an id pool refill for %s left by an earlier '
+                   'request', self._model_class.__name__)
+      self._refill = None
+    elif time.time() - started > self._REFILL_TIMEOUT:
+      logging.warn('giving up on an id pool refill for %s',
+                   self._model_class.__name__)
+      self._refill = None
+
+  def _takeRefill(self):
+    """Return the future of the refill in flight, if the current request can
+    wait on it, taking it over from the pool; otherwise None, in which case
+    the caller allocates a range synchronously.  Called with the lock held."""
+    self._dropStaleRefill()
+    if not self._ownsRefill():
+      return None
+    future = self._refill[3]
+    self._refill = None
+    return future
+
+  def _startRefill(self):
+    """Start an async allocation of the next range.  Called with the lock
+    held."""
+    future = self._model_class.allocate_ids_async(size=self._batch_size)
+    self._refill = (thread.get_ident(), eventloop.get_event_loop(),
+                    time.time(), future)
+    future.add_callback(self._finishRefill, future)
+
+  def _finishRefill(self, future):
+    with self._lock:
+      if not self._refill or self._refill[3] is not future:
+        return  # already collected, or given up on
+      self._refill = None
+      try:
+        self._addRange(future.get_result())
+      except Exception:
+        logging.exception('id pool refill for %s failed',
+                          self._model_class.__name__)
+
+  def _addRange(self, id_range):
+    start, end = id_range
+    self._ranges.append([start, end])
+    self._available += end - start + 1
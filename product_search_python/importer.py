@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the streaming, pipelined bulk importers for product and review
+data.
+Rows are read from a CSV reader as they are needed, and built into documents
+and product entities in batches of up to the Search API maximum.  The
+indexing of each batch overlaps with the datastore write of the previous
+batch.  Imports of whole files run as a chain of deferred tasks, which
+checkpoint their progress in an ImportJob entity, so that an interrupted
+import resumes from its last completed batch.
+
+Review imports write each batch of reviews with one put_multi, and group the
+batch's ratings by product, so that each product gets a single aggregated
+rating update and document reindex per batch rather than one per review.
+"""
+
+import csv
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import time
+
+import cache
+import config
+import docs
+import models
+import utils
+
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+# the maximum number of documents that can be indexed in one put call
+MAX_BATCH_SIZE = 200
+# the maximum number of review rows imported in one batch.  A product's rating
+# update writes the product and a RatingImportMark per review in one
+# transaction, which must stay within the 500 entity commit limit.
+MAX_REVIEW_BATCH_SIZE = 499
+# the default columns of a review CSV file without a header row
+REVIEW_FIELDNAMES = ['pid', 'username', 'rating', 'comment', 'date_added',
+                     'review_id']
+# the accepted formats of a review's date_added value
+_DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+
+
+def getBatchSize():
+  """The import batch size as set in the config file, clamped to the allowed
+  range."""
+  return utils.intClamp(config.IMPORT_BATCH_SIZE, 1, MAX_BATCH_SIZE)
+
+
+def batches(rows, batchsize):
+  """Yield successive lists of (up to) batchsize rows from the given row
+  iterator, without reading ahead of the current batch."""
+  rows = iter(rows)
+  while True:
+    batch = list(itertools.islice(rows, batchsize))
+    if not batch:
+      return
+    yield batch
+
+
+class ImportPipeline(object):
+  """Indexes batches of product data rows, and stores their product entities.
+  Two batches are kept in flight: while one batch's documents are being
+  indexed, the previous batch's entities are being written to the datastore.
+  (A batch's entities are only written once its documents have been indexed.)
+  """
+
+  def __init__(self, checkpoint=None):
+    """checkpoint, if given, is called with the total number of rows completed
+    so far, each time a batch has been both indexed and stored."""
+    self._index = docs.Product.getIndex()
+    self._checkpoint = checkpoint
+    # (index rpc, entities, row count) for the batch being indexed
+    self._indexing = None
+    # (datastore futures, row count) for the batch being stored
+    self._storing = None
+    self.rows_done = 0
+
+  def addBatch(self, rows):
+    """Build the given rows, and start indexing them."""
+    pdocs, prods = docs.Product.prepareProductBatch(rows)
+    if len(pdocs) < len(rows):
+      logging.warn('skipped %s bad rows', len(rows) - len(pdocs))
+    rpc = None
+    if pdocs:
+      rpc = self._index.put_async(pdocs)
+    self._finishIndexing()
+    self._indexing = (rpc, prods, len(rows))
+
+  def flush(self):
+    """Wait for all the batches in flight to be indexed and stored."""
+    self._finishIndexing()
+    self._finishStoring()
+
+  def _finishIndexing(self):
+    """Wait for the batch being indexed, then start storing its entities."""
+    if not self._indexing:
+      return
+    rpc, prods, nrows = self._indexing
+    self._indexing = None
+    futures = []
+    if rpc:
+      # a search.Error raised here will fail the task, which will then be
+      # retried from the last checkpoint.
+      add_results = rpc.get_result()
+      # set the entities with the doc ids, the list of which are returned in
+      # the same order as the list of docs given to the indexer
+      for prod, add_result in zip(prods, add_results):
+        prod.doc_id = add_result.id
+      futures = ndb.put_multi_async(prods)
+    self._finishStoring()
+    self._storing = (futures, nrows)
+
+  def _finishStoring(self):
+    """Wait for the batch being stored."""
+    if not self._storing:
+      return
+    futures, nrows = self._storing
+    self._storing = None
+    for f in futures:
+      f.get_result()
+    cache.bumpGeneration()
+    self.rows_done += nrows
+    if self._checkpoint:
+      self._checkpoint(self.rows_done)
+
+
+def importRows(rows):
+  """Import the product data rows from the given iterator (e.g., a csv
+  DictReader), in a single request.  Returns the number of rows processed."""
+  start = time.time()
+  pipeline = ImportPipeline()
+  for batch in batches(rows, getBatchSize()):
+    pipeline.addBatch(batch)
+  pipeline.flush()
+  elapsed = time.time() - start
+  logging.info('imported %s rows in %.1fs (%.1f rows/sec)',
+               pipeline.rows_done, elapsed,
+               pipeline.rows_done / elapsed if elapsed else 0)
+  return pipeline.rows_done
+
+
+def startImport(datafile, fieldnames):
+  """Create an ImportJob for the given CSV data file, whose columns are the
+  given product fields, and start running it in a deferred task.  Returns the
+  job entity."""
+  job = models.ImportJob(datafile=datafile, fieldnames=fieldnames)
+  job.put()
+  defer(runImportJob, job.key.id())
+  return job
+
+
+def runImportJob(job_id):
+  """Run (or continue) the import job with the given id, starting at its
+  checkpointed row.  If the task runs for longer than
+  config.IMPORT_TASK_TIME_LIMIT seconds, it checkpoints and chains a new task
+  to continue the import.  If the task fails, the task queue retries it, and
+  it resumes from the last checkpoint."""
+  job = models.ImportJob.get_by_id(job_id)
+  if not job or job.done:
+    return
+  task_start = time.time()
+  start_row = job.next_row
+  prior_elapsed = job.elapsed_secs
+
+  def _checkpoint(rows_done):
+    job.next_row = start_row + rows_done
+    job.elapsed_secs = prior_elapsed + (time.time() - task_start)
+    job.put()
+
+  logging.info('import of %s: starting at row %s', job.datafile, start_row)
+  with open(job.datafile, 'r') as f:
+    reader = csv.DictReader(f, job.fieldnames)
+    pipeline = ImportPipeline(_checkpoint)
+    for batch in batches(
+        itertools.islice(reader, start_row, None), getBatchSize()):
+      pipeline.addBatch(batch)
+      if time.time() - task_start > config.IMPORT_TASK_TIME_LIMIT:
+        pipeline.flush()
+        logging.info('import of %s: continuing from row %s in a new task '
+                     '(%.1f rows/sec)', job.datafile, job.next_row,
+                     job.rows_per_sec)
+        defer(runImportJob, job_id)
+        return
+    pipeline.flush()
+  job.elapsed_secs = prior_elapsed + (time.time() - task_start)
+  job.done = True
+  job.put()
+  logging.info('import of %s: done, %s rows in %.1fs (%.1f rows/sec)',
+               job.datafile, job.next_row, job.elapsed_secs, job.rows_per_sec)
+
+
+def getReviewBatchSize():
+  """The review import batch size as set in the config file, clamped to the
+  allowed range."""
+  return utils.intClamp(config.REVIEW_IMPORT_BATCH_SIZE, 1,
+                        MAX_REVIEW_BATCH_SIZE)
+
+
+def readReviewRows(f, fieldnames=None, jsonl=False):
+  """Return an iterator of review data dicts read from the given file: one
+  JSON object per line if jsonl is set, otherwise CSV rows, whose columns are
+  the given fieldnames, or are named by the file's header row if fieldnames
+  is not given."""
+  if jsonl:
+    return (json.loads(line) for line in f if line.strip())
+  return csv.DictReader(f, fieldnames or None)
+
+
+def _parseDate(value):
+  for fmt in _DATE_FORMATS:
+    try:
+      return datetime.datetime.strptime(value.strip(), fmt)
+    except ValueError:
+      pass
+  return None
+
+
+def buildReview(row):
+  """Build an (unsaved) Review entity from the given review data dict, or
+  return None if the row is not valid.  The review id is derived from the
+  row's review_id value if it has one, or else from a hash of its contents,
+  so that re-importing a row, in any job, overwrites the same entity rather
+  than adding a duplicate review."""
+  pid = row.get('pid')
+  if not pid:
+    return None
+  try:
+    rating = int(row.get('rating'))
+  except (TypeError, ValueError):
+    return None
+  if rating < config.RATING_MIN or rating > config.RATING_MAX:
+    return None
+  pid = unicode(pid).strip()
+  if row.get('review_id'):
+    rid = 'imported:%s' % row['review_id']
+  else:
+    content = [pid, row.get('username'), rating, row.get('comment'),
+               row.get('date_added')]
+    rid = 'imported-row:%s' % hashlib.sha1(
+        json.dumps(content).encode('utf-8')).hexdigest()
+  review = models.Review(
+      id=rid, product_key=ndb.Key(models.Product, pid),
+      username=row.get('username') or 'anonymous', rating=rating,
+      comment=row.get('comment') or '', rating_added=True)
+  if row.get('date_added'):
+    date_added = _parseDate(row['date_added'])
+    if date_added:
+      review.date_added = date_added
+  return review
+
+
+@ndb.transactional_tasklet
+def _addRatingsTx(pkey, reviews):
+  """Add the ratings of the given reviews of a product to its average rating,
+  skipping those whose import marks show that they have already been added.
+  The marks are in the product's entity group, so this is not an XG
+  transaction.  Returns the number of ratings added."""
+  mark_keys = [models.RatingImportMark.markKey(pkey, review.key.id())
+               for review in reviews]
+  entities = yield ndb.get_multi_async([pkey] + mark_keys)
+  prod, marks = entities[0], entities[1:]
+  if not prod:
+    raise ndb.Return(0)
+  new = [(review, mark_key)
+         for review, mark_key, mark in zip(reviews, mark_keys, marks)
+         if not mark]
+  if not new:
+    raise ndb.Return(0)
+  num_reviews = prod.num_reviews + len(new)
+  prod.avg_rating = (
+      (prod.avg_rating * prod.num_reviews +
+       sum(review.rating for review, _ in new)) / float(num_reviews))
+  prod.num_reviews = num_reviews
+  prod.needs_review_reindex = True
+  yield ndb.put_multi_async(
+      [prod] + [models.RatingImportMark(key=mark_key) for _, mark_key in new])
+  raise ndb.Return(len(new))
+
+
+def importReviewBatch(rows):
+  """Import a batch of review data rows.  The reviews are written with one
+  put_multi; then each product's ratings from the batch are added to it in
+  one transaction (the transactions for different products run
+  concurrently), and the products' documents are reindexed in one batch.
+  Rows that are not valid, or whose product does not exist, are skipped.
+  Reviews can safely be imported again, whether in a retried batch or a new
+  import of the same data: they are overwritten, and each one's rating is
+  only added once.  Returns the number of reviews imported."""
+  # review key -> review, dropping repeats of a review within the batch
+  reviews = dict((review.key, review) for review in (
+      buildReview(row) for row in rows) if review)
+  pkeys = list(set(review.product_key for review in reviews.itervalues()))
+  existing = set(prod.key for prod in ndb.get_multi(pkeys) if prod)
+  reviews = [review for review in reviews.itervalues()
+             if review.product_key in existing]
+  if len(reviews) < len(rows):
+    logging.warn('skipped %s bad or repeated review rows',
+                 len(rows) - len(reviews))
+  if not reviews:
+    return 0
+  ndb.put_multi(reviews)
+
+  by_product = {}
+  for review in reviews:
+    by_product.setdefault(review.product_key, []).append(review)
+  futures = [_addRatingsTx(pkey, prod_reviews)
+             for pkey, prod_reviews in by_product.iteritems()]
+  added = sum(f.get_result() for f in futures)
+  if added < len(reviews):
+    logging.info('%s reviews had already been imported',
+                 len(reviews) - added)
+  for pkey in by_product:
+    models.Review.invalidateFirstPage(pkey.id())
+  models.Product.updateProdDocsWithNewRating(by_product.keys())
+  return len(reviews)
+
+
+def startReviewImport(datafile, fieldnames=None):
+  """Create an ImportJob for the given review data file, and start running it
+  in a deferred task.  A file whose name ends in .jsonl or .json is read as
+  one JSON object per line; otherwise it is read as CSV, whose columns are the
+  given fieldnames, or are named by its header row.  Returns the job
+  entity."""
+  job = models.ImportJob(kind=models.ImportJob.REVIEWS, datafile=datafile,
+                         fieldnames=fieldnames or [])
+  job.put()
+  defer(runReviewImportJob, job.key.id())
+  return job
+
+
+def runReviewImportJob(job_id):
+  """Run (or continue) the review import job with the given id, starting at
+  its checkpointed row, and checkpointing after each batch.  Like
+  runImportJob, it chains a new task if it runs for longer than
+  config.IMPORT_TASK_TIME_LIMIT seconds, and a failed task resumes from the
+  last checkpoint."""
+  job = models.ImportJob.get_by_id(job_id)
+  if not job or job.done:
+    return
+  task_start = time.time()
+  prior_elapsed = job.elapsed_secs
+  jsonl = job.datafile.endswith(('.jsonl', '.json'))
+
+  logging.info('review import of %s: starting at row %s', job.datafile,
+               job.next_row)
+  with open(job.datafile, 'r') as f:
+    rows = readReviewRows(f, job.fieldnames, jsonl)
+    for batch in batches(
+        itertools.islice(rows, job.next_row, None), getReviewBatchSize()):
+      importReviewBatch(batch)
+      job.next_row += len(batch)
+      job.elapsed_secs = prior_elapsed + (time.time() - task_start)
+      job.put()
+      if time.time() - task_start > config.IMPORT_TASK_TIME_LIMIT:
+        logging.info('review import of %s: continuing from row %s in a new '
+                     'task (%.1f rows/sec)', job.datafile, job.next_row,
+                     job.rows_per_sec)
+        defer(runReviewImportJob, job_id)
+        return
+  job.elapsed_secs = prior_elapsed + (time.time() - task_start)
+  job.done = True
+  job.put()
+  logging.info('review import of %s: done, %s rows in %.1fs (%.1f rows/sec)',
+               job.datafile, job.next_row, job.elapsed_secs, job.rows_per_sec)
@@ -0,0 +1,904 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" An in-process search backend, for tests and offline tools.  LocalIndex
+implements the parts of the search.Index interface that the app uses (put,
+delete, get_range and search, and their async variants), over an inverted
+index with compact posting lists, and sorted numeric (and date) field indexes,
+so that it stays fast with catalogs of a million documents.  It is used in
+place of the Search API when config.SEARCH_BACKEND is 'local' (see
+BaseDocumentManager.getIndex).
+
+The query language supported is the subset that the app emits: words and
+quoted phrases, optionally restricted to a field (field:value,
+field:"some value"), numeric and date comparisons (ar >= 2, price < 100),
+distance(field, geopoint(lat, lon)) comparisons, AND, OR, NOT (or '-') and
+parentheses.  Sort expressions may be field names, _score, numbers,
+distance(...) calls, and arithmetic combinations of these.
+"""
+
+import array
+import base64
+import bisect
+import datetime
+import heapq
+import itertools
+import math
+import re
+import threading
+
+import utils
+
+from google.appengine.api import search
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_DISTANCE_RE = re.compile(
+    r'distance\(\s*(\w+)\s*,\s*geopoint\(\s*([-+\d.eE]+)\s*,\s*([-+\d.eE]+)'
+    r'\s*\)\s*\)\s*(<=|>=|<|>|=)\s*([-+\d.eE]+)')
+_EARTH_RADIUS_METERS = 6371010.0
+# compact the posting lists when at least this many documents have been
+# replaced or deleted, and they outnumber the live documents.
+_MIN_DEAD_TO_COMPACT = 1000
+# new values are inserted into a sorted column index one at a time, unless
+# there are more than this many, in which case it is re-sorted.
+_MAX_PENDING_INSERTS = 1000
+# the pseudo-column holding the document ranks.  (Field names must start with
+# a letter, so this can't collide with a field.)
+_RANK = '_rank'
+
+# field kinds
+_TEXT = 'text'
+_ATOM = 'atom'
+_NUMBER = 'number'
+_DATE = 'date'
+_GEO = 'geo'
+
+_INDEXES = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def getIndex(name):
+  """Return the LocalIndex with the given name, creating it if necessary."""
+  with _REGISTRY_LOCK:
+    index = _INDEXES.get(name)
+    if index is None:
+      index = _INDEXES[name] = LocalIndex(name)
+    return index
+
+
+def resetAll():
+  """Drop all the local indexes."""
+  with _REGISTRY_LOCK:
+    _INDEXES.clear()
+
+
+def tokenize(text):
+  return [t.lower() for t in _TOKEN_RE.findall(text or '')]
+
+
+def _fieldKind(field):
+  if isinstance(field, search.AtomField):
+    return _ATOM
+  if isinstance(field, search.NumberField):
+    return _NUMBER
+  if isinstance(field, search.DateField):
+    return _DATE
+  if isinstance(field, search.GeoField):
+    return _GEO
+  return _TEXT  # TextField and HtmlField
+
+
+def _dateOrdinal(value):
+  if isinstance(value, datetime.datetime):
+    value = value.date()
+  return value.toordinal()
+
+
+def _distance(geopoint, lat, lon):
+  """The great-circle distance in meters between a GeoPoint and a lat/lon."""
+  lat1, lon1 = math.radians(geopoint.latitude), math.radians(geopoint.longitude)
+  lat2, lon2 = math.radians(lat), math.radians(lon)
+  a = (math.sin((lat2 - lat1) / 2) ** 2 +
+       math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+  return 2 * _EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def _compare(value, op, target):
+  if op == '<':
+    return value < target
+  if op == '<=':
+    return value <= target
+  if op == '>':
+    return value > target
+  if op == '>=':
+    return value >= target
+  return value == target
+
+
+class _QueryParser(object):
+  """Parses a query string into a tree of tuples:
+    ('all',), ('and', [nodes]), ('or', [nodes]), ('not', node),
+    ('term', field or None, value, quoted),
+    ('cmp', field, op, value), ('dist', field, lat, lon, op, value).
+  """
+
+  _OPS = ['<=', '>=', '<', '>', '=', ':']
+
+  def __init__(self, query_string):
+    self.text = query_string or ''
+    self.pos = 0
+
+  def parse(self):
+    if not self.text.strip():
+      return ('all',)
+    node = self._parseOr()
+    self._skipSpace()
+    if self.pos < len(self.text):
+      raise search.QueryError('Failed to parse query "%s"' % self.text)
+    return node
+
+  def _skipSpace(self):
+    while self.pos < len(self.text) and self.text[self.pos].isspace():
+      self.pos += 1
+
+  def _peekWord(self):
+    self._skipSpace()
+    m = re.compile(r'[^\s()<>=:"]+').match(self.text, self.pos)
+    return m.group(0) if m else None
+
+  def _parseOr(self):
+    nodes = [self._parseAnd()]
+    while self._peekWord() == 'OR':
+      self.pos += 2
+      nodes.append(self._parseAnd())
+    return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+  def _parseAnd(self):
+    nodes = []
+    while True:
+      self._skipSpace()
+      if self.pos >= len(self.text) or self.text[self.pos] == ')':
+        break
+      word = self._peekWord()
+      if word == 'OR':
+        break
+      if word == 'AND':
+        self.pos += 3
+        continue
+      nodes.append(self._parseUnary())
+    if not nodes:
+      raise search.QueryError('Failed to parse query "%s"' % self.text)
+    return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+  def _parseUnary(self):
+    self._skipSpace()
+    if self._peekWord() == 'NOT':
+      self.pos += 3
+      return ('not', self._parseUnary())
+    if self.text[self.pos] == '-':
+      self.pos += 1
+      return ('not', self._parseUnary())
+    if self.text[self.pos] == '(':
+      self.pos += 1
+      node = self._parseOr()
+      self._skipSpace()
+      if self.pos >= len(self.text) or self.text[self.pos] != ')':
+        raise search.QueryError('Unbalanced parentheses in "%s"' % self.text)
+      self.pos += 1
+      return node
+    return self._parseTerm()
+
+  def _parseValue(self):
+    """Parse a word or a quoted string; returns (value, quoted)."""
+    self._skipSpace()
+    if self.pos < len(self.text) and self.text[self.pos] == '"':
+      end = self.text.find('"', self.pos + 1)
+      if end < 0:
+        raise search.QueryError('Unbalanced quotes in "%s"' % self.text)
+      value = self.text[self.pos + 1:end]
+      self.pos = end + 1
+      return (value, True)
+    word = self._peekWord()
+    if not word:
+      raise search.QueryError('Failed to parse query "%s"' % self.text)
+    self.pos += len(word)
+    return (word, False)
+
+  def _parseTerm(self):
+    m = _DISTANCE_RE.match(self.text, self.pos)
+    if m:
+      self.pos = m.end()
+      return ('dist', m.group(1), float(m.group(2)), float(m.group(3)),
+              m.group(4), float(m.group(5)))
+    value, quoted = self._parseValue()
+    if quoted:
+      return ('term', None, value, True)
+    save = self.pos
+    self._skipSpace()
+    for op in self._OPS:
+      if self.text.startswith(op, self.pos):
+        self.pos += len(op)
+        target, target_quoted = self._parseValue()
+        if op == ':':
+          return ('term', value, target, target_quoted)
+        return ('cmp', value, op, target)
+    self.pos = save
+    return ('term', None, value, False)
+
+
+class _Expression(object):
+  """Evaluates a sort or returned expression: field names, _score, numbers,
+  distance(field, geopoint(lat, lon)), max(...)/min(...), and + - * /."""
+
+  _TOKENS_RE = re.compile(
+      r'\s*(?:(?P<num>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+)|(?P<name>\w+)|'
+      r'(?P<op>[-+*/(),]))')
+
+  def __init__(self, expression):
+    self.expression = expression
+    self.tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+      m = self._TOKENS_RE.match(expression, pos)
+      if not m or m.end() == pos:
+        raise search.ExpressionError('Failed to parse expression "%s"' %
+                                     expression)
+      pos = m.end()
+      self.tokens.append((m.lastgroup, m.group(m.lastgroup)))
+    # the fast path: a plain field name
+    if len(self.tokens) == 1 and self.tokens[0][0] == 'name':
+      self.field_name = self.tokens[0][1]
+    else:
+      self.field_name = None
+
+  def evaluate(self, index, ordinal, score=0):
+    """Evaluate for the given document; returns None if a field is missing."""
+    self._pos = 0
+    try:
+      value = self._sum(index, ordinal, score)
+    except (TypeError, ValueError, ZeroDivisionError, IndexError):
+      return None
+    return value
+
+  def _next(self):
+    token = self.tokens[self._pos]
+    self._pos += 1
+    return token
+
+  def _peek(self):
+    if self._pos < len(self.tokens):
+      return self.tokens[self._pos]
+    return (None, None)
+
+  def _sum(self, index, ordinal, score):
+    value = self._product(index, ordinal, score)
+    while self._peek() in [('op', '+'), ('op', '-')]:
+      op = self._next()[1]
+      rhs = self._product(index, ordinal, score)
+      value = value + rhs if op == '+' else value - rhs
+    return value
+
+  def _product(self, index, ordinal, score):
+    value = self._atom(index, ordinal, score)
+    while self._peek() in [('op', '*'), ('op', '/')]:
+      op = self._next()[1]
+      rhs = self._atom(index, ordinal, score)
+      value = value * rhs if op == '*' else value / float(rhs)
+    return value
+
+  def _args(self, index, ordinal, score):
+    self._next()  # '('
+    args = [self._sum(index, ordinal, score)]
+    while self._peek() == ('op', ','):
+      self._next()
+      args.append(self._sum(index, ordinal, score))
+    self._next()  # ')'
+    return args
+
+  def _atom(self, index, ordinal, score):
+    kind, value = self._next()
+    if kind == 'num':
+      return float(value)
+    if kind == 'op' and value == '-':
+      return -self._atom(index, ordinal, score)
+    if kind == 'op' and value == '(':
+      res = self._sum(index, ordinal, score)
+      self._next()  # ')'
+      return res
+    if value == '_score':
+      return score
+    if value == 'distance':
+      self._next()  # '('
+      field = self._next()[1]
+      self._next()  # ','
+      self._next()  # 'geopoint'
+      lat, lon = self._args(index, ordinal, score)
+      self._next()  # ')'
+      geopoint = index.fieldValue(ordinal, field)
+      if geopoint is None:
+        return None
+      return _distance(geopoint, lat, lon)
+    if value in ['max', 'min'] and self._peek() == ('op', '('):
+      args = self._args(index, ordinal, score)
+      return max(args) if value == 'max' else min(args)
+    return index.sortValue(ordinal, value)
+
+
+class _Descending(object):
+  """Wraps a sort key value to invert its ordering."""
+
+  __slots__ = ['value']
+
+  def __init__(self, value):
+    self.value = value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+
+class LocalIndex(object):
+  """An in-memory search index.  See the module docstring."""
+
+  def __init__(self, name):
+    self.name = name
+    self._lock = threading.RLock()
+    self._clear()
+
+  def _clear(self):
+    # ordinal -> search.Document, or None if replaced/deleted
+    self._docs = []
+    self._ids = {}  # doc id -> ordinal
+    self._live = set()
+    self._dead = 0
+    # posting lists, keyed by (field or None, token) for text, and by
+    # ('=field', lowercased value) for atoms: arrays of ascending ordinals.
+    self._postings = {}
+    # field name -> kind
+    self._kinds = {}
+    # numeric and date columns: field name -> {ordinal: value}; their sorted
+    # (values, ordinals) indexes, built when first needed; and the (value,
+    # ordinal)s added since then.
+    self._columns = {}
+    self._sorted = {}
+    self._pending = {}
+    self._sorted_ids = None
+
+  # --- writes
+
+  def put(self, documents):
+    """Index the given document(s), replacing any with the same doc ids.
+    Returns a list of search.PutResults."""
+    if isinstance(documents, search.Document):
+      documents = [documents]
+    results = []
+    with self._lock:
+      for doc in documents:
+        doc_id = doc.doc_id
+        if not doc_id:
+          raise ValueError('LocalIndex documents must have doc ids')
+        self._remove(doc_id)
+        self._add(doc)
+        results.append(search.PutResult(
+            code=search.OperationResult.OK, id=doc_id))
+      self._maybeCompact()
+    return results
+
+  def delete(self, document_ids):
+    """Delete the documents with the given id(s)."""
+    if isinstance(document_ids, basestring):
+      document_ids = [document_ids]
+    with self._lock:
+      for doc_id in document_ids:
+        self._remove(doc_id)
+      self._maybeCompact()
+
+  def _add(self, doc):
+    ordinal = len(self._docs)
+    # store a copy, so that callers' changes to the doc are not seen
+    self._docs.append(search.Document(
+        doc_id=doc.doc_id, fields=list(doc.fields), language=doc.language,
+        rank=doc.rank))
+    self._ids[doc.doc_id] = ordinal
+    self._live.add(ordinal)
+    self._sorted_ids = None
+    self._addToColumn(_RANK, ordinal, doc.rank)
+    for field in doc.fields:
+      kind = _fieldKind(field)
+      self._kinds.setdefault(field.name, kind)
+      if kind == _TEXT:
+        for token in set(tokenize(field.value)):
+          self._post((field.name, token), ordinal)
+          self._post((None, token), ordinal)
+      elif kind == _ATOM:
+        value = (field.value or '').lower()
+        self._post(('=' + field.name, value), ordinal)
+        self._post(('=', value), ordinal)
+      elif kind in (_NUMBER, _DATE):
+        value = field.value
+        if kind == _DATE:
+          value = _dateOrdinal(value)
+        self._addToColumn(field.name, ordinal, value)
+
+  def _addToColumn(self, name, ordinal, value):
+    column = self._columns.setdefault(name, {})
+    if ordinal in column:
+      return  # only the first field with a given name is indexed
+    column[ordinal] = value
+    if name in self._sorted:
+      self._pending.setdefault(name, []).append((value, ordinal))
+
+  def _post(self, key, ordinal):
+    postings = self._postings.get(key)
+    if postings is None:
+      postings = self._postings[key] = array.array('l')
+    if not postings or postings[-1] != ordinal:
+      postings.append(ordinal)
+
+  def _remove(self, doc_id):
+    ordinal = self._ids.pop(doc_id, None)
+    if ordinal is None:
+      return
+    self._docs[ordinal] = None
+    self._live.discard(ordinal)
+    self._dead += 1
+    self._sorted_ids = None
+
+  def _maybeCompact(self):
+    """Rebuild the index without the replaced and deleted documents, once they
+    make up most of it."""
+    if self._dead >= _MIN_DEAD_TO_COMPACT and self._dead > len(self._live):
+      live_docs = [doc for doc in self._docs if doc is not None]
+      self._clear()
+      for doc in live_docs:
+        self._add(doc)
+
+  # --- field access
+
+  def fieldValue(self, ordinal, name):
+    """The value of the (first) field with the given name, or None."""
+    for field in self._docs[ordinal].fields:
+      if field.name == name:
+        return field.value
+    return None
+
+  def sortValue(self, ordinal, name):
+    column = self._columns.get(name)
+    if column is not None:
+      return column.get(ordinal)
+    value = self.fieldValue(ordinal, name)
+    if isinstance(value, basestring):
+      return value.lower()
+    return value
+
+  def _sortedColumn(self, name):
+    """Return the (values, ordinals) of the given column, in ascending
+    (value, ordinal) order.  May include deleted documents."""
+    entry = self._sorted.get(name)
+    pending = self._pending.pop(name, None)
+    if entry is None or (pending and len(pending) > _MAX_PENDING_INSERTS):
+      items = sorted((v, o) for o, v in self._columns.get(name, {}).iteritems()
+                     if o in self._live)
+      entry = self._sorted[name] = ([v for v, _ in items],
+                                    [o for _, o in items])
+    elif pending:
+      values, ordinals = entry
+      for value, ordinal in pending:
+        # ordinals only increase, so inserting after equal values keeps the
+        # (value, ordinal) order
+        i = bisect.bisect_right(values, value)
+        values.insert(i, value)
+        ordinals.insert(i, ordinal)
+    return entry
+
+  # --- reads
+
+  def get_range(self, start_id=None, include_start_object=True, limit=100,
+                ids_only=False, **kwargs):
+    """Return a search.GetResponse with (up to limit) documents in doc id
+    order, starting at start_id."""
+    with self._lock:
+      if self._sorted_ids is None:
+        self._sorted_ids = sorted(self._ids)
+      ids = self._sorted_ids
+      pos = 0
+      if start_id:
+        if include_start_object:
+          pos = bisect.bisect_left(ids, start_id)
+        else:
+          pos = bisect.bisect_right(ids, start_id)
+      results = [self._copyDoc(self._ids[doc_id], ids_only)
+                 for doc_id in ids[pos:pos + limit]]
+    return search.GetResponse(results=results)
+
+  def _copyDoc(self, ordinal, ids_only=False, returned_fields=None):
+    doc = self._docs[ordinal]
+    if ids_only:
+      fields = []
+    elif returned_fields:
+      fields = [f for f in doc.fields if f.name in returned_fields]
+    else:
+      fields = list(doc.fields)
+    return search.Document(doc_id=doc.doc_id, fields=fields,
+                           language=doc.language, rank=doc.rank)
+
+  def search(self, query, **kwargs):
+    """Run the given search.Query (or query string), and return a
+    search.SearchResults."""
+    if isinstance(query, basestring):
+      query = search.Query(query_string=query)
+    options = query.options or search.QueryOptions()
+    tree = _QueryParser(query.query_string).parse()
+    with self._lock:
+      matches = self._evaluate(tree)
+      ordered, scores = self._order(matches, tree, options.sort_options)
+      number_found = len(matches)
+      cursor = options.cursor
+      start = options.offset or 0
+      if cursor is not None and cursor.web_safe_string:
+        start = self._decodeCursor(cursor)
+      limit = options.limit
+      page = ordered(start + limit)[start:start + limit]
+      per_result = cursor is not None and cursor.per_result
+      results = []
+      for i, ordinal in enumerate(page):
+        results.append(self._scoredDoc(
+            ordinal, options, scores.get(ordinal, 0),
+            self._encodeCursor(start + i + 1) if per_result else None))
+      next_cursor = None
+      if (cursor is not None and not per_result and
+          start + limit < number_found):
+        next_cursor = self._encodeCursor(start + limit)
+    return search.SearchResults(
+        number_found=number_found, results=results, cursor=next_cursor)
+
+  def _encodeCursor(self, position):
+    return search.Cursor(web_safe_string='False:' + base64.urlsafe_b64encode(
+        '%s:%d' % (self.name, position)))
+
+  def _decodeCursor(self, cursor):
+    try:
+      internal = cursor.web_safe_string.split(':', 1)[1]
+      name, position = base64.urlsafe_b64decode(
+          str(internal)).rsplit(':', 1)
+      return int(position)
+    except (IndexError, TypeError, ValueError):
+      raise ValueError('invalid cursor %s' % cursor.web_safe_string)
+
+  def _scoredDoc(self, ordinal, options, score, cursor):
+    doc = self._copyDoc(ordinal, options.ids_only, options.returned_fields)
+    expressions = []
+    if not options.ids_only:
+      for fname in options.snippeted_fields or []:
+        value = self.fieldValue(ordinal, fname)
+        if value is not None:
+          expressions.append(search.HtmlField(name=fname, value=value))
+      for expr in options.returned_expressions or []:
+        value = _Expression(expr.expression).evaluate(self, ordinal, score)
+        if isinstance(value, (int, long, float)):
+          expressions.append(search.NumberField(name=expr.name, value=value))
+    return search.ScoredDocument(
+        doc_id=doc.doc_id, fields=doc.fields, language=doc.language,
+        rank=doc.rank, sort_scores=[score], expressions=expressions,
+        cursor=cursor)
+
+  # --- query evaluation
+
+  def _postingSet(self, key):
+    postings = self._postings.get(key)
+    if not postings:
+      return set()
+    return self._live.intersection(postings)
+
+  def _evaluate(self, node):
+    """Return the set of live ordinals matching the given query tree node."""
+    kind = node[0]
+    if kind == 'all':
+      return set(self._live)
+    if kind == 'and':
+      # intersect the positive parts, smallest first.  Large posting lists
+      # are not turned into sets, but probed for the remaining candidates.
+      sets = []
+      postings = []
+      for n in node[1]:
+        if n[0] != 'not':
+          raw = self._rawPostings(n)
+          if raw is None:
+            sets.append(self._evaluate(n))
+          else:
+            postings.append(raw)
+      sets.sort(key=len)
+      postings.sort(key=lambda raw: sum(len(a) for a in raw))
+      if sets:
+        result = sets[0]
+        for other in sets[1:]:
+          result &= other
+      elif postings:
+        result = self._postingsSet(postings.pop(0))
+      else:
+        result = set(self._live)
+      for raw in postings:
+        result = self._filterByPostings(result, raw)
+      for n in node[1]:
+        if n[0] == 'not':
+          result -= self._evaluate(n[1])
+      return result
+    if kind == 'or':
+      result = set()
+      for n in node[1]:
+        result |= self._evaluate(n)
+      return result
+    if kind == 'not':
+      return self._live - self._evaluate(node[1])
+    if kind == 'term':
+      return self._evaluateTerm(node[1], node[2], node[3])
+    if kind == 'cmp':
+      return self._evaluateComparison(node[1], node[2], node[3])
+    if kind == 'dist':
+      _, field, lat, lon, op, target = node
+      result = set()
+      for ordinal in self._live:
+        geopoint = self.fieldValue(ordinal, field)
+        if geopoint is not None and _compare(
+            _distance(geopoint, lat, lon), op, target):
+          result.add(ordinal)
+      return result
+    raise search.QueryError('Unsupported query node %s' % (node,))
+
+  def _rawPostings(self, node):
+    """If the given query node matches the documents in one or more posting
+    lists, return the lists; otherwise None."""
+    if node[0] != 'term':
+      return None
+    _, field, value, quoted = node
+    fkind = self._kinds.get(field) if field else None
+    empty = array.array('l')
+    if fkind == _ATOM:
+      return [self._postings.get(('=' + field, value.lower()), empty)]
+    tokens = tokenize(value)
+    if fkind not in (None, _TEXT) or len(tokens) != 1:
+      return None
+    raw = [self._postings.get((field, tokens[0]), empty)]
+    if fkind is None:
+      # an untyped term also matches atoms, in the same field only
+      raw.append(self._postings.get(
+          ('=' + (field or ''), value.lower()), empty))
+    return raw
+
+  def _postingsSet(self, raw):
+    result = set()
+    for postings in raw:
+      result |= self._live.intersection(postings)
+    return result
+
+  def _filterByPostings(self, candidates, raw):
+    """Return the candidates that are in any of the given posting lists."""
+    if sum(len(postings) for postings in raw) < 4 * len(candidates):
+      return candidates & self._postingsSet(raw)
+
+    def _contains(postings, ordinal):
+      i = bisect.bisect_left(postings, ordinal)
+      return i < len(postings) and postings[i] == ordinal
+    return set(o for o in candidates
+               if any(_contains(postings, o) for postings in raw))
+
+  def _evaluateTerm(self, field, value, quoted):
+    fkind = self._kinds.get(field) if field else None
+    if fkind in (_NUMBER, _DATE):
+      return self._evaluateComparison(field, '=', value)
+    result = set()
+    if fkind in (None, _ATOM):
+      result |= self._postingSet(('=' + (field or ''), value.lower()))
+    if fkind in (None, _TEXT):
+      tokens = tokenize(value)
+      if tokens:
+        sets = [self._postingSet((field, t)) for t in tokens]
+        sets.sort(key=len)
+        text_matches = sets[0]
+        for other in sets[1:]:
+          text_matches = text_matches & other
+        if quoted and len(tokens) > 1:
+          text_matches = set(o for o in text_matches
+                             if self._hasPhrase(o, field, tokens))
+        result |= text_matches
+    return result
+
+  def _hasPhrase(self, ordinal, field, tokens):
+    n = len(tokens)
+    for f in self._docs[ordinal].fields:
+      if (field and f.name != field) or _fieldKind(f) != _TEXT:
+        continue
+      ftokens = tokenize(f.value)
+      for i in xrange(len(ftokens) - n + 1):
+        if ftokens[i:i + n] == tokens:
+          return True
+    return False
+
+  def _evaluateComparison(self, field, op, value):
+    fkind = self._kinds.get(field)
+    if fkind not in (_NUMBER, _DATE):
+      if fkind is None:
+        return set()
+      raise search.QueryError('Field %s does not support comparisons' % field)
+    try:
+      if fkind == _DATE:
+        target = _dateOrdinal(
+            datetime.datetime.strptime(value, '%Y-%m-%d').date())
+      else:
+        target = float(value)
+    except ValueError:
+      raise search.QueryError('Bad comparison value %s' % value)
+    values, ordinals = self._sortedColumn(field)
+    if op == '<':
+      lo, hi = 0, bisect.bisect_left(values, target)
+    elif op == '<=':
+      lo, hi = 0, bisect.bisect_right(values, target)
+    elif op == '>':
+      lo, hi = bisect.bisect_right(values, target), len(values)
+    elif op == '>=':
+      lo, hi = bisect.bisect_left(values, target), len(values)
+    else:
+      lo, hi = (bisect.bisect_left(values, target),
+                bisect.bisect_right(values, target))
+    return self._live.intersection(ordinals[lo:hi])
+
+  # --- ordering
+
+  def _scores(self, matches, tree):
+    """Simple term frequency scores, for the MatchScorer."""
+    tokens = []
+
+    def _collect(node):
+      if node[0] in ('and', 'or'):
+        for n in node[1]:
+          _collect(n)
+      elif node[0] == 'term':
+        tokens.extend((node[1], t) for t in tokenize(node[2]))
+    _collect(tree)
+    scores = {}
+    for ordinal in matches:
+      score = 0
+      for f in self._docs[ordinal].fields:
+        if _fieldKind(f) != _TEXT:
+          continue
+        ftokens = tokenize(f.value)
+        for field, token in tokens:
+          if field is None or field == f.name:
+            score += ftokens.count(token)
+      scores[ordinal] = score
+    return scores
+
+  def _order(self, matches, tree, sort_options):
+    """Return (ordered, scores), where ordered(n) returns the first n of the
+    matching ordinals in result order: by the sort expressions, then by
+    descending match score if there is a MatchScorer, or else, if there are no
+    sort expressions, by descending document rank.  Remaining ties are in
+    descending index order, so that the order is the same from page to page."""
+    scores = {}
+    match_scorer = sort_options and sort_options.match_scorer
+    sort_exprs = (sort_options and sort_options.expressions) or []
+    if match_scorer:
+      scores = self._scores(matches, tree)
+    keyfuncs = [self._sortKeyFunc(e, scores) for e in sort_exprs]
+    if match_scorer:
+      keyfuncs.append(lambda o: -scores.get(o, 0))
+    elif not sort_exprs:
+      ranks = self._columns.get(_RANK, {})
+      keyfuncs.append(lambda o: -ranks[o])
+    keyfuncs.append(lambda o: -o)
+
+    def key(ordinal):
+      return tuple(f(ordinal) for f in keyfuncs)
+
+    # if the results are ordered by a single column, they can be read off its
+    # sorted index
+    column_order = None
+    if not match_scorer and not sort_exprs:
+      column_order = (_RANK, 0, True)
+    elif not match_scorer and len(sort_exprs) == 1:
+      name = _Expression(sort_exprs[0].expression).field_name
+      default = self._columnDefault(name, sort_exprs[0].default_value)
+      if name in self._columns and isinstance(default, (int, long, float)):
+        column_order = (name, default, sort_exprs[0].direction ==
+                        search.SortExpression.DESCENDING)
+
+    def ordered(n):
+      if column_order and self._isWalkCheap(matches, column_order[0], n):
+        return self._walkColumn(matches, n, *column_order)
+      if n < len(matches) / 4:
+        return heapq.nsmallest(n, matches, key=key)
+      return sorted(matches, key=key)[:n]
+    return (ordered, scores)
+
+  def _isWalkCheap(self, matches, name, n):
+    """Whether walking the sorted index of the given column to find the first
+    n matches would take fewer steps (about n * size / matches) than sorting
+    the matches."""
+    size = len(self._columns[name])
+    return n * size <= 4 * len(matches) * len(matches)
+
+  def _walkColumn(self, matches, n, name, default, descending):
+    """Return the first n matches in (value, then descending ordinal) order
+    of the given column, with default as the value of matches that lack it."""
+    values, ordinals = self._sortedColumn(name)
+
+    def _present():
+      if descending:
+        for i in xrange(len(ordinals) - 1, -1, -1):
+          if ordinals[i] in matches:
+            yield (-values[i], -ordinals[i], ordinals[i])
+      else:
+        i = 0
+        while i < len(values):
+          # within a run of equal values, the ordinals are in descending order
+          j = bisect.bisect_right(values, values[i], i)
+          for k in xrange(j - 1, i - 1, -1):
+            if ordinals[k] in matches:
+              yield (values[k], -ordinals[k], ordinals[k])
+          i = j
+    missing_key = -default if descending else default
+    missing = ((missing_key, -o, o) for o in heapq.nlargest(
+        n, matches.difference(self._columns[name])))
+    return [o for _, _, o in itertools.islice(
+        heapq.merge(_present(), missing), n)]
+
+  def _columnDefault(self, name, default):
+    """Date columns hold date ordinals, so convert a date default value."""
+    if isinstance(default, (datetime.date, datetime.datetime)):
+      return _dateOrdinal(default)
+    return default
+
+  def _sortKeyFunc(self, sort_expr, scores):
+    expr = _Expression(sort_expr.expression)
+    default = sort_expr.default_value
+    descending = sort_expr.direction == search.SortExpression.DESCENDING
+    if expr.field_name and expr.field_name != '_score':
+      name = expr.field_name
+      column = self._columns.get(name)
+      if column is not None:
+        default = self._columnDefault(name, default)
+        getter = lambda o: column.get(o, default)
+      else:
+        getter = lambda o: self._orDefault(self.sortValue(o, name), default)
+    else:
+      getter = lambda o: self._orDefault(
+          expr.evaluate(self, o, scores.get(o, 0)), default)
+    if descending:
+      return lambda o: _Descending(getter(o))
+    return getter
+
+  def _orDefault(self, value, default):
+    if value is None:
+      return default
+    return value
+
+  # --- async variants, for parity with search.Index.  The work is done when
+  # the result is requested.
+
+  def put_async(self, documents, **kwargs):
+    return utils.LazyResult(lambda: self.put(documents))
+
+  def delete_async(self, document_ids, **kwargs):
+    return utils.LazyResult(lambda: self.delete(document_ids))
+
+  def get_range_async(self, **kwargs):
+    return utils.LazyResult(lambda: self.get_range(**kwargs))
+
+  def search_async(self, query, **kwargs):
+    return utils.LazyResult(lambda: self.search(query))
@@ -18,6 +18,9 @@
 """
 
 
+# imported first, to note the start of the instance
+import warmup
+
 from handlers import *
 import webapp2
 
@@ -27,7 +30,9 @@ application = webapp2.WSGIApplication(
      ('/product', ShowProductHandler),
      ('/reviews', ShowReviewsHandler),
      ('/create_review', CreateReviewHandler),
-     ('/get_store_locations', StoreLocationHandler)
+     ('/get_store_locations', StoreLocationHandler),
+     ('/get_nearest_stores', NearestStoresHandler),
+     ('/_ah/warmup', WarmupHandler)
     ],
     debug=True)
 
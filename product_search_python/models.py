@@ -15,7 +15,8 @@
 # limitations under the License.
 
 """ Contains the Datastore model classes used by the app: Category, Product,
-and Review.
+and Review, and ImportJob and ResetJob, which track the progress of data
+imports and of data resets.
 Each Product entity will have a corresponding indexed "product" search.Document.
 Product entities contain a subset of the fields in their corresponding document.
 Product Review entities are not indexed (do not have corresponding Documents).
@@ -25,8 +26,12 @@ scenarios where a large number of product reviews might be edited/added at once.
 """
 
 import logging
+import threading
+import time
 
+import cache
 import categories
+import config
 import docs
 
 from google.appengine.api import memcache
@@ -35,14 +40,30 @@ from google.appengine.ext import ndb
 
 class Category(ndb.Model):
   """The model class for product category information.  Supports building a
-  category tree."""
+  category tree.  Each category stores its materialized path: the names of
+  its ancestors (below the root) and itself, which are indexed in the
+  category_path field of product documents, so that a search restricted to a
+  category also matches the products in its subcategories.
+
+  The category info used by the handlers is cached in memcache, under a
+  version number that is bumped on every category write, and each instance
+  keeps a snapshot of it, which it checks against the memcache version at most
+  every config.CATEGORY_CACHE_CHECK_INTERVAL seconds.  So a new instance
+  usually gets the category info from memcache, without datastore queries."""
 
-  _CATEGORY_INFO = None
-  _CATEGORY_DICT = None
-  _RCATEGORY_DICT = None
   _ROOT = 'root'  # the 'root' category of the category tree
+  _CACHE_NAMESPACE = 'category_cache'
+  _VERSION_KEY = 'version'
+  # the instance's (version, category data, time last checked) snapshot; the
+  # app is threadsafe, so it is guarded by a lock.
+  _snapshot = None
+  _snapshot_lock = threading.Lock()
+  # set while writing a batch of categories, which is invalidated once
+  _batch_write = threading.local()
 
   parent_category = ndb.KeyProperty()
+  # the names of the category's ancestors below the root, and its own name
+  path = ndb.StringProperty(repeated=True)
 
   @property
   def category_name(self):
@@ -56,47 +77,122 @@ class Category(ndb.Model):
     # Don't build if there are any categories in the datastore already
     if cls.query().get():
       return
-    root_category = categories.ctree
-    cls.buildCategory(root_category, None)
+    cls.putCategories(cls.buildCategoryTree(categories.ctree))
 
   @classmethod
-  def buildCategory(cls, category_data, parent_key):
-    """build a category and any children from the given data dict."""
-
+  def buildCategoryTree(cls, category_data, parent=None):
+    """Return a list of (unsaved) Category entities for the given category
+    data dict and all its descendants, with their ancestor paths."""
     if not category_data:
-      return
+      return []
     cname = category_data.get('name')
     if not cname:
-      logging.warn('no category name for %s', category)
-      return
-    if parent_key:
-      cat = cls(id=cname, parent_category=parent_key)
+      logging.warn('no category name for %s', category_data)
+      return []
+    if parent:
+      path = parent.path + [cname]
+      cat = cls(id=cname, parent_category=parent.key, path=path)
     else:
-      cat = cls(id=cname)
-    cat.put()
+      # the root is not part of the paths
+      cat = cls(id=cname, path=[])
+    cats = [cat]
+    for child in category_data.get('children') or []:
+      cats.extend(cls.buildCategoryTree(child, cat))
+    return cats
 
-    children = category_data.get('children')
-    # if there are any children, build them using their parent key
-    cls.buildChildCategories(children, cat.key)
+  @classmethod
+  def putCategories(cls, cats):
+    """Store the given categories in one batch, and invalidate the cached
+    category info once."""
+    cls._batch_write.active = True
+    try:
+      ndb.put_multi(cats)
+    finally:
+      cls._batch_write.active = False
+    cls.invalidateCategoryInfo()
+
+  def _post_put_hook(self, future):
+    if not getattr(self._batch_write, 'active', False):
+      self.invalidateCategoryInfo()
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    cls.invalidateCategoryInfo()
+
+  @classmethod
+  def getCategoryInfoVersion(cls):
+    """Return the current version of the cached category info.  The version is
+    initialized from the current time, so that it is not reused after memcache
+    loses it."""
+    version = memcache.get(cls._VERSION_KEY, namespace=cls._CACHE_NAMESPACE)
+    if version is None:
+      version = int(time.time() * 1000)
+      if not memcache.add(cls._VERSION_KEY, version,
+                          namespace=cls._CACHE_NAMESPACE):
+        version = memcache.get(
+            cls._VERSION_KEY, namespace=cls._CACHE_NAMESPACE) or version
+    return version
 
   @classmethod
-  def buildChildCategories(cls, children, parent_key):
-    """Given a list of category data structures and a parent key, build the
-    child categories, with the given key as their entity group parent."""
-    for cat in children:
-      cls.buildCategory(cat, parent_key)
+  def invalidateCategoryInfo(cls):
+    """Invalidate the cached category info, in memcache and in this instance's
+    snapshot.  Other instances see the change within their check interval."""
+    memcache.incr(cls._VERSION_KEY, namespace=cls._CACHE_NAMESPACE,
+                  initial_value=int(time.time() * 1000))
+    with cls._snapshot_lock:
+      cls._snapshot = None
 
   @classmethod
   def getCategoryInfo(cls):
     """Build and cache a list of category id/name correspondences.  This info is
     used to populate html select menus."""
-    if not cls._CATEGORY_INFO:
-      cls.buildAllCategories()  #first build categories from data file
-          # if required
-      cats = cls.query().fetch()
-      cls._CATEGORY_INFO = [(c.key.id(), c.key.id()) for c in cats
-            if c.key.id() != cls._ROOT]
-    return cls._CATEGORY_INFO
+    return cls.getCategoryInfoAsync().get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def getCategoryInfoAsync(cls):
+    """Async version of getCategoryInfo, so that the (uncached) category
+    query can run alongside other RPCs."""
+    data = yield cls._getCategoryDataAsync()
+    raise ndb.Return(data['info'])
+
+  @classmethod
+  def getCategoryPath(cls, category):
+    """Return the ancestor path of the named category (from the cached category
+    info).  An unknown category is its own path."""
+    data = cls._getCategoryDataAsync().get_result()
+    return data['paths'].get(category) or [category]
+
+  @classmethod
+  @ndb.tasklet
+  def _getCategoryDataAsync(cls):
+    """Return the cached dict of category 'info' (see getCategoryInfo) and
+    'paths' (category name -> path)."""
+    now = time.time()
+    with cls._snapshot_lock:
+      snapshot = cls._snapshot
+    if snapshot and now - snapshot[2] < config.CATEGORY_CACHE_CHECK_INTERVAL:
+      raise ndb.Return(snapshot[1])
+    # read the version before building the info, so that info built from
+    # data that is changed in the meantime is not cached as current.
+    version = cls.getCategoryInfoVersion()
+    if snapshot and snapshot[0] == version:
+      data = snapshot[1]
+    else:
+      cache_key = 'data:%s' % version
+      data = memcache.get(cache_key, namespace=cls._CACHE_NAMESPACE)
+      if data is None:
+        cls.buildAllCategories()  #first build categories from data file
+            # if required
+        cats = yield cls.query().fetch_async()
+        data = {
+            'info': [(c.key.id(), c.key.id()) for c in cats
+                     if c.key.id() != cls._ROOT],
+            'paths': dict((c.key.id(), c.path) for c in cats)}
+        memcache.set(cache_key, data, namespace=cls._CACHE_NAMESPACE)
+    with cls._snapshot_lock:
+      cls._snapshot = (version, data, now)
+    raise ndb.Return(data)
 
 class Product(ndb.Model):
   """Model for Product data. A Product entity will be built for each product,
@@ -120,39 +216,39 @@ class Product(ndb.Model):
   def pid(self):
     return self.key.id()
 
-  def reviews(self):
-    """Retrieve all the (active) associated reviews for this product, via the
-    reviews' product_key field."""
-    return Review.query(
-        Review.active == True,
-        Review.rating_added == True,
-        Review.product_key == self.key).fetch()
-
   @classmethod
   def updateProdDocsWithNewRating(cls, pkeys):
     """Given a list of product entity keys, check each entity to see if it is
     marked as needing a document re-index.  This flag is set when a new review
     is created for that product, and config.BATCH_RATINGS_UPDATE = True.
-    Generate the modified docs as needed and batch re-index them."""
-
-    doclist = []
+    Generate the modified docs as needed and batch re-index them.
+    The products and their docs are each fetched in batch."""
 
-    def _tx(pid):
-      prod = cls.get_by_id(pid)
-      if prod and prod.needs_review_reindex:
-
-        # update the associated document with the new ratings info
-        # and reindex
-        modified_doc = docs.Product.updateRatingInDoc(
-            prod.doc_id, prod.avg_rating)
-        if modified_doc:
-          doclist.append(modified_doc)
+    prods = [prod for prod in ndb.get_multi(pkeys)
+             if prod and prod.needs_review_reindex]
+    if not prods:
+      return
+    doc_ratings = dict((prod.doc_id, prod.avg_rating) for prod in prods)
+    # update the associated documents with the new ratings info
+    # and reindex all modified docs in batch
+    modified_docs = docs.Product.updateRatingsInDocs(doc_ratings)
+    if docs.Product.addMulti(modified_docs) is None:
+      return
+    cache.bumpGeneration()
+
+    # Clear the reindex flags, in concurrent transactions.  If a product's
+    # rating has changed again since we read it, leave its flag set so that
+    # it is picked up by the next batch update.
+    @ndb.transactional_tasklet
+    def _txClearFlag(pkey, indexed_rating):
+      prod = yield pkey.get_async()
+      if prod and prod.avg_rating == indexed_rating:
         prod.needs_review_reindex = False
-        prod.put()
-    for pkey in pkeys:
-      ndb.transaction(lambda: _tx(pkey.id()))
-    # reindex all modified docs in batch
-    docs.Product.add(doclist)
+        yield prod.put_async()
+
+    futures = [_txClearFlag(prod.key, prod.avg_rating) for prod in prods]
+    for f in futures:
+      f.get_result()
 
   @classmethod
   def create(cls, params, doc_id):
@@ -188,6 +284,47 @@ class Product(ndb.Model):
     docs.Product.updateRatingsInfo(doc_id, avg_rating)
 
 
+class RatingShard(ndb.Model):
+  """One shard of the review rating count and sum for a product, for the
+  reviews that have not yet been folded into the product's avg_rating and
+  num_reviews (see ratings.py).  Used when config.RATING_SHARDS > 0.  Each
+  shard is its own entity group, so that the review writes for a popular
+  product are spread over several entity groups, rather than all updating the
+  product entity."""
+
+  # the upper bound on the number of shards per product.  A product and all of
+  # its shards must fit in one XG transaction (at most 25 entity groups).
+  MAX_SHARDS = 20
+
+  product_key = ndb.KeyProperty(kind=Product)
+  num_reviews = ndb.IntegerProperty(default=0)
+  rating_sum = ndb.IntegerProperty(default=0)
+
+  @classmethod
+  def shardKey(cls, pid, index):
+    return ndb.Key(cls, '%s:%s' % (pid, index))
+
+  @classmethod
+  def allShardKeys(cls, pid):
+    """The keys of all the shards that the product with the given pid could
+    have, however many shards are currently configured."""
+    return [cls.shardKey(pid, i) for i in xrange(cls.MAX_SHARDS)]
+
+
+class RatingImportMark(ndb.Model):
+  """Records that the rating of an imported review has been added to the
+  parent product's avg_rating and num_reviews, so that importing the review
+  again (in a retried batch, or a later import of the same data) doesn't add
+  it twice.  Its id is the review's id.  The marks are deleted along with the
+  product's reviews (see Review.deleteReviews), and by a data reset."""
+
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def markKey(cls, product_key, review_id):
+    return ndb.Key(cls, review_id, parent=product_key)
+
+
 class Review(ndb.Model):
   """Model for Review data. Associated with a product entity via the product
   key."""
@@ -201,11 +338,219 @@ class Review(ndb.Model):
   comment = ndb.TextProperty()
   rating_added = ndb.BooleanProperty(default=False)
 
+  # the cached first pages of the products' reviews are stored by pid, as
+  # (version, page) pairs, where only pages of the current version are valid
+  # (see dropAllFirstPages).  pids are doc ids, so can't start with '!'.
+  _FIRST_PAGE_NAMESPACE = 'review_pages'
+  _FIRST_PAGE_VERSION_KEY = '!version'
+  # how many times refreshFirstPage tries to update a cached page that is
+  # being updated concurrently, before it drops the page instead
+  _REFRESH_TRIES = 3
+
   @classmethod
   def deleteReviews(cls, pid):
-    """Deletes the reviews associated with a product id."""
+    """Deletes the reviews associated with a product id, and the import marks
+    of their ratings."""
     if not pid:
       return
-    reviews = cls.query(
-        cls.product_key == ndb.Key(Product, pid)).fetch(keys_only=True)
-    return ndb.delete_multi(reviews)
+    pkey = ndb.Key(Product, pid)
+    reviews = cls.query(cls.product_key == pkey).fetch(keys_only=True)
+    marks = RatingImportMark.query(ancestor=pkey).fetch(keys_only=True)
+    res = ndb.delete_multi(reviews + marks)
+    # the query may still see the deleted reviews for a while, so cache the
+    # now empty first page rather than have it refilled from the query.
+    cls._setFirstPage(pid, ([], None))
+    return res
+
+  @classmethod
+  def _pageQuery(cls, pid):
+    return cls.query(
+        cls.active == True,
+        cls.rating_added == True,
+        cls.product_key == ndb.Key(Product, pid)).order(-cls.date_added)
+
+  @classmethod
+  def getPage(cls, pid, cursor=None):
+    """Return a page of the (active, rated) reviews of the product with the
+    given pid, newest first, as (reviews, next cursor), where the next cursor
+    is a web-safe string, or None if there are no more reviews.  cursor is an
+    ndb.Cursor, or None for the first page, which is served from memcache when
+    possible."""
+    return cls.getPageAsync(pid, cursor).get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def getPageAsync(cls, pid, cursor=None):
+    """Async version of getPage, so that the review page lookup can run
+    alongside other RPCs."""
+    ctx = ndb.get_context()
+    if not cursor:
+      # the two gets are batched into one memcache call
+      entry, version = yield (
+          ctx.memcache_get(pid, namespace=cls._FIRST_PAGE_NAMESPACE),
+          cls._getFirstPageVersionAsync())
+      if entry is not None and entry[0] == version:
+        raise ndb.Return(entry[1])
+    reviews, next_cursor, more = yield cls._pageQuery(pid).fetch_page_async(
+        config.REVIEWS_PAGE_SIZE, start_cursor=cursor)
+    page = (reviews, next_cursor.urlsafe() if more and next_cursor else None)
+    if not cursor:
+      # the query is only eventually consistent, so the page may be missing
+      # reviews added moments ago: cache it only briefly.  If there was no
+      # entry, add rather than set, so as not to replace a page that was
+      # cached by refreshFirstPage while the query ran.
+      cache_fn = ctx.memcache_add if entry is None else ctx.memcache_set
+      yield cache_fn(pid, (version, page), time=config.REVIEWS_MISS_CACHE_TTL,
+                     namespace=cls._FIRST_PAGE_NAMESPACE)
+    raise ndb.Return(page)
+
+  @classmethod
+  def refreshFirstPage(cls, pid, new_reviews):
+    """Update the cached first page of the given product's reviews to include
+    the given newly rated reviews.  The reviews query is only eventually
+    consistent, so it may miss them, and other reviews added moments ago; the
+    reviews it misses are merged into the page in date order, along with
+    those already in the cached page.  The page is updated with
+    compare-and-set, so that the reviews merged into it by concurrent
+    refreshes are not lost.  If a merged review would fall beyond the first
+    page, or the page keeps changing under us, the cached page is dropped
+    instead (a merged review beyond the page could not be reached from the
+    page's cursor)."""
+    page_size = config.REVIEWS_PAGE_SIZE
+    it = cls._pageQuery(pid).iter(limit=page_size + 1, produce_cursors=True)
+    # (review, the cursor to start a page at it) for the query results
+    query_rows = [(review, it.cursor_before()) for review in it]
+    client = memcache.Client()
+    for _ in xrange(cls._REFRESH_TRIES):
+      entry = client.gets(pid, namespace=cls._FIRST_PAGE_NAMESPACE)
+      version = cls._getFirstPageVersionAsync().get_result()
+      cached = []
+      if entry is not None and entry[0] == version:
+        cached = entry[1][0]
+      rows = list(query_rows)
+      keys = set(review.key for review, _ in rows)
+      for review in list(new_reviews) + cached:
+        if review.key not in keys:
+          keys.add(review.key)
+          rows.append((review, None))
+      rows.sort(key=lambda row: row[0].date_added, reverse=True)
+      rest = rows[page_size:]
+      if any(cursor is None for _, cursor in rest):
+        break
+      page = ([review for review, _ in rows[:page_size]],
+              rest[0][1].urlsafe() if rest else None)
+      if entry is None:
+        # without a cached page to build on, the page may be missing reviews
+        # that the query doesn't see yet: cache it only briefly, as for a miss.
+        stored = client.add(pid, (version, page),
+                            time=config.REVIEWS_MISS_CACHE_TTL,
+                            namespace=cls._FIRST_PAGE_NAMESPACE)
+      else:
+        stored = client.cas(pid, (version, page),
+                            time=config.REVIEWS_CACHE_TTL,
+                            namespace=cls._FIRST_PAGE_NAMESPACE)
+      if stored:
+        return
+    cls.invalidateFirstPage(pid)
+
+  @classmethod
+  def invalidateFirstPage(cls, pid):
+    """Drop the cached first page of the given product's reviews."""
+    memcache.delete(pid, namespace=cls._FIRST_PAGE_NAMESPACE)
+
+  @classmethod
+  def dropAllFirstPages(cls):
+    """Invalidate the cached first pages of all the products' reviews, by
+    starting a new version of them."""
+    memcache.incr(cls._FIRST_PAGE_VERSION_KEY,
+                  namespace=cls._FIRST_PAGE_NAMESPACE,
+                  initial_value=int(time.time() * 1000))
+
+  @classmethod
+  def _setFirstPage(cls, pid, page):
+    version = cls._getFirstPageVersionAsync().get_result()
+    memcache.set(pid, (version, page), time=config.REVIEWS_CACHE_TTL,
+                 namespace=cls._FIRST_PAGE_NAMESPACE)
+
+  @classmethod
+  @ndb.tasklet
+  def _getFirstPageVersionAsync(cls):
+    """Return the current version of the cached first pages.  If it is not
+    in memcache (e.g., it was evicted), a new one is started, based on the
+    current time so that it does not match the version of any cached page."""
+    ctx = ndb.get_context()
+    version = yield ctx.memcache_get(cls._FIRST_PAGE_VERSION_KEY,
+                                     namespace=cls._FIRST_PAGE_NAMESPACE)
+    if version is None:
+      version = int(time.time() * 1000)
+      added = yield ctx.memcache_add(cls._FIRST_PAGE_VERSION_KEY, version,
+                                     namespace=cls._FIRST_PAGE_NAMESPACE)
+      if not added:
+        # another request started it first
+        version = yield ctx.memcache_get(cls._FIRST_PAGE_VERSION_KEY,
+                                         namespace=cls._FIRST_PAGE_NAMESPACE)
+    raise ndb.Return(version)
+
+
+class ImportJob(ndb.Model):
+  """Tracks the progress of a product or review data import from a file,
+  which may be run as a chain of tasks.  next_row is checkpointed as batches
+  of rows are completed, so that an interrupted import resumes from there
+  rather than from the start of the file."""
+
+  # import kinds
+  PRODUCTS = 'products'
+  REVIEWS = 'reviews'
+
+  kind = ndb.StringProperty(default=PRODUCTS)
+  datafile = ndb.StringProperty()
+  fieldnames = ndb.StringProperty(repeated=True)
+  # the number of the next (0-based) data row to import
+  next_row = ndb.IntegerProperty(default=0)
+  # the total time spent importing, over all tasks
+  elapsed_secs = ndb.FloatProperty(default=0)
+  done = ndb.BooleanProperty(default=False)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  @property
+  def rows_per_sec(self):
+    if not self.elapsed_secs:
+      return 0
+    return self.next_row / self.elapsed_secs
+
+
+class ResetJob(ndb.Model):
+  """Tracks the progress of a reset of the app's data (see reset.py), whose
+  deletions run in parallel, as one chain of tasks per shard.  Each shard's
+  progress is recorded in its own ResetShard entity, so that the shards don't
+  contend; the job entity is only written when a shard finishes."""
+
+  num_shards = ndb.IntegerProperty(default=0)
+  shards_done = ndb.IntegerProperty(default=0)
+  # (function, args) to run in a deferred task once all the shards are done
+  on_done = ndb.PickleProperty()
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  finished = ndb.DateTimeProperty()
+
+  @property
+  def done(self):
+    return self.shards_done >= self.num_shards
+
+  def shardKeys(self):
+    return [ResetShard.shardKey(self.key.id(), n)
+            for n in xrange(self.num_shards)]
+
+
+class ResetShard(ndb.Model):
+  """The progress of one shard of a ResetJob: the deletion of a range of the
+  entities of a kind, or of the documents of an index."""
+
+  description = ndb.StringProperty(indexed=False)
+  deleted = ndb.IntegerProperty(default=0, indexed=False)
+  # where to continue from: a web-safe query cursor, or a doc id
+  position = ndb.StringProperty(indexed=False)
+  done = ndb.BooleanProperty(default=False, indexed=False)
+
+  @classmethod
+  def shardKey(cls, job_id, shard_num):
+    return ndb.Key(cls, '%s:%s' % (job_id, shard_num))
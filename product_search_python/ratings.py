@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Sharded aggregation of review ratings, used when config.RATING_SHARDS > 0.
+Each new review's rating is added to a randomly chosen RatingShard of its
+product, rather than to the product entity, so that the write throughput for
+one product scales with the number of shards.  The shards are periodically
+folded into the product's num_reviews and avg_rating (after which the
+product's document is reindexed with the new 'ar' value), by the coalesced
+reindex flush (see reindex.py), and by a cron sweep that catches any shards
+that were missed.
+"""
+
+import logging
+import random
+
+import config
+import models
+import reindex
+import utils
+
+from google.appengine.ext import ndb
+
+
+def getNumShards():
+  return utils.intClamp(config.RATING_SHARDS, 1, models.RatingShard.MAX_SHARDS)
+
+
+def addShardedRating(review_key):
+  """Add the rating of the given review to a random shard of its product's
+  rating counts, and flag the review as processed, in one XG transaction.
+  Then record the product as needing its shards folded in and its document
+  reindexed."""
+
+  def _tx():
+    review = review_key.get()
+    if review.rating_added:
+      return None
+    pid = review.product_key.id()
+    shard_key = models.RatingShard.shardKey(
+        pid, random.randint(0, getNumShards() - 1))
+    shard = shard_key.get()
+    if not shard:
+      shard = models.RatingShard(key=shard_key, product_key=review.product_key)
+    shard.num_reviews += 1
+    shard.rating_sum += review.rating
+    review.rating_added = True
+    ndb.put_multi([shard, review])
+    return review
+
+  try:
+    review = ndb.transaction(_tx, xg=True)
+  except AttributeError:
+    # swallow this error and log it; it's not recoverable.
+    logging.exception('The function addShardedRating failed. The review '
+                      'entity does not exist.')
+    return
+  if review:
+    pid = review.product_key.id()
+    # the review now belongs in the product's listing
+    models.Review.refreshFirstPage(pid, [review])
+    reindex.markDirty(pid)
+
+
+@ndb.transactional(xg=True)
+def _foldShards(pid):
+  """Fold the rating counts of the given product's shards into the product
+  entity, reset the shards, and flag the product for a document reindex.
+  Returns True if there was anything to fold."""
+  entities = ndb.get_multi(
+      [ndb.Key(models.Product, pid)] + models.RatingShard.allShardKeys(pid))
+  product = entities[0]
+  shards = [shard for shard in entities[1:] if shard and shard.num_reviews]
+  if not product or not shards:
+    return False
+  num_new = sum(shard.num_reviews for shard in shards)
+  new_sum = sum(shard.rating_sum for shard in shards)
+  num_reviews = product.num_reviews + num_new
+  product.avg_rating = ((product.avg_rating * product.num_reviews + new_sum) /
+                        float(num_reviews))
+  product.num_reviews = num_reviews
+  # signal that we need to reindex the doc with the new ratings info.
+  product.needs_review_reindex = True
+  for shard in shards:
+    shard.num_reviews = 0
+    shard.rating_sum = 0
+  ndb.put_multi([product] + shards)
+  return True
+
+
+def compactShards(pids):
+  """Fold the rating shards of the products with the given pids into their
+  product entities.  Returns the number of products updated."""
+  return len([pid for pid in pids if _foldShards(pid)])
+
+
+def compactAllShards():
+  """Fold all the rating shards that hold unfolded ratings into their product
+  entities, and reindex the products' documents.  Run periodically, to catch
+  products whose reindex could not be queued."""
+  shard_keys = models.RatingShard.query(
+      models.RatingShard.num_reviews > 0).fetch(keys_only=True)
+  pids = set(key.id().rsplit(':', 1)[0] for key in shard_keys)
+  if not pids:
+    return 0
+  compactShards(pids)
+  models.Product.updateProdDocsWithNewRating(
+      [ndb.Key(models.Product, pid) for pid in pids])
+  return len(pids)
+
+
+def _combineRating(product, shards):
+  """Return the (average rating, number of reviews) of the given product,
+  including the ratings in the given shards."""
+  num_reviews = product.num_reviews
+  rating_sum = product.avg_rating * product.num_reviews
+  for shard in shards:
+    if shard:
+      num_reviews += shard.num_reviews
+      rating_sum += shard.rating_sum
+  if not num_reviews:
+    return (0, 0)
+  return (rating_sum / float(num_reviews), num_reviews)
+
+
+def getCurrentRating(product):
+  """Return the (average rating, number of reviews) of the given product,
+  including the ratings in its shards that have not been folded in yet."""
+  shards = []
+  if config.RATING_SHARDS:
+    shards = ndb.get_multi(models.RatingShard.allShardKeys(product.pid))
+  return _combineRating(product, shards)
+
+
+@ndb.tasklet
+def getCurrentRatingAsync(pid):
+  """Async version of getCurrentRating, which fetches the product with the
+  given pid and its shards in one batch.  Returns None if there is no such
+  product."""
+  keys = [ndb.Key(models.Product, pid)]
+  if config.RATING_SHARDS:
+    keys.extend(models.RatingShard.allShardKeys(pid))
+  entities = yield ndb.get_multi_async(keys)
+  if not entities[0]:
+    raise ndb.Return(None)
+  raise ndb.Return(_combineRating(entities[0], entities[1:]))
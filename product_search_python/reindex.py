@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Write-behind coalescing of the product document reindexes triggered by
+new reviews.  Instead of reindexing a product's document once per review,
+markDirty records the product in a pull queue, using a task name that is
+unique to the product and the current coalescing window
+(config.REINDEX_COALESCE_WINDOW seconds), so that the queue holds at most one
+task per product per window.  The tasks become available at the end of their
+window, when flushDirty (run by cron) leases them and reindexes each product's
+document once, with its latest average rating, in batch.  (If ratings are
+sharded, the product's rating shards are folded in first; see ratings.py.)
+
+In batch mode (config.BATCH_RATINGS_UPDATE), each new review instead appends
+its product to the dirty log: a second pull queue, to which the task is added
+in the review's rating transaction.  The batch ratings update (run by cron)
+leases the log in chunks and reindexes the logged products' documents in
+batch, so its cost is proportional to the number of products that changed,
+rather than to the size of the catalog.  The dirty log is also the fallback
+for a product whose coalesced reindex can't be queued: with coalescing, each
+review's rating transaction adds its product to the log too.  (The batch
+update only reindexes the products still flagged with needs_review_reindex,
+so the products whose coalesced reindex has already run cost it a get.)
+
+sweepFlagged reindexes every product flagged with needs_review_reindex, for
+the products that were flagged before the dirty log existed.
+"""
+
+import hashlib
+import logging
+import time
+
+import config
+import models
+import ratings
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+QUEUE_NAME = 'reindex'
+# the append-only log of products with rating changes, for batch mode
+DIRTY_LOG_QUEUE_NAME = 'dirty_ratings'
+_STATS_NAMESPACE = 'reindex_stats'
+_LEASE_SECONDS = 60
+# the maximum number of tasks that can be leased at once
+_MAX_LEASE_TASKS = 1000
+
+
+def _incrStat(name, delta=1):
+  memcache.incr(name, delta=delta, namespace=_STATS_NAMESPACE, initial_value=0)
+
+
+def _taskName(pid, window_start):
+  """Task names may only contain [a-zA-Z0-9_-], so use a hash of the pid."""
+  return 'reindex-%s-%d' % (
+      hashlib.md5(pid.encode('utf-8')).hexdigest(), window_start)
+
+
+def markDirty(pid):
+  """Record that the document of the product with the given pid needs to be
+  reindexed with the product's latest average rating.  Returns True if a new
+  reindex task was queued, and False if the reindex was coalesced into one
+  that is already pending for the current window (or could not be queued)."""
+  window = max(int(config.REINDEX_COALESCE_WINDOW), 1)
+  now = time.time()
+  window_start = int(now // window) * window
+  task = taskqueue.Task(
+      name=_taskName(pid, window_start), method='PULL',
+      payload=pid.encode('utf-8'),
+      # make the task available at the end of its window
+      countdown=max(window_start + window - now, 0))
+  try:
+    taskqueue.Queue(QUEUE_NAME).add(task)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    _incrStat('coalesced')
+    return False
+  except taskqueue.Error:
+    logging.exception('Could not queue the reindex of product %s; logging it '
+                      'for the batch ratings update instead.', pid)
+    try:
+      logDirty(pid)
+    except taskqueue.Error:
+      logging.exception('Could not log product %s as dirty.', pid)
+    return False
+  _incrStat('queued')
+  return True
+
+
+def logDirty(pid, transactional=False):
+  """Append the product with the given pid to the dirty log, so that the next
+  batch ratings update reindexes its document.  Pass transactional=True to
+  add the log entry as part of the current datastore transaction."""
+  task = taskqueue.Task(method='PULL', payload=pid.encode('utf-8'))
+  taskqueue.Queue(DIRTY_LOG_QUEUE_NAME).add(task, transactional=transactional)
+
+
+def _drainQueue(queue_name):
+  """Lease the available tasks of the given pull queue in chunks, and
+  reindex the documents of the products named by each chunk in batch.
+  Returns the number of products reindexed."""
+  queue = taskqueue.Queue(queue_name)
+  total = 0
+  while True:
+    tasks = queue.lease_tasks(_LEASE_SECONDS, _MAX_LEASE_TASKS)
+    if not tasks:
+      break
+    pids = set(task.payload.decode('utf-8') for task in tasks)
+    if config.RATING_SHARDS:
+      # first fold any sharded ratings into the product entities
+      ratings.compactShards(pids)
+    models.Product.updateProdDocsWithNewRating(
+        [ndb.Key(models.Product, pid) for pid in pids])
+    queue.delete_tasks(tasks)
+    _incrStat('reindexed', len(pids))
+    total += len(pids)
+    if len(tasks) < _MAX_LEASE_TASKS:
+      break
+  return total
+
+
+def flushDirty():
+  """Lease the reindex tasks whose windows have ended, and reindex the
+  documents of their products in batch.  Returns the number of products
+  reindexed."""
+  total = _drainQueue(QUEUE_NAME)
+  if total:
+    logging.info('reindexed %s products with updated ratings', total)
+  return total
+
+
+def flushDirtyLog():
+  """Lease the dirty log, and reindex the documents of the logged products
+  in batch (each product once per chunk, however many times it was logged).
+  Returns the number of products reindexed."""
+  total = _drainQueue(DIRTY_LOG_QUEUE_NAME)
+  if total:
+    logging.info('reindexed %s products from the dirty log', total)
+  return total
+
+
+def sweepFlagged(cursor=None):
+  """Reindex the documents of all the products flagged with
+  needs_review_reindex, a page at a time, as a chain of deferred tasks
+  starting from the given (web-safe) query cursor.  This is a one-off, for
+  products flagged before their reindexes were logged in the dirty log, which
+  nothing else would reindex."""
+  query = models.Product.query(models.Product.needs_review_reindex == True)
+  keys, next_cursor, more = query.fetch_page(
+      _MAX_LEASE_TASKS, keys_only=True,
+      start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+  if config.RATING_SHARDS:
+    ratings.compactShards([key.id() for key in keys])
+  models.Product.updateProdDocsWithNewRating(keys)
+  _incrStat('reindexed', len(keys))
+  logging.info('swept %s flagged products', len(keys))
+  if more and next_cursor:
+    defer(sweepFlagged, next_cursor.urlsafe())
+
+
+def getStats():
+  """Return a dict of reindex counts: 'queued' reindex tasks, reviews whose
+  reindex was 'coalesced' into an already-queued task (i.e., the reindexes
+  saved), and products 'reindexed'."""
+  names = ['queued', 'coalesced', 'reindexed']
+  counts = memcache.get_multi(names, namespace=_STATS_NAMESPACE)
+  return dict((name, counts.get(name, 0)) for name in names)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Resets the app's data: deletes all the entities of the RESET_KINDS
+(products, reviews, and their rating shards, import marks and import jobs),
+and all the documents of the product index, with bounded memory per task.  The
+deletion is split into shards: ranges of each kind's keys, and of the index's
+doc ids, whose split points are picked from a sample of keys taken with the
+datastore's __scatter__ property.  (The product doc ids are the product ids,
+so the product index is split at the same points as the Product keys.)  Each
+shard runs as its own chain of deferred tasks, in parallel with the others.
+A shard pages through its range with the maximum page size, and deletes each
+page asynchronously while the next one is fetched.
+
+The progress of a reset is recorded in a ResetJob entity, and each shard's in
+its own ResetShard entity, where it is checkpointed after every page, so that
+a retried shard task resumes where it left off.  See getProgress.  A function
+can be given to run once all the shards are done.
+"""
+
+import datetime
+import logging
+import time
+
+import cache
+import config
+import docs
+import models
+import utils
+
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+# the kinds whose entities are deleted by a reset.  The rating shards and
+# import marks are keyed by pid, so they would otherwise be counted into the
+# ratings of reloaded products with the same pids.
+RESET_KINDS = [models.Review, models.Product, models.RatingShard,
+               models.RatingImportMark, models.ImportJob]
+
+# the maximum number of documents that can be fetched in one get_range call,
+# and deleted in one delete call
+_MAX_GET_RANGE = 1000
+_MAX_DELETE_DOCS = 200
+# the number of entity keys fetched, and deleted, at a time
+_KEY_BATCH_SIZE = 500
+# the number of keys sampled per shard when picking the split points
+_OVERSAMPLE = 32
+
+
+def _splitKeys(model_class, num_shards):
+  """Return up to num_shards - 1 sorted keys that split the keys of the given
+  model class into ranges of similar size.  They are picked from a sample of
+  keys ordered by the __scatter__ property, which the datastore sets on a
+  random subset of entities.  If there are too few entities to be sampled,
+  there are no split points, and the kind is deleted by a single shard."""
+  if num_shards < 2:
+    return []
+  sample = model_class.query().order(
+      ndb.GenericProperty('__scatter__')).fetch(
+          num_shards * _OVERSAMPLE, keys_only=True)
+  sample.sort(key=lambda key: key.pairs())
+  if len(sample) > num_shards:
+    step = len(sample) / float(num_shards)
+    sample = [sample[int(step * i)] for i in xrange(1, num_shards)]
+  splits = []
+  for key in sample:
+    if not splits or splits[-1] != key:
+      splits.append(key)
+  return splits
+
+
+def _ranges(splits):
+  """Return the [start, end) ranges between the given split points, where a
+  start or end of None is unbounded."""
+  bounds = [None] + list(splits) + [None]
+  return zip(bounds[:-1], bounds[1:])
+
+
+def _deleteKeyRange(model_class, start, end, position):
+  """Delete the entities of the given model class whose keys are in the range
+  [start, end), starting from the given (web-safe) query cursor position.
+  Yields (number deleted, next position) after each page; the next position
+  is None after the last page."""
+  query = model_class.query()
+  if start is not None:
+    query = query.filter(model_class.key >= start)
+  if end is not None:
+    query = query.filter(model_class.key < end)
+  cursor = ndb.Cursor(urlsafe=position) if position else None
+  page = query.fetch_page_async(
+      _KEY_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+  while True:
+    keys, cursor, more = page.get_result()
+    deletes = ndb.delete_multi_async(keys)
+    more = more and cursor is not None
+    if more:
+      page = query.fetch_page_async(
+          _KEY_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    for f in deletes:
+      f.get_result()
+    yield len(keys), cursor.urlsafe() if more else None
+    if not more:
+      return
+
+
+def _deleteDocRange(doc_class, start, end, position):
+  """Delete the documents of the given document class's index whose ids are
+  in the range [start, end), starting after the doc id given as the position.
+  Yields (number deleted, next position) after each page; the next position
+  is None after the last page."""
+  index = doc_class.getIndex()
+
+  def _getIds(start_id, include_start):
+    return index.get_range_async(
+        start_id=start_id, include_start_object=include_start,
+        limit=_MAX_GET_RANGE, ids_only=True)
+
+  rpc = _getIds(position or start, not position)
+  while True:
+    ids = [doc.doc_id for doc in rpc.get_result()]
+    finished = len(ids) < _MAX_GET_RANGE
+    if end is not None and ids and ids[-1] >= end:
+      ids = [doc_id for doc_id in ids if doc_id < end]
+      finished = True
+    if not finished:
+      rpc = _getIds(ids[-1], False)
+    deletes = [index.delete_async(ids[i:i + _MAX_DELETE_DOCS])
+               for i in xrange(0, len(ids), _MAX_DELETE_DOCS)]
+    for rpc_delete in deletes:
+      rpc_delete.get_result()
+    yield len(ids), None if finished else ids[-1]
+    if finished:
+      return
+
+
+def startReset(on_done=None, num_shards=None):
+  """Start a reset of the app's data, as one chain of deferred tasks per
+  shard, into which each of the reset kinds and the product index are split
+  num_shards ways (by default, config.RESET_SHARDS).  on_done, if given, is a
+  (function, args) pair to run in a deferred task once all the shards are
+  done.  Returns the ResetJob entity."""
+  num_shards = utils.intClamp(num_shards or config.RESET_SHARDS, 1, 100)
+  # (description, delete function, args) for each shard
+  shards = []
+  product_splits = []
+  for model_class in RESET_KINDS:
+    splits = _splitKeys(model_class, num_shards)
+    if model_class is models.Product:
+      product_splits = splits
+    for start, end in _ranges(splits):
+      shards.append(('%s keys [%s, %s)' % (model_class._get_kind(), start, end),
+                     _deleteKeyRange, (model_class, start, end)))
+  doc_splits = [key.id() for key in product_splits
+                if isinstance(key.id(), basestring)]
+  for start, end in _ranges(doc_splits):
+    shards.append(('%s docs [%s, %s)' % (docs.Product._INDEX_NAME, start, end),
+                   _deleteDocRange, (docs.Product, start, end)))
+
+  job = models.ResetJob(num_shards=len(shards), on_done=on_done)
+  job.put()
+  job_id = job.key.id()
+  ndb.put_multi([
+      models.ResetShard(key=models.ResetShard.shardKey(job_id, n),
+                        description=description)
+      for n, (description, _, _) in enumerate(shards)])
+  for n, (_, delete_fn, args) in enumerate(shards):
+    defer(_runShard, job_id, n, delete_fn, args)
+  logging.info('reset %s: started %s shards', job_id, len(shards))
+  return job
+
+
+def _runShard(job_id, shard_num, delete_fn, args):
+  """Run (or continue) a shard of a reset, from its checkpointed position.
+  If the task runs for longer than config.RESET_TASK_TIME_LIMIT seconds, it
+  chains a new task to continue the shard."""
+  shard = models.ResetShard.shardKey(job_id, shard_num).get()
+  if not shard or shard.done:
+    return
+  task_start = time.time()
+  for deleted, position in delete_fn(*args, position=shard.position):
+    shard.deleted += deleted
+    shard.position = position
+    shard.put()
+    if position and time.time() - task_start > config.RESET_TASK_TIME_LIMIT:
+      defer(_runShard, job_id, shard_num, delete_fn, args)
+      return
+  _finishShard(job_id, shard_num)
+
+
+@ndb.transactional(xg=True, retries=10)
+def _finishShard(job_id, shard_num):
+  """Mark the shard done, and if it was the last one, finish the job."""
+  job, shard = ndb.get_multi([ndb.Key(models.ResetJob, job_id),
+                              models.ResetShard.shardKey(job_id, shard_num)])
+  if not job or shard.done:
+    return
+  shard.done = True
+  job.shards_done += 1
+  if job.done:
+    job.finished = datetime.datetime.now()
+    defer(_finishJob, job_id, _transactional=True)
+  ndb.put_multi([job, shard])
+
+
+def _finishJob(job_id):
+  job = models.ResetJob.get_by_id(job_id)
+  # the cached search results and review pages are now stale
+  cache.bumpGeneration()
+  models.Review.dropAllFirstPages()
+  logging.info('reset %s: done in %s', job_id, job.finished - job.created)
+  if job.on_done:
+    function, args = job.on_done
+    function(*args)
+
+
+def getProgress(job_id=None):
+  """Return the progress of the reset job with the given id (by default, the
+  most recent one) as a dict, or None if there is no such job."""
+  if job_id:
+    job = models.ResetJob.get_by_id(job_id)
+  else:
+    job = models.ResetJob.query().order(-models.ResetJob.created).get()
+  if not job:
+    return None
+  shards = [shard for shard in ndb.get_multi(job.shardKeys()) if shard]
+  return {'job_id': job.key.id(), 'created': job.created,
+          'finished': job.finished, 'num_shards': job.num_shards,
+          'shards_done': job.shards_done,
+          'deleted': sum(shard.deleted for shard in shards)}
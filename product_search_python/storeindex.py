@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains StoreIndex, an in-memory spatial index of the store locations,
+which answers nearest-store and radius queries without a search RPC.  Each
+instance builds the index from the documents of the store search index, and
+keeps it until the store data changes: changes to the stores bump a version
+number in memcache (see invalidate), which an instance checks at most every
+config.STORE_INDEX_CHECK_INTERVAL seconds.
+
+The stores are kept in a k-d tree over their locations as points on the unit
+sphere.  The straight-line (chord) distance between two such points increases
+with their great-circle distance, so the nearest points by chord distance are
+the nearest stores, with no special cases at the poles or the date line.
+
+For batches of locations (nearestMany), the store coordinates are also kept
+as contiguous arrays, and the haversine distances from all the locations to
+all the stores are computed in one vectorized pass with NumPy.  If NumPy is
+not available, a plain Python loop over the arrays is used instead.
+"""
+
+import array
+import collections
+import heapq
+import logging
+import math
+import threading
+import time
+
+import config
+import docs
+
+from google.appengine.api import memcache
+from google.appengine.api import search
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# the mean radius of the earth, in meters
+EARTH_RADIUS = 6371010.0
+
+# the maximum number of documents that can be fetched in one get_range call
+_PAGE_SIZE = 1000
+# the maximum number of location-to-store distances held in one array while
+# computing a batch, which bounds its memory use
+_MAX_BATCH_DISTANCES = 1000000
+
+_CACHE_NAMESPACE = 'store_index'
+_VERSION_KEY = 'version'
+
+StoreInfo = collections.namedtuple(
+    'StoreInfo', ['store_id', 'name', 'address', 'lat', 'lon'])
+
+
+def toUnitVector(lat, lon):
+  """Return the point on the unit sphere at the given latitude and longitude,
+  in degrees, as an (x, y, z) tuple."""
+  lat = math.radians(lat)
+  lon = math.radians(lon)
+  return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon),
+          math.sin(lat))
+
+
+def chordToMeters(chord):
+  """Convert a chord length on the unit sphere to a distance in meters."""
+  return 2 * EARTH_RADIUS * math.asin(min(chord / 2.0, 1.0))
+
+
+def metersToChord(meters):
+  """Convert a distance in meters to a chord length on the unit sphere."""
+  return 2 * math.sin(min(meters / (2 * EARTH_RADIUS), math.pi / 2))
+
+
+class StoreIndex(object):
+  """An immutable k-d tree of stores, for nearest-store and radius queries.
+  Queries take time roughly logarithmic in the number of stores."""
+
+  def __init__(self, stores):
+    """stores is a list of StoreInfo tuples."""
+    self.stores = list(stores)
+    self._points = [toUnitVector(s.lat, s.lon) for s in self.stores]
+    self._root = self._build(range(len(self.stores)), 0)
+    # the store coordinates in radians, for batch distance computations
+    lats = [math.radians(s.lat) for s in self.stores]
+    lons = [math.radians(s.lon) for s in self.stores]
+    if numpy:
+      self._lats = numpy.array(lats, dtype=numpy.float64)
+      self._lons = numpy.array(lons, dtype=numpy.float64)
+      self._cos_lats = numpy.cos(self._lats)
+    else:
+      self._lats = array.array('d', lats)
+      self._lons = array.array('d', lons)
+      self._cos_lats = array.array('d', [math.cos(lat) for lat in lats])
+
+  def __len__(self):
+    return len(self.stores)
+
+  def _build(self, indexes, depth):
+    """Build the subtree of the given store indexes, splitting on the median
+    of one coordinate per level.  A node is (axis, store index, left subtree,
+    right subtree)."""
+    if not indexes:
+      return None
+    axis = depth % 3
+    indexes = sorted(indexes, key=lambda i: self._points[i][axis])
+    mid = len(indexes) // 2
+    return (axis, indexes[mid], self._build(indexes[:mid], depth + 1),
+            self._build(indexes[mid + 1:], depth + 1))
+
+  def nearest(self, lat, lon, limit, offset=0, max_distance=None):
+    """Return up to limit stores nearest to the given location, skipping the
+    first offset of them, as a list of (distance in meters, StoreInfo) pairs,
+    nearest first.  If max_distance (in meters) is given, only stores within
+    that distance are returned."""
+    k = offset + limit
+    if k <= 0 or not self.stores:
+      return []
+    query = toUnitVector(lat, lon)
+    if max_distance is None:
+      bound = float('inf')
+    else:
+      bound = metersToChord(max_distance) ** 2
+    # a max-heap of the k nearest so far, as (-squared chord, -index) pairs
+    heap = []
+    self._search(self._root, query, k, heap, bound)
+    found = sorted((-d2, -i) for d2, i in heap)
+    return [(chordToMeters(math.sqrt(d2)), self.stores[i])
+            for d2, i in found[offset:]]
+
+  def withinRadius(self, lat, lon, radius, limit, offset=0):
+    """Return up to limit of the stores within radius meters of the given
+    location, nearest first, skipping the first offset of them."""
+    return self.nearest(lat, lon, limit, offset, max_distance=radius)
+
+  def nearestMany(self, origins, k, max_distance=None):
+    """Return the (up to) k nearest stores to each of the given (lat, lon)
+    origins, as a list with an entry for each origin of the form returned by
+    nearest.  If max_distance (in meters) is given, only stores within that
+    distance are returned."""
+    if not origins or not self.stores or k <= 0:
+      return [[] for _ in origins]
+    if numpy:
+      nearest = self._nearestManyNumpy(origins, k)
+    else:
+      nearest = [self._nearestOne(lat, lon, k) for lat, lon in origins]
+    return [[(dist, self.stores[i]) for dist, i in found
+             if max_distance is None or dist <= max_distance]
+            for found in nearest]
+
+  def _nearestManyNumpy(self, origins, k):
+    """Compute the haversine distances from blocks of origins to all the
+    stores as matrices, and pick the k smallest in each row."""
+    nstores = len(self.stores)
+    k = min(k, nstores)
+    block = max(_MAX_BATCH_DISTANCES // nstores, 1)
+    points = numpy.radians(numpy.array(origins, dtype=numpy.float64))
+    nearest = []
+    for start in xrange(0, len(points), block):
+      lats = points[start:start + block, 0:1]
+      lons = points[start:start + block, 1:2]
+      a = (numpy.sin((self._lats - lats) / 2) ** 2 +
+           numpy.cos(lats) * self._cos_lats *
+           numpy.sin((self._lons - lons) / 2) ** 2)
+      dists = 2 * EARTH_RADIUS * numpy.arcsin(
+          numpy.sqrt(numpy.clip(a, 0, 1)))
+      if k < nstores and hasattr(numpy, 'argpartition'):
+        candidates = numpy.argpartition(dists, k - 1, axis=1)[:, :k]
+      else:
+        candidates = numpy.argsort(dists, axis=1)[:, :k]
+      for row, idxs in enumerate(candidates):
+        row_dists = dists[row]
+        nearest.append(sorted(
+            (float(row_dists[i]), int(i)) for i in idxs))
+    return nearest
+
+  def _nearestOne(self, lat, lon, k):
+    """The k nearest stores to one origin, by a scan of the coordinate
+    arrays."""
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    cos_lat = math.cos(lat)
+    sin = math.sin
+    dists = [
+        2 * EARTH_RADIUS * math.asin(min(math.sqrt(
+            sin((slat - lat) / 2) ** 2 +
+            cos_lat * scos * sin((slon - lon) / 2) ** 2), 1.0))
+        for slat, slon, scos in zip(self._lats, self._lons, self._cos_lats)]
+    return [(dists[i], i)
+            for i in heapq.nsmallest(k, xrange(len(dists)),
+                                     key=dists.__getitem__)]
+
+  def _search(self, node, query, k, heap, bound):
+    if node is None:
+      return
+    axis, i, left, right = node
+    point = self._points[i]
+    d2 = ((query[0] - point[0]) ** 2 + (query[1] - point[1]) ** 2 +
+          (query[2] - point[2]) ** 2)
+    if d2 <= bound:
+      if len(heap) < k:
+        heapq.heappush(heap, (-d2, -i))
+      elif (-d2, -i) > heap[0]:
+        heapq.heapreplace(heap, (-d2, -i))
+    diff = query[axis] - point[axis]
+    near, far = (left, right) if diff < 0 else (right, left)
+    self._search(near, query, k, heap, bound)
+    # the far side can only hold closer stores if the splitting plane is
+    # closer than the current kth nearest store
+    worst = -heap[0][0] if len(heap) == k else bound
+    if diff * diff <= worst:
+      self._search(far, query, k, heap, bound)
+
+
+def storeInfoFromDoc(doc):
+  """Return the StoreInfo of the given store search.Document."""
+  sdoc = docs.Store(doc)
+  geopoint = sdoc.getFieldVal(docs.Store.STORE_LOCATION)
+  return StoreInfo(doc.doc_id, sdoc.getFieldVal(docs.Store.STORE_NAME),
+                   sdoc.getFieldVal(docs.Store.STORE_ADDRESS),
+                   geopoint.latitude, geopoint.longitude)
+
+
+def buildStoreDoc(store):
+  """Return the store search.Document for the given StoreInfo."""
+  geopoint = search.GeoPoint(store.lat, store.lon)
+  fields = [search.TextField(name=docs.Store.STORE_NAME, value=store.name),
+            search.TextField(name=docs.Store.STORE_ADDRESS,
+                             value=store.address),
+            search.GeoField(name=docs.Store.STORE_LOCATION, value=geopoint)]
+  return search.Document(doc_id=store.store_id, fields=fields)
+
+
+def geoQuery(lat, lon, limit, offset=0, max_distance=None):
+  """Look up the stores nearest to the given location with a Search API geo
+  query (the fallback if the store index is not available), returning a list
+  of (distance, StoreInfo) pairs like StoreIndex.nearest.  Raises search.Error
+  on failure."""
+  loc_expr = 'distance(%s, geopoint(%s, %s))' % (
+      docs.Store.STORE_LOCATION, lat, lon)
+  sortexpr = search.SortExpression(
+      expression=loc_expr,
+      direction=search.SortExpression.ASCENDING, default_value=0)
+  query_string = ''
+  if max_distance is not None:
+    query_string = '%s < %s' % (loc_expr, max_distance)
+  search_query = search.Query(
+      query_string=query_string,
+      options=search.QueryOptions(
+          limit=limit, offset=offset,
+          sort_options=search.SortOptions(expressions=[sortexpr]),
+          returned_expressions=[
+              search.FieldExpression(name='distance', expression=loc_expr)]))
+  results = []
+  for doc in docs.Store.getIndex().search(search_query):
+    dist = 0
+    for expr in doc.expressions:
+      if expr.name == 'distance':
+        dist = expr.value
+    results.append((dist, storeInfoFromDoc(doc)))
+  return results
+
+
+def loadStores():
+  """Read all the stores from the store search index, a page at a time, and
+  return them as a list of StoreInfo tuples.  Raises search.Error on
+  failure."""
+  index = docs.Store.getIndex()
+  stores = []
+  start_id = None
+  while True:
+    response = index.get_range(start_id=start_id, include_start_object=False,
+                               limit=_PAGE_SIZE)
+    if not response.results:
+      break
+    stores.extend(storeInfoFromDoc(doc) for doc in response.results)
+    start_id = response.results[-1].doc_id
+    if len(response.results) < _PAGE_SIZE:
+      break
+  return stores
+
+
+# this instance's (version, StoreIndex, time last checked) snapshot; the app
+# is threadsafe, so it is guarded by a lock.
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def getVersion():
+  """Return the current version of the store data.  The version is
+  initialized from the current time, so that it is not reused after memcache
+  loses it."""
+  version = memcache.get(_VERSION_KEY, namespace=_CACHE_NAMESPACE)
+  if version is None:
+    version = int(time.time() * 1000)
+    if not memcache.add(_VERSION_KEY, version, namespace=_CACHE_NAMESPACE):
+      version = memcache.get(_VERSION_KEY, namespace=_CACHE_NAMESPACE) or version
+  return version
+
+
+def invalidate():
+  """Record that the store data has changed, so that each instance rebuilds
+  its StoreIndex (other instances within their check interval)."""
+  global _snapshot
+  memcache.incr(_VERSION_KEY, namespace=_CACHE_NAMESPACE,
+                initial_value=int(time.time() * 1000))
+  with _snapshot_lock:
+    _snapshot = None
+
+
+def getStoreIndex():
+  """Return the StoreIndex of the current store data, building it if the
+  stores have changed since this instance last built it.  Raises search.Error
+  if the index has to be built but the stores can't be read."""
+  global _snapshot
+  now = time.time()
+  with _snapshot_lock:
+    snapshot = _snapshot
+  if snapshot and now - snapshot[2] < config.STORE_INDEX_CHECK_INTERVAL:
+    return snapshot[1]
+  # read the version before loading the stores, so that an index built from
+  # stores that are changed in the meantime is not kept as current.
+  version = getVersion()
+  if snapshot and snapshot[0] == version:
+    store_index = snapshot[1]
+  else:
+    start = time.time()
+    store_index = StoreIndex(loadStores())
+    logging.info('built the store index of %s stores in %.3fs',
+                 len(store_index), time.time() - start)
+  with _snapshot_lock:
+    _snapshot = (version, store_index, now)
+  return store_index
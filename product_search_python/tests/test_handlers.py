@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains unit tests for the request handlers, which check the number of
+API calls that each endpoint makes."""
+
+
+import collections
+import json
+import os
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.search import simple_search_stub
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+import admin_handlers
+import docs
+import main
+import models
+import storeindex
+import utils
+import warmup
+
+PRODUCT_PARAMS = dict(
+  pid='testproduct',
+  name='The adventures of Sherlock Holmes',
+  category='books',
+  price=2000,
+  publisher='Baker Books',
+  title='The adventures of Sherlock Holmes',
+  pages=200,
+  author='Sir Arthur Conan Doyle',
+  description='The adventures of Sherlock Holmes',
+  isbn='123456')
+
+
+class RpcCounter(object):
+  """Counts the API calls made, by service, via an apiproxy pre-call hook."""
+
+  def __init__(self):
+    self.counts = collections.defaultdict(int)
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpc_counter', self._hook)
+
+  def _hook(self, service, call, request, response):
+    self.counts[service] += 1
+
+  def reset(self):
+    self.counts.clear()
+
+
+class HandlerRpcTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+    self.testbed.init_memcache_stub()
+    self.testbed.init_user_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    apiproxy_stub_map.apiproxy.RegisterStub(
+      'search',
+      simple_search_stub.SearchServiceStub())
+    models.Category._snapshot = None
+    # don't count the cold start recording in the other tests' RPCs
+    warmup._cold_start_recorded = True
+    # the handlers load their templates relative to the app directory
+    self.cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    models.Category.buildAllCategories()
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    review = models.Review(product_key=product.key, username='bob', rating=4,
+                           comment='comment')
+    review.put()
+    utils.updateAverageRating(review.key)
+    self.rpcs = RpcCounter()
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    self.testbed.deactivate()
+
+  def _get(self, url):
+    self.rpcs.reset()
+    response = main.application.get_response(url)
+    self.assertEqual(response.status_int, 200)
+    return response
+
+  def testShowProductRpcs(self):
+    """The product page fetches the document, the product and the first review
+    page in parallel: one index call, and a datastore get and query."""
+    response = self._get('/product?pid=testproduct')
+    self.assertTrue('comment' in response.body)
+    self.assertEqual(self.rpcs.counts['search'], 1)
+    self.assertTrue(self.rpcs.counts['datastore_v3'] <= 3, self.rpcs.counts)
+    # the second time, the product and the review page are cached
+    self._get('/product?pid=testproduct')
+    self.assertEqual(self.rpcs.counts['search'], 1)
+    self.assertEqual(self.rpcs.counts['datastore_v3'], 0)
+
+  def testShowReviewsRpcs(self):
+    """The reviews page fetches the product and the review page in
+    parallel, and makes no index calls."""
+    response = self._get('/reviews?pid=testproduct&pname=sherlock')
+    self.assertTrue('bob' in response.body)
+    self.assertEqual(self.rpcs.counts['search'], 0)
+    self.assertTrue(self.rpcs.counts['datastore_v3'] <= 3, self.rpcs.counts)
+    self._get('/reviews?pid=testproduct&pname=sherlock')
+    self.assertEqual(self.rpcs.counts['datastore_v3'], 0)
+
+  def testWarmup(self):
+    """The warmup request preloads the instance once, and records its cold
+    start time."""
+    warmup._warmed_up = False
+    warmup._cold_start_recorded = False
+    models.Category._snapshot = None
+    self._get('/_ah/warmup')
+    self.assertTrue(warmup._warmed_up)
+    stats = warmup.getStats()
+    self.assertEqual(stats['count'], 1)
+    self.assertEqual(stats['warmup_count'], 1)
+    # a second warmup does nothing
+    self._get('/_ah/warmup')
+    self.assertEqual(sum(self.rpcs.counts.values()), 0)
+    self.assertEqual(warmup.getStats()['count'], 1)
+
+  def testLoadingRequestColdStart(self):
+    """An instance that gets no warmup request records its cold start time
+    after its first (loading) request, once."""
+    warmup._cold_start_recorded = False
+    self._get('/product?pid=testproduct')
+    stats = warmup.getStats()
+    self.assertEqual(stats['count'], 1)
+    self.assertEqual(stats['loading_count'], 1)
+    self.assertEqual(stats['warmup_count'], 0)
+    self._get('/product?pid=testproduct')
+    self.assertEqual(warmup.getStats()['count'], 1)
+
+  def testNearestStores(self):
+    """The nearest stores are returned as JSONP for a GET, and as plain JSON
+    for a POST."""
+    admin_handlers.loadStoreLocationData()
+    storeindex._snapshot = None
+    points = '-33.87,151.2;51.5,-0.12'
+    response = self._get('/get_nearest_stores?points=%s&k=2&callback=cb' %
+                         points)
+    self.assertTrue(response.body.startswith('cb('))
+    results = json.loads(response.body[len('cb('):-len(');')])
+    self.assertEqual([2, 2], [len(result['stores']) for result in results])
+    self.assertEqual('London', results[1]['stores'][0]['storename'])
+    response = main.application.get_response(
+        '/get_nearest_stores', POST={'points': points, 'k': '2'})
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(response.content_type, 'application/json')
+    self.assertEqual(results, json.loads(response.body))
+    response = main.application.get_response(
+        '/get_nearest_stores', POST={'points': 'nowhere'})
+    self.assertEqual(response.status_int, 400)
+
+  def testShowReviewsNotFound(self):
+    response = main.application.get_response('/reviews?pid=nosuchproduct')
+    self.assertEqual(response.status_int, 404)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains unit tests for the in-process search backend."""
+
+
+import os
+import time
+import unittest
+
+from google.appengine.api import search
+from google.appengine.ext import testbed
+
+import config
+import docs
+import localsearch
+from tests import test_search
+
+# the number of documents in the large catalog test; set
+# LOCALSEARCH_CATALOG_SIZE to check other sizes, e.g. 1000000
+CATALOG_SIZE = int(os.environ.get('LOCALSEARCH_CATALOG_SIZE', 20000))
+# the time allowed for a top-k query over the large catalog, in seconds
+QUERY_TIME_LIMIT = 1.0
+
+
+def _make_doc(i):
+  return search.Document(
+      doc_id='doc%s' % i,
+      fields=[search.TextField(name='name', value='product number %s' % i),
+              search.TextField(name='description',
+                               value='%s sherlock holmes' % (
+                                   'red' if i % 2 else 'blue')),
+              search.AtomField(name='category',
+                               value='hd televisions' if i % 3 else 'books'),
+              search.NumberField(name='price', value=i * 10),
+              search.NumberField(name='ar', value=i % 5),
+              search.GeoField(name='store_location',
+                              value=search.GeoPoint(37.0 + i / 100.0, -122.0))],
+      rank=i)
+
+
+class LocalSearchTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.saved_backend = config.SEARCH_BACKEND
+    config.SEARCH_BACKEND = 'local'
+    localsearch.resetAll()
+    self.index = localsearch.getIndex('test')
+    self.index.put([_make_doc(i) for i in xrange(30)])
+
+  def tearDown(self):
+    config.SEARCH_BACKEND = self.saved_backend
+    localsearch.resetAll()
+    self.testbed.deactivate()
+
+  def _ids(self, query, **kwargs):
+    results = self.index.search(search.Query(
+        query_string=query, options=search.QueryOptions(**kwargs)))
+    return [r.doc_id for r in results]
+
+  def testQueries(self):
+    self.assertEqual(30, self.index.search('').number_found)
+    self.assertEqual(15, self.index.search('red').number_found)
+    self.assertEqual(15, self.index.search('description:blue').number_found)
+    self.assertEqual(0, self.index.search('name:blue').number_found)
+    self.assertEqual(10, self.index.search('category:"books"').number_found)
+    # a restriction to a field that no document has matches nothing
+    self.assertEqual(0, self.index.search('nosuchfield:books').number_found)
+    self.assertEqual(
+        0, self.index.search('nosuchfield:books red').number_found)
+    self.assertEqual(
+        5, self.index.search('category:"books" red').number_found)
+    self.assertEqual(30, self.index.search('"sherlock holmes"').number_found)
+    self.assertEqual(0, self.index.search('"holmes sherlock"').number_found)
+    self.assertEqual(12, self.index.search('ar >= 2 ar < 4').number_found)
+    self.assertEqual(6, self.index.search('ar:3').number_found)
+    self.assertEqual(
+        3, self.index.search('price > 50 AND price <= 80').number_found)
+    self.assertEqual(20, self.index.search('NOT category:books').number_found)
+    self.assertEqual(
+        14, self.index.search('(ar:0 OR ar:1) OR price < 40').number_found)
+    self.assertEqual(
+        11, self.index.search('distance(store_location, '
+                              'geopoint(37.0, -122.0)) < 12000').number_found)
+    self.assertRaises(search.QueryError, self.index.search, 'ar >= (')
+
+  def testSortAndPaging(self):
+    self.assertEqual(['doc29', 'doc28', 'doc27'], self._ids('', limit=3))
+    sortopts = search.SortOptions(expressions=[
+        search.SortExpression(expression='ar',
+                              direction=search.SortExpression.DESCENDING,
+                              default_value=0),
+        search.SortExpression(expression='price * 2',
+                              direction=search.SortExpression.ASCENDING,
+                              default_value=0)])
+    self.assertEqual(['doc4', 'doc9', 'doc14'],
+                     self._ids('', limit=3, sort_options=sortopts))
+    self.assertEqual(['doc19', 'doc24'],
+                     self._ids('', limit=2, offset=3, sort_options=sortopts))
+    # cursors continue where the previous page left off
+    results = self.index.search(search.Query(
+        query_string='red', options=search.QueryOptions(
+            limit=10, cursor=search.Cursor())))
+    self.assertEqual(10, len(results.results))
+    results = self.index.search(search.Query(
+        query_string='red', options=search.QueryOptions(
+            limit=10, cursor=results.cursor)))
+    self.assertEqual(5, len(results.results))
+    self.assertEqual(None, results.cursor)
+
+  def testReturnedFields(self):
+    results = self.index.search(search.Query(
+        query_string='category:books', options=search.QueryOptions(
+            limit=1, returned_fields=['price'])))
+    self.assertEqual(['price'], [f.name for f in results.results[0].fields])
+
+  def testPutDeleteAndGetRange(self):
+    self.index.delete(['doc3', 'doc4'])
+    self.index.put(search.Document(
+        doc_id='doc5', fields=[search.TextField(name='name', value='moriarty')]))
+    self.assertEqual(0, self.index.search('number 5').number_found)
+    self.assertEqual(1, self.index.search('moriarty').number_found)
+    ids = [d.doc_id for d in self.index.get_range(limit=5).results]
+    self.assertEqual(['doc0', 'doc1', 'doc10', 'doc11', 'doc12'], ids)
+    ids = [d.doc_id for d in self.index.get_range(
+        start_id='doc25', include_start_object=False).results]
+    self.assertEqual(['doc26', 'doc27', 'doc28', 'doc29', 'doc5', 'doc6',
+                      'doc7', 'doc8', 'doc9'], ids)
+    # changes to returned documents don't affect the index
+    doc = self.index.get_range(start_id='doc5', limit=1).results[0]
+    doc.fields[:] = []
+    self.assertEqual(1, self.index.search('moriarty').number_found)
+
+  def testProductBackend(self):
+    self.assertTrue(isinstance(docs.Product.getIndex(),
+                               localsearch.LocalIndex))
+    params = dict(pid='testproduct', name='The adventures of Sherlock Holmes',
+                  category='books', price=2000, publisher='Baker Books',
+                  title='The adventures of Sherlock Holmes', pages=200,
+                  author='Sir Arthur Conan Doyle',
+                  description='The adventures of Sherlock Holmes',
+                  isbn='123456')
+    docs.Product.buildProduct(params)
+    res = docs.Product.getIndex().search_async('sherlock').get_result()
+    self.assertEqual(1, res.number_found)
+    self.assertEqual('testproduct', res.results[0].doc_id)
+
+
+class LargeCatalogTestCase(unittest.TestCase):
+  """Checks that top-k queries over a large catalog are fast, and right."""
+
+  @classmethod
+  def setUpClass(cls):
+    cls.index = localsearch.LocalIndex('large')
+    batch = []
+    for i in xrange(CATALOG_SIZE):
+      batch.append(search.Document(
+          doc_id='doc%07d' % i,
+          fields=[search.TextField(name='name', value='product %s' % i),
+                  search.AtomField(name='category',
+                                   value='books' if i % 4 else 'televisions'),
+                  search.NumberField(name='price', value=cls._price(i)),
+                  search.NumberField(name='ar', value=i % 5)],
+          rank=i))
+      if len(batch) == 200:
+        cls.index.put(batch)
+        batch = []
+    cls.index.put(batch)
+
+  @staticmethod
+  def _price(i):
+    return (i * 7919) % 100000
+
+  def _timedSearch(self, query_string, limit, sort_options=None):
+    start = time.time()
+    results = self.index.search(search.Query(
+        query_string=query_string, options=search.QueryOptions(
+            limit=limit, ids_only=True, sort_options=sort_options)))
+    self.assertTrue(time.time() - start < QUERY_TIME_LIMIT,
+                    'slow query: %r' % query_string)
+    return results
+
+  def testTopK(self):
+    results = self._timedSearch('', 10)
+    self.assertEqual(CATALOG_SIZE, results.number_found)
+    self.assertEqual(['doc%07d' % i for i in
+                      xrange(CATALOG_SIZE - 1, CATALOG_SIZE - 11, -1)],
+                     [r.doc_id for r in results])
+    sortopts = search.SortOptions(expressions=[
+        search.SortExpression(expression='price',
+                              direction=search.SortExpression.ASCENDING,
+                              default_value=0)])
+    results = self._timedSearch('category:books ar >= 3', 10, sortopts)
+    expected = sorted(self._price(i)
+                      for i in xrange(CATALOG_SIZE) if i % 4 and i % 5 >= 3)
+    self.assertEqual(len(expected), results.number_found)
+    self.assertEqual(expected[:10],
+                     [self._price(int(r.doc_id[3:])) for r in results])
+
+
+class LocalBackendFTSTestCase(test_search.FTSTestCase):
+  """Runs the product search tests against the local search backend."""
+
+  def setUp(self):
+    super(LocalBackendFTSTestCase, self).setUp()
+    self.saved_backend = config.SEARCH_BACKEND
+    config.SEARCH_BACKEND = 'local'
+    localsearch.resetAll()
+
+  def tearDown(self):
+    config.SEARCH_BACKEND = self.saved_backend
+    localsearch.resetAll()
+    super(LocalBackendFTSTestCase, self).tearDown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -19,6 +19,8 @@
 
 __author__ = 'tmatsuo@google.com (Takashi Matsuo), amyu@google.com (Amy Unruh)'
 
+import csv
+import json
 import os
 import shutil
 import tempfile
@@ -28,6 +30,7 @@ import pickle
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import files
+from google.appengine.api import memcache
 from google.appengine.api import queueinfo
 from google.appengine.api import search
 from google.appengine.api import users
@@ -35,14 +38,23 @@ from google.appengine.api.search import simple_search_stub
 from google.appengine.api.taskqueue import taskqueue_stub
 from google.appengine.ext import db
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from google.appengine.datastore import datastore_stub_util
 
 import admin_handlers
+import cache
+import categories
 import config
 import docs
 import errors
+import facets
+import idpool
+import importer
 import models
+import ratings
+import reindex
+import reset
 import utils
 
 PRODUCT_PARAMS = dict(
@@ -72,6 +84,9 @@ def create_test_data(n):
       if key == 'category':
         # untouched
         params[key] = PRODUCT_PARAMS[key]
+      elif key == 'pid':
+        # the pid is used as the doc id, which may not contain whitespace
+        params[key] = '%s%s' % (PRODUCT_PARAMS[key], i)
       else:
         params[key] = _add_mark(PRODUCT_PARAMS[key], i)
     ret.append(params)
@@ -93,15 +108,21 @@ class FTSTestCase(unittest.TestCase):
     # Initialize the datastore stub with this policy.
     self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
     self.testbed.init_memcache_stub()
-    self.testbed.init_taskqueue_stub()
+    # load the app's queue.yaml, which defines the pull queues.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
 
     # search stub is not available via testbed, so doing this by
     # myself.
     apiproxy_stub_map.apiproxy.RegisterStub(
       'search',
       simple_search_stub.SearchServiceStub())
+    # drop any category info snapshot left by another test
+    models.Category._snapshot = None
+    self.coalesce_window = config.REINDEX_COALESCE_WINDOW
 
   def tearDown(self):
+    config.REINDEX_COALESCE_WINDOW = self.coalesce_window
     self.testbed.deactivate()
 
   def testBuildProduct(self):
@@ -127,6 +148,7 @@ class FTSTestCase(unittest.TestCase):
     product = docs.Product.buildProduct(PRODUCT_PARAMS)
     self.assertEqual(product.avg_rating, 0)
     config.BATCH_RATINGS_UPDATE = False
+    config.REINDEX_COALESCE_WINDOW = 0
 
     # Create a review object and invoke updateAverageRating.
     review = models.Review(product_key=product.key,
@@ -174,6 +196,7 @@ class FTSTestCase(unittest.TestCase):
     models.Category.buildAllCategories()
     product = docs.Product.buildProduct(PRODUCT_PARAMS)
     config.BATCH_RATINGS_UPDATE = False
+    config.REINDEX_COALESCE_WINDOW = 0
 
     # Create a review object and invoke updateAverageRating.
     review = models.Review(product_key=product.key,
@@ -197,6 +220,121 @@ class FTSTestCase(unittest.TestCase):
     taskq.FlushQueue("default")
     self.assertEqual(len(tasks), 2)
 
+  def testReviewPages(self):
+    "Test the paged review listing, and its cached first page."
+    models.Category.buildAllCategories()
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    page_size = config.REVIEWS_PAGE_SIZE
+    config.REVIEWS_PAGE_SIZE = 2
+    try:
+      for i in xrange(3):
+        review = models.Review(product_key=product.key, username='user%s' % i,
+                               rating=3, comment='comment')
+        review.put()
+        utils.updateAverageRating(review.key)
+      reviews, cursor = models.Review.getPage(product.pid)
+      self.assertEqual(['user2', 'user1'], [r.username for r in reviews])
+      self.assertNotEqual(None, memcache.get(
+          product.pid, namespace=models.Review._FIRST_PAGE_NAMESPACE))
+      reviews, cursor = models.Review.getPage(
+          product.pid, ndb.Cursor(urlsafe=cursor))
+      self.assertEqual(['user0'], [r.username for r in reviews])
+      self.assertEqual(None, cursor)
+      # a new review refreshes the cached first page
+      review = models.Review(product_key=product.key, username='user3',
+                             rating=3, comment='comment')
+      review.put()
+      utils.updateAverageRating(review.key)
+      reviews, cursor = models.Review.getPage(product.pid)
+      self.assertEqual(['user3', 'user2'], [r.username for r in reviews])
+      # a new review that the query doesn't see yet is merged into the page
+      review = models.Review(product_key=product.key, username='user4',
+                             rating=3, comment='comment')
+      review.put()
+      models.Review.refreshFirstPage(product.pid, [review])
+      reviews, cursor = models.Review.getPage(product.pid)
+      self.assertEqual(['user4', 'user3'], [r.username for r in reviews])
+      reviews, cursor = models.Review.getPage(
+          product.pid, ndb.Cursor(urlsafe=cursor))
+      self.assertEqual(['user2', 'user1'], [r.username for r in reviews])
+      # two reviews added close together, neither seen by the query: the
+      # second refresh keeps the review merged by the first
+      review.rating_added = True
+      review.put()
+      for name in ['user5', 'user6']:
+        review = models.Review(product_key=product.key, username=name,
+                               rating=3, comment='comment')
+        review.put()
+        models.Review.refreshFirstPage(product.pid, [review])
+      reviews, cursor = models.Review.getPage(product.pid)
+      self.assertEqual(['user6', 'user5'], [r.username for r in reviews])
+      reviews, cursor = models.Review.getPage(
+          product.pid, ndb.Cursor(urlsafe=cursor))
+      self.assertEqual(['user4', 'user3'], [r.username for r in reviews])
+    finally:
+      config.REVIEWS_PAGE_SIZE = page_size
+
+  def testUpdateAverageRatingCoalesced(self):
+    "Test that the doc reindexes for a product's reviews are coalesced."
+    models.Category.buildAllCategories()
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    config.BATCH_RATINGS_UPDATE = False
+    config.REINDEX_COALESCE_WINDOW = 3600
+
+    for rating in [4, 1, 5]:
+      review = models.Review(product_key=product.key,
+                             username='bob',
+                             rating=rating,
+                             comment='comment'
+                             )
+      review.put()
+      utils.updateAverageRating(review.key)
+
+    # no push tasks, and a single pending reindex for the three reviews
+    taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    self.assertEqual(len(taskq.GetTasks("default")), 0)
+    self.assertEqual(len(taskq.GetTasks(reindex.QUEUE_NAME)), 1)
+    # each review also logged the product, in case its reindex was not queued
+    self.assertEqual(len(taskq.GetTasks(reindex.DIRTY_LOG_QUEUE_NAME)), 3)
+    stats = reindex.getStats()
+    self.assertEqual(stats['queued'], 1)
+    self.assertEqual(stats['coalesced'], 2)
+    # the window has not ended, so there is nothing to flush yet
+    self.assertEqual(reindex.flushDirty(), 0)
+    product = models.Product.get_by_id(product.pid)
+    self.assertTrue(product.needs_review_reindex)
+
+  def testShardedRatings(self):
+    "Test sharded rating aggregation, and the folding in of the shards."
+    models.Category.buildAllCategories()
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    rating_shards = config.RATING_SHARDS
+    config.RATING_SHARDS = 4
+    try:
+      for rating in [4, 1, 5, 2]:
+        review = models.Review(product_key=product.key,
+                               username='bob',
+                               rating=rating,
+                               comment='comment'
+                               )
+        review.put()
+        utils.updateAverageRating(review.key)
+      # the product entity itself has not been updated yet
+      product = models.Product.get_by_id(product.pid)
+      self.assertEqual(product.num_reviews, 0)
+      self.assertEqual(ratings.getCurrentRating(product), (3.0, 4))
+
+      self.assertEqual(ratings.compactAllShards(), 1)
+    finally:
+      config.RATING_SHARDS = rating_shards
+    product = models.Product.get_by_id(product.pid)
+    self.assertEqual(product.num_reviews, 4)
+    self.assertEqual(product.avg_rating, 3.0)
+    self.assertFalse(product.needs_review_reindex)
+    sq = search.Query(query_string='ar:3.0')
+    res = docs.Product.getIndex().search(sq)
+    self.assertEqual(res.number_found, 1)
+
   def testUpdateAverageRatingBatch(self):
     "Test batch mode avg ratings updating."
     models.Category.buildAllCategories()
@@ -226,6 +364,335 @@ class FTSTestCase(unittest.TestCase):
     res = docs.Product.getIndex().search(sq)
     self.assertEqual(res.number_found, 0)
 
+    # the product was logged as dirty, and the batch update reindexes it
+    self.assertEqual(len(taskq.GetTasks(reindex.DIRTY_LOG_QUEUE_NAME)), 1)
+    self.assertEqual(admin_handlers.updateRatings(), 1)
+    res = docs.Product.getIndex().search(sq)
+    self.assertEqual(res.number_found, 1)
+    self.assertEqual(len(taskq.GetTasks(reindex.DIRTY_LOG_QUEUE_NAME)), 0)
+
+  def testSweepFlagged(self):
+    "Test the sweep of products flagged before the dirty log was in use."
+    models.Category.buildAllCategories()
+    products = [docs.Product.buildProduct(params)
+                for params in create_test_data(3)]
+    for product in products[:2]:
+      product.avg_rating = 4.0
+      product.needs_review_reindex = True
+    ndb.put_multi(products)
+    reindex.sweepFlagged()
+    for product in ndb.get_multi([product.key for product in products]):
+      self.assertFalse(product.needs_review_reindex)
+    sq = search.Query(query_string='ar:4.0')
+    res = docs.Product.getIndex().search(sq)
+    self.assertEqual(res.number_found, 2)
+
+  def testGenerateFacets(self):
+    "Test facet counting, and the marking of sampled counts as estimates."
+    models.Category.buildAllCategories()
+    for params in create_test_data(4):
+      docs.Product.buildProduct(params)
+
+    facet_counts = docs.Product.generateFacets('Sherlock')
+    self.assertFalse(facet_counts.is_estimate)
+    self.assertEqual(facet_counts.getCounts(facets.CATEGORY), {'books': 4})
+    self.assertEqual(facet_counts.getCounts(facets.RATING), {0: 4})
+    self.assertEqual(
+        facet_counts.getCounts(facets.PRICE), {(500, None): 4})
+    self.assertEqual(sum(facet_counts.getCounts('publisher').values()), 4)
+
+    # with a sample smaller than the result set, counts are scaled estimates
+    orig_limit = config.FACET_SAMPLE_LIMIT
+    config.FACET_SAMPLE_LIMIT = 2
+    try:
+      facet_counts = docs.Product.generateFacets('Sherlock')
+    finally:
+      config.FACET_SAMPLE_LIMIT = orig_limit
+    self.assertTrue(facet_counts.is_estimate)
+    self.assertEqual(facet_counts.sample_size, 2)
+    self.assertEqual(facet_counts.getCounts(facets.CATEGORY), {'books': 4})
+
+  def testSearchCacheInvalidation(self):
+    "Test that product index writes invalidate cached search entries."
+    models.Category.buildAllCategories()
+    cache_params = ('sherlock', 'books', '', '', '', 0, 3)
+    cache.put('psearch', cache_params, {'number_found': 1})
+    self.assertEqual(
+        cache.get('psearch', cache_params), {'number_found': 1})
+
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    self.assertEqual(cache.get('psearch', cache_params), None)
+    cache.put('psearch', cache_params, {'number_found': 1})
+    docs.Product.updateRatingsInfo(product.doc_id, 4.0)
+    self.assertEqual(cache.get('psearch', cache_params), None)
+    self.assertEqual(cache.getStats(), {'hits': 1, 'misses': 2})
+
+  def testCategoryInfoCache(self):
+    "Test the versioned category info cache."
+    cat_info = models.Category.getCategoryInfo()
+    self.assertTrue(('books', 'books') in cat_info)
+    # another instance, with no snapshot, gets the info from memcache
+    models.Category._snapshot = None
+    version = models.Category.getCategoryInfoVersion()
+    self.assertEqual(cat_info, memcache.get(
+        'data:%s' % version,
+        namespace=models.Category._CACHE_NAMESPACE)['info'])
+    self.assertEqual(cat_info, models.Category.getCategoryInfo())
+    # category writes invalidate the cache
+    models.Category(id='games').put()
+    self.assertNotEqual(version, models.Category.getCategoryInfoVersion())
+    self.assertTrue(('games', 'games') in models.Category.getCategoryInfo())
+
+  def testCategoryPaths(self):
+    "Test that a search on a category also matches its subcategories."
+    tree = {'name': 'root',
+            'children': [{'name': 'media', 'children': [categories.books]}]}
+    cats = models.Category.buildCategoryTree(tree)
+    self.assertEqual([[], ['media'], ['media', 'books']],
+                     [c.path for c in cats])
+    models.Category.putCategories(cats)
+    docs.Product.buildProduct(PRODUCT_PARAMS)
+    for cname in ['media', 'books']:
+      res = docs.Product.getIndex().search(
+          docs.Product.categoryQuery(cname))
+      self.assertEqual(res.number_found, 1)
+    # a doc indexed without the category path still matches its own category
+    doc = docs.Product.getDocFromPid(PRODUCT_PARAMS['pid'])
+    docs.Product.add(search.Document(
+        doc_id=doc.doc_id,
+        fields=[f for f in doc.fields
+                if f.name != docs.Product.CATEGORY_PATH]))
+    for cname, count in [('media', 0), ('books', 1)]:
+      res = docs.Product.getIndex().search(
+          docs.Product.categoryQuery(cname))
+      self.assertEqual(res.number_found, count)
+
+  def testIdPool(self):
+    "Test that the id pool hands out distinct, reserved ids."
+    pool = idpool.IdPool(models.Review, batch_size=10)
+    ids = [pool.allocateId() for _ in xrange(25)]
+    self.assertEqual(len(set(ids)), 25)
+    # the pool's ids are reserved, so new allocations don't overlap them
+    start, end = models.Review.allocate_ids(size=10)
+    self.assertFalse(set(ids) & set(xrange(start, end + 1)))
+
+  def testIdPoolRefillAcrossRequests(self):
+    "Test that a refill left by an ended request is not waited on."
+    pool = idpool.IdPool(models.Review, batch_size=10)
+    # taking the 8th id starts a refill, in this request's event loop
+    ids = [pool.allocateId() for _ in xrange(8)]
+    self.assert_(pool._refill)
+    # end the request: the next one on this thread gets a new event loop
+    os.environ.pop('__EVENT_LOOP__', None)
+    ids += [pool.allocateId() for _ in xrange(15)]
+    self.assertEqual(len(set(ids)), 23)
+    # settle collects the new request's own refill
+    pool.settle()
+    self.assertEqual(pool._refill, None)
+
+  def testGetDocs(self):
+    "Test the batch document fetch."
+    models.Category.buildAllCategories()
+    for params in create_test_data(3):
+      docs.Product.buildProduct(params)
+    res = docs.Product.getDocs(
+        ['testproduct2', 'testproduct0', 'nosuchproduct', ''])
+    self.assertEqual(sorted(res.keys()), ['testproduct0', 'testproduct2'])
+    for doc_id, doc in res.iteritems():
+      self.assertEqual(doc.doc_id, doc_id)
+    self.assertEqual(docs.Product.getDoc('nosuchproduct'), None)
+
+  def testBuildProductUpserts(self):
+    "Test batch product upserts, which retain existing ratings info."
+    models.Category.buildAllCategories()
+    product = docs.Product.buildProduct(PRODUCT_PARAMS)
+    product.avg_rating = 4.0
+    product.put()
+    rows = create_test_data(2)
+    rows[0]['pid'] = PRODUCT_PARAMS['pid']
+    prods = docs.Product.buildProductUpserts(rows)
+    self.assertEqual(len(prods), 2)
+    self.assertEqual(prods[0].price, rows[0]['price'])
+    self.assertEqual(prods[0].avg_rating, 4.0)
+    doc = docs.Product.getDocFromPid(PRODUCT_PARAMS['pid'])
+    self.assertEqual(docs.Product(doc).getAvgRating(), 4.0)
+    new_prod = models.Product.get_by_id(rows[1]['pid'])
+    self.assert_(new_prod is not None)
+    self.assertEqual(new_prod.doc_id, rows[1]['pid'])
+    # ratings info written after the products were loaded is kept
+    orig_get_multi = ndb.get_multi
+    def _getMultiThenRate(keys):
+      res = orig_get_multi(keys)
+      prod = models.Product.get_by_id(PRODUCT_PARAMS['pid'])
+      prod.avg_rating = 2.0
+      prod.num_reviews = 3
+      prod.put()
+      return res
+    ndb.get_multi = _getMultiThenRate
+    try:
+      docs.Product.buildProductUpserts(rows[:1])
+    finally:
+      ndb.get_multi = orig_get_multi
+    prod = models.Product.get_by_id(PRODUCT_PARAMS['pid'])
+    self.assertEqual(prod.avg_rating, 2.0)
+    self.assertEqual(prod.num_reviews, 3)
+
+  def testUpdateProdDocsWithNewRating(self):
+    "Test the batch reindexing of docs with updated ratings."
+    models.Category.buildAllCategories()
+    config.BATCH_RATINGS_UPDATE = True
+    pkeys = []
+    for params in create_test_data(3):
+      product = docs.Product.buildProduct(params)
+      review = models.Review(product_key=product.key, username='bob',
+                             rating=3, comment='comment')
+      review.put()
+      utils.updateAverageRating(review.key)
+      pkeys.append(product.key)
+    models.Product.updateProdDocsWithNewRating(pkeys)
+    for prod in ndb.get_multi(pkeys):
+      self.assertFalse(prod.needs_review_reindex)
+    sq = search.Query(query_string='ar:3.0')
+    res = docs.Product.getIndex().search(sq)
+    self.assertEqual(res.number_found, 3)
+
+  def _runDeferredTasks(self):
+    """Run the deferred tasks in the default queue, until there are none."""
+    taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    tasks = taskq.GetTasks("default")
+    taskq.FlushQueue("default")
+    while tasks:
+      for task in tasks:
+        deferred.run(base64.b64decode(task["body"]))
+      tasks = taskq.GetTasks("default")
+      taskq.FlushQueue("default")
+
+  def testImportJob(self):
+    "Test a chained, checkpointed import of a csv file."
+    models.Category.buildAllCategories()
+    fieldnames = ['pid', 'name', 'category', 'price', 'publisher', 'title',
+                  'pages', 'author', 'description', 'isbn']
+    tmpdir = tempfile.mkdtemp()
+    try:
+      datafile = os.path.join(tmpdir, 'books.csv')
+      with open(datafile, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames)
+        for row in create_test_data(5):
+          writer.writerow(row)
+      orig_batch_size = config.IMPORT_BATCH_SIZE
+      orig_time_limit = config.IMPORT_TASK_TIME_LIMIT
+      # import two rows per batch, and chain a new task after every batch
+      config.IMPORT_BATCH_SIZE = 2
+      config.IMPORT_TASK_TIME_LIMIT = 0
+      try:
+        job = importer.startImport(datafile, fieldnames)
+        self._runDeferredTasks()
+      finally:
+        config.IMPORT_BATCH_SIZE = orig_batch_size
+        config.IMPORT_TASK_TIME_LIMIT = orig_time_limit
+    finally:
+      shutil.rmtree(tmpdir)
+
+    job = job.key.get()
+    self.assertTrue(job.done)
+    self.assertEqual(job.next_row, 5)
+    self.assertEqual(models.Product.query().count(), 5)
+    sq = search.Query(query_string='Sherlock')
+    res = docs.Product.getIndex().search(sq)
+    self.assertEqual(res.number_found, 5)
+
+  def testReviewImportJob(self):
+    "Test a chained import of reviews, with aggregated rating updates."
+    models.Category.buildAllCategories()
+    products = [docs.Product.buildProduct(params)
+                for params in create_test_data(2)]
+    pid0, pid1 = [prod.key.id() for prod in products]
+    rows = [dict(pid=pid0, username='bob', rating=5, comment='great'),
+            dict(pid=pid1, username='bob', rating=2, comment='poor'),
+            dict(pid=pid0, username='sue', rating=3, comment='good'),
+            dict(pid='nosuchproduct', username='sue', rating=3),
+            dict(pid=pid1, username='sue', rating=9, comment='bad rating')]
+    tmpdir = tempfile.mkdtemp()
+    try:
+      datafile = os.path.join(tmpdir, 'reviews.jsonl')
+      with open(datafile, 'w') as f:
+        for row in rows:
+          f.write(json.dumps(row) + '\n')
+      orig_batch_size = config.REVIEW_IMPORT_BATCH_SIZE
+      orig_time_limit = config.IMPORT_TASK_TIME_LIMIT
+      config.REVIEW_IMPORT_BATCH_SIZE = 3
+      config.IMPORT_TASK_TIME_LIMIT = 0
+      try:
+        job = importer.startReviewImport(datafile)
+        self._runDeferredTasks()
+        # importing the same file again, in a new job, adds no ratings
+        importer.startReviewImport(datafile)
+        self._runDeferredTasks()
+      finally:
+        config.REVIEW_IMPORT_BATCH_SIZE = orig_batch_size
+        config.IMPORT_TASK_TIME_LIMIT = orig_time_limit
+    finally:
+      shutil.rmtree(tmpdir)
+
+    job = job.key.get()
+    self.assertTrue(job.done)
+    self.assertEqual(job.next_row, 5)
+    self.assertEqual(models.Review.query().count(), 3)
+    prod0, prod1 = ndb.get_multi([prod.key for prod in products])
+    self.assertEqual(prod0.num_reviews, 2)
+    self.assertEqual(prod0.avg_rating, 4.0)
+    self.assertFalse(prod0.needs_review_reindex)
+    self.assertEqual(prod1.num_reviews, 1)
+    sq = search.Query(query_string='ar:4.0')
+    res = docs.Product.getIndex().search(sq)
+    self.assertEqual(res.number_found, 1)
+
+    # a retried batch doesn't add its ratings twice
+    self.assertEqual(importer.importReviewBatch(rows[:3]), 3)
+    self.assertEqual(models.Review.query().count(), 3)
+    self.assertEqual(prod0.key.get().num_reviews, 2)
+    # deleting a product's reviews also deletes their import marks
+    models.Review.deleteReviews(pid0)
+    self.assertEqual(
+        models.RatingImportMark.query(ancestor=prod0.key).count(), 0)
+    self.assertEqual(models.RatingImportMark.query().count(), 1)
+
+  def testReset(self):
+    "Test a sharded reset of the product and review data."
+    models.Category.buildAllCategories()
+    for params in create_test_data(3):
+      product = docs.Product.buildProduct(params)
+      review = models.Review(product_key=product.key, username='bob',
+                             rating=3, comment='comment')
+      review.put()
+      utils.updateAverageRating(review.key)
+    # the ratings state that is keyed by pid, and an import job
+    pid = product.key.id()
+    models.RatingShard(key=models.RatingShard.shardKey(pid, 0),
+                       product_key=product.key, num_reviews=1,
+                       rating_sum=5).put()
+    models.RatingImportMark(
+        key=models.RatingImportMark.markKey(product.key, 'review')).put()
+    models.ImportJob(datafile='reviews.csv').put()
+    reviews, _ = models.Review.getPage(pid)
+    self.assertEqual(len(reviews), 1)
+    job = reset.startReset(on_done=(memcache.set, ('reset_done', True)),
+                           num_shards=4)
+    self._runDeferredTasks()
+
+    for model_class in reset.RESET_KINDS:
+      self.assertEqual(model_class.query().count(), 0)
+    self.assertEqual(
+        len(docs.Product.getIndex().get_range(ids_only=True).results), 0)
+    # the cached review pages were dropped
+    reviews, _ = models.Review.getPage(pid)
+    self.assertEqual(reviews, [])
+    progress = reset.getProgress(job.key.id())
+    self.assertEqual(progress['shards_done'], progress['num_shards'])
+    self.assertEqual(progress['deleted'], 12)
+    self.assertTrue(progress['finished'] is not None)
+    self.assertTrue(memcache.get('reset_done'))
+
 
 if __name__ == '__main__':
   unittest.main()
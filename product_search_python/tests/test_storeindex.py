@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains unit tests for the in-memory store index."""
+
+
+import math
+import random
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.search import simple_search_stub
+from google.appengine.ext import testbed
+
+import admin_handlers
+import storeindex
+import stores
+
+
+def haversine(lat1, lon1, lat2, lon2):
+  lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+  a = (math.sin((lat2 - lat1) / 2) ** 2 +
+       math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+  return 2 * storeindex.EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def sampleStores():
+  return [storeindex.StoreInfo(s[0], s[1], s[2], s[3][0], s[3][1])
+          for s in stores.stores]
+
+
+class StoreIndexTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+      'search',
+      simple_search_stub.SearchServiceStub())
+    storeindex._snapshot = None
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _bruteForce(self, store_list, lat, lon, max_distance=None):
+    found = sorted((haversine(lat, lon, s.lat, s.lon), s.store_id)
+                   for s in store_list)
+    return [sid for dist, sid in found
+            if max_distance is None or dist <= max_distance]
+
+  def testNearest(self):
+    "The nearest stores match a brute force search, in order."
+    store_list = sampleStores()
+    store_index = storeindex.StoreIndex(store_list)
+    rand = random.Random(1)
+    for _ in xrange(50):
+      lat, lon = rand.uniform(-90, 90), rand.uniform(-180, 180)
+      expected = self._bruteForce(store_list, lat, lon)
+      results = store_index.nearest(lat, lon, 5)
+      self.assertEqual([s.store_id for d, s in results], expected[:5])
+      dist, store = results[0]
+      self.assertAlmostEqual(
+          dist, haversine(lat, lon, store.lat, store.lon), places=3)
+
+  def testRadiusAndPaging(self):
+    "Radius queries return only the stores in range, a page at a time."
+    store_list = sampleStores()
+    store_index = storeindex.StoreIndex(store_list)
+    # near Sydney
+    lat, lon = -33.87, 151.2
+    expected = self._bruteForce(store_list, lat, lon, 40000)
+    self.assertEqual(len(expected), 5)
+    results = store_index.withinRadius(lat, lon, 40000, 3)
+    self.assertEqual([s.store_id for d, s in results], expected[:3])
+    results = store_index.withinRadius(lat, lon, 40000, 3, offset=3)
+    self.assertEqual([s.store_id for d, s in results], expected[3:])
+    # across the date line
+    results = store_index.nearest(0, 179.9, 1)
+    self.assertEqual(results[0][1].store_id, 'armidale')
+
+  def testNearestMany(self):
+    "Batch lookups match single lookups, with or without NumPy."
+    rand = random.Random(2)
+    origins = [(rand.uniform(-90, 90), rand.uniform(-180, 180))
+               for _ in xrange(20)]
+    orig_numpy = storeindex.numpy
+    try:
+      for numpy in set([orig_numpy, None]):
+        storeindex.numpy = numpy
+        store_index = storeindex.StoreIndex(sampleStores())
+        batch = store_index.nearestMany(origins, 4)
+        for (lat, lon), nearest in zip(origins, batch):
+          single = store_index.nearest(lat, lon, 4)
+          self.assertEqual([s.store_id for d, s in nearest],
+                           [s.store_id for d, s in single])
+          for (d1, _), (d2, _) in zip(nearest, single):
+            self.assertAlmostEqual(d1, d2, delta=1)
+        nearest = store_index.nearestMany([(-33.87, 151.2)], 10, 40000)
+        self.assertEqual(len(nearest[0]), 5)
+    finally:
+      storeindex.numpy = orig_numpy
+
+  def testGetStoreIndex(self):
+    "The store index is built from the store documents, and rebuilt on change."
+    self.assertEqual(len(storeindex.getStoreIndex()), 0)
+    admin_handlers.loadStoreLocationData()
+    store_index = storeindex.getStoreIndex()
+    self.assertEqual(len(store_index), len(stores.stores))
+    self.assertEqual(store_index.nearest(51.5, -0.12, 1)[0][1].name, 'London')
+    self.assertTrue(storeindex.getStoreIndex() is store_index)
+
+  def testSyncStores(self):
+    "The store sync only writes the stores that have changed."
+    self.assertEqual(admin_handlers.loadStoreLocationData(),
+                     len(stores.stores))
+    self.assertEqual(admin_handlers.loadStoreLocationData(), 0)
+    store_data = list(stores.stores[1:])
+    store_data[0] = ('sydney', 'Sydney', '1 George St.', [-33.873, 151.206])
+    self.assertEqual(admin_handlers.loadStoreLocationData(store_data), 2)
+    store_index = storeindex.getStoreIndex()
+    self.assertEqual(len(store_index), len(stores.stores) - 1)
+    nearest = store_index.nearest(-33.87, 151.2, 1)[0][1]
+    self.assertEqual(nearest.address, '1 George St.')
+
+
+if __name__ == '__main__':
+  unittest.main()
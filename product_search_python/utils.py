@@ -16,11 +16,15 @@
 
 """Contains utility functions."""
 
+import contextlib
 import logging
+import time
 
 import config
 import docs
 import models
+import ratings
+import reindex
 
 from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
@@ -39,9 +43,65 @@ def intClamp(v, low, high):
   """
   return max(int(low), min(int(v), int(high)))
 
+class LazyResult(object):
+  """A minimal future: wraps a function that computes a result, usually by
+  waiting on one or more RPCs that have already been started.  The function is
+  called, once, the first time get_result is called."""
+
+  def __init__(self, func):
+    self._func = func
+    self._done = False
+    self._result = None
+
+  def get_result(self):
+    if not self._done:
+      self._result = self._func()
+      self._done = True
+    return self._result
+
+
+class RequestTimer(object):
+  """Records the time spent in named phases of a request, e.g. the time spent
+  waiting for each of a set of concurrent RPCs.  When the RPCs overlap, the
+  total request time is close to that of the slowest phase, rather than to
+  their sum."""
+
+  def __init__(self):
+    self._start = time.time()
+    self.phases = []
+
+  @contextlib.contextmanager
+  def timed(self, name):
+    """Context manager that records the time spent in its block as the
+    named phase."""
+    phase_start = time.time()
+    try:
+      yield
+    finally:
+      self.phases.append((name, (time.time() - phase_start) * 1000))
+
+  def totalMillis(self):
+    return (time.time() - self._start) * 1000
+
+  def serverTimingHeader(self):
+    """Format the phases (and the total) as a Server-Timing header value."""
+    entries = ['%s;dur=%.1f' % (name, ms) for name, ms in self.phases]
+    entries.append('total;dur=%.1f' % self.totalMillis())
+    return ', '.join(entries)
+
+  def __str__(self):
+    return ', '.join(['%s: %.1fms' % (name, ms) for name, ms in self.phases] +
+                     ['total: %.1fms' % self.totalMillis()])
+
+
 def updateAverageRating(review_key):
   """Helper function for updating the average rating of a product when new
-  review(s) are added."""
+  review(s) are added.  If config.RATING_SHARDS is set, the rating is added to
+  one of the product's rating shards instead (see ratings.py)."""
+
+  if config.RATING_SHARDS:
+    ratings.addShardedRating(review_key)
+    return
 
   def _tx():
     review = review_key.get()
@@ -56,22 +116,40 @@ def updateAverageRating(review_key):
       ndb.put_multi([product, review])
       # We need to update the ratings associated document at some point as well.
       # If the app is configured to have BATCH_RATINGS_UPDATE set to True, don't
-      # do this re-indexing now.  (Instead, all the out-of-date documents can be
-      # be later handled in batch -- see cron.yaml).  If BATCH_RATINGS_UPDATE is
-      # False, go ahead and reindex now in a transational task.
-      if not config.BATCH_RATINGS_UPDATE:
+      # do this re-indexing now.  (Instead, the product is added to the dirty
+      # log, and all the out-of-date documents are later handled in batch --
+      # see reindex.py and cron.yaml).  If BATCH_RATINGS_UPDATE is
+      # False, and REINDEX_COALESCE_WINDOW is 0, go ahead and reindex now in a
+      # transational task.  Otherwise the reindex is coalesced with those for
+      # other reviews of the product in the same window (see below), and the
+      # product is also added to the dirty log, in case the coalesced reindex
+      # is never queued.
+      if config.BATCH_RATINGS_UPDATE or config.REINDEX_COALESCE_WINDOW:
+        # log the product for the next batch update
+        reindex.logDirty(product.key.id(), transactional=True)
+      else:
         defer(
             models.Product.updateProdDocWithNewRating,
             product.key.id(), _transactional=True)
-    return (product, review)
+      return review
+    return None
 
   try:
     # use an XG transaction in order to update both entities at once
-    ndb.transaction(_tx, xg=True)
+    review = ndb.transaction(_tx, xg=True)
   except AttributeError:
     # swallow this error and log it; it's not recoverable.
     logging.exception('The function updateAverageRating failed. Either review '
                       + 'or product entity does not exist.')
-
-
-
+    return
+  updated_pid = review.product_key.id() if review else None
+  if updated_pid:
+    # the review now belongs in the product's listing
+    models.Review.refreshFirstPage(updated_pid, [review])
+  if (updated_pid and not config.BATCH_RATINGS_UPDATE and
+      config.REINDEX_COALESCE_WINDOW):
+    # Named tasks can't be added transactionally, so this is done after the
+    # commit.  If it fails, or never runs, the batch ratings update will
+    # reindex the doc, since the product was added to the dirty log in the
+    # transaction.
+    reindex.markDirty(updated_pid)
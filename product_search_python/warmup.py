@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Warms up a new instance before it serves user requests (App Engine sends
+a warmup request to each new instance; see app.yaml): imports the modules of
+both the main and the admin apps, creates their Jinja2 environments and
+compiles all the templates into them, and builds the product sort options and
+the category info.
+
+App Engine does not send a warmup request to every new instance, so the
+instance's cold start time -- from the time the app's first module was
+imported to the end of its first request, whether that is a warmup request or
+a user's (loading) request -- is recorded after the first request of any kind
+(see BaseHandler.dispatch).  It is logged, and recorded in memcache per app
+version, so that it can be compared across releases (see getStats; the admin
+page shows it).
+
+main.py and admin.py import this module first, so that its import time
+approximates the start of the instance.
+"""
+
+import logging
+import os
+import threading
+import time
+
+INSTANCE_START = time.time()
+
+from webapp2_extras import jinja2
+
+from google.appengine.api import memcache
+
+_STATS_NAMESPACE = 'warmup_stats'
+
+# the kinds of first request that an instance can get
+WARMUP = 'warmup'
+LOADING = 'loading'
+
+_warmed_up = False
+_cold_start_recorded = False
+_lock = threading.Lock()
+
+
+def _version():
+  return os.environ.get('CURRENT_VERSION_ID', 'unknown')
+
+
+def warmUp():
+  """Warm up the instance, once.  Returns the time taken in seconds, or None
+  if it was already warmed up."""
+  global _warmed_up
+  with _lock:
+    if _warmed_up:
+      return None
+    start = time.time()
+    # import the apps, and so all of their handler modules
+    import admin
+    import main
+    import docs
+    import models
+    for app in [main.application, admin.application]:
+      env = jinja2.get_jinja2(app=app).environment
+      for name in env.list_templates():
+        env.get_template(name)
+    docs.Product.getSortMenu()
+    docs.Product.getSortDict()
+    models.Category.getCategoryInfo()
+    _warmed_up = True
+  secs = time.time() - start
+  logging.info('warmup of version %s took %.0fms', _version(), secs * 1000)
+  return secs
+
+
+def requestDone(path):
+  """Called at the end of every request.  Records the instance's cold start
+  time at the end of its first request, of either kind."""
+  global _cold_start_recorded
+  if _cold_start_recorded:
+    return
+  with _lock:
+    if _cold_start_recorded:
+      return
+    _cold_start_recorded = True
+  kind = WARMUP if path == '/_ah/warmup' else LOADING
+  cold_start = time.time() - INSTANCE_START
+  logging.info('cold start of version %s (%s request): %.0fms',
+               _version(), kind, cold_start * 1000)
+  _recordColdStart(cold_start, kind)
+
+
+def _recordColdStart(secs, kind):
+  prefix = _version() + ':'
+  memcache.incr(prefix + 'count', namespace=_STATS_NAMESPACE, initial_value=0)
+  memcache.incr(prefix + kind + '_count', namespace=_STATS_NAMESPACE,
+                initial_value=0)
+  memcache.incr(prefix + 'total_ms', delta=int(secs * 1000),
+                namespace=_STATS_NAMESPACE, initial_value=0)
+  memcache.set(prefix + 'last_ms', int(secs * 1000),
+               namespace=_STATS_NAMESPACE)
+
+
+def getStats():
+  """Return a dict of the cold start stats of the current app version: the
+  number of instances started ('count'), how many of them were started by
+  warmup and by loading requests ('warmup_count' and 'loading_count'), and
+  their average and latest cold start times in milliseconds ('avg_ms' and
+  'last_ms')."""
+  names = ['count', WARMUP + '_count', LOADING + '_count', 'total_ms',
+           'last_ms']
+  values = memcache.get_multi(names, key_prefix=_version() + ':',
+                              namespace=_STATS_NAMESPACE)
+  count = values.get('count', 0)
+  return {'version': _version(), 'count': count,
+          'warmup_count': values.get(WARMUP + '_count', 0),
+          'loading_count': values.get(LOADING + '_count', 0),
+          'avg_ms': values.get('total_ms', 0) // count if count else 0,
+          'last_ms': values.get('last_ms', 0)}
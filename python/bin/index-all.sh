@@ -2,18 +2,18 @@
 
 appurl="https://sandbox-146200.appspot.com/bulkindex"
 
-max=2000000
-# should divide evenly into above or else we won't terminate...
-fetch=2000
+# how many key range shards to index in parallel
+shards=16
 
-offset=0
-until [ "$offset" = "$max" ]; do
-	echo "Indexing $fetch from offset $offset"
-	curl -i -X POST -F confirm=true -F fetch=$fetch -F offset=$offset "$appurl"
+# start a bulk index run; it runs server-side as one chain of tasks per
+# shard, checkpointing each shard's cursor, so there is nothing to resume
+# here if this script is interrupted.
+echo "Starting a bulk index with $shards shards"
+curl -i -X POST -F superconfirm=true -F shards=$shards "$appurl"
 
-	offset=`expr $offset + $fetch`
-	echo "..."
+# then poll its progress until all the shards are done
+until curl -s "$appurl/status" | grep -q "^done"; do
+	curl -s "$appurl/status"
 	sleep 10
 done
-
-
+curl -s "$appurl/status"
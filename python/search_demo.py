@@ -7,8 +7,10 @@
 
 from cgi import parse_qs
 from datetime import datetime
+from datetime import timedelta
 import os
 import string
+import time
 import urllib
 from urlparse import urlparse
 
@@ -16,8 +18,10 @@ import logging
 import webapp2
 from webapp2_extras import jinja2
 
+from google.appengine.api import memcache
 from google.appengine.api import search
 from google.appengine.api import users
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 # change these if you want
@@ -29,8 +33,30 @@ NDB_OFFSET = 0
 # don't change these
 _INDEX_NAME = 'bby_product'
 _INDEX_BATCH = 200
-# how many records we have (upper limit of massive bulk query)
-_NDB_TOTAL_SIZE = 2000000
+# how many parallel shards the bulk indexer splits the product keys into
+_INDEX_SHARDS = 16
+# how long (seconds) a bulk indexer task runs before it checkpoints and
+# chains a new task, leaving a margin below the 10 minute task deadline
+_TASK_TIME_LIMIT = 8 * 60
+# how many __scatter__ keys to sample per shard when splitting the key space
+_SHARD_OVERSAMPLE = 32
+# set to False to index only the product names, and load the fields shown
+# for each search result from the datastore
+_DENORMALIZED_DOCS = True
+# the fields shown for each search result, which are stored in the documents
+# (as well as the name) when _DENORMALIZED_DOCS is set
+_DISPLAY_FIELDS = ['name', 'url', 'image', 'regularPrice', 'salePrice',
+                   'onSale', 'salesRankMediumTerm', 'bestSellingRank']
+# marks a document that holds all its product's display fields
+_DOC_VERSION = 2
+# the maximum length of an atom field value
+_MAX_ATOM_LENGTH = 500
+# how long (seconds) the display fields loaded from the datastore are cached
+_HYDRATION_TTL = 3600
+_HYDRATION_PREFIX = 'bby_display:'
+# how far back (seconds) before its watermark each incremental sync starts,
+# to pick up changes whose writes committed out of timestamp order
+_SYNC_OVERLAP = 60
 
 # nifty function to split our long array data into batches
 def chunks(l, n):
@@ -58,6 +84,316 @@ class BestBuyProduct(ndb.Model):
     sku = ndb.IntegerProperty()
     image = ndb.StringProperty()
     url = ndb.StringProperty()
+    # the time of the product's last change, by which the incremental sync
+    # (SyncChanges) finds the changed products.  ndb sets it on every put
+    # through this model, but this app never writes the products: a loader
+    # that writes them any other way (the bulk loader, another model class
+    # or language) must set it to the write time itself, or its changes to
+    # prices and ranks are never synced.
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+class BulkIndexJob(ndb.Model):
+    """Tracks a sharded bulk index run, which indexes the products in one
+    chain of tasks per shard (a range of the product keys)."""
+    num_shards = ndb.IntegerProperty(default=0)
+    shards_done = ndb.IntegerProperty(default=0)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+
+    @property
+    def done(self):
+        return self.shards_done >= self.num_shards
+
+    def shardKeys(self):
+        return [BulkIndexShard.shardKey(self.key.id(), n)
+                for n in xrange(self.num_shards)]
+
+
+class BulkIndexShard(ndb.Model):
+    """The checkpoint of one shard of a BulkIndexJob: its [start_key, end_key)
+    key range (None is unbounded), and the query cursor it has reached."""
+    start_key = ndb.KeyProperty(indexed=False)
+    end_key = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    indexed = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+    @classmethod
+    def shardKey(cls, job_id, shard_num):
+        return ndb.Key(cls, '%s:%s' % (job_id, shard_num))
+
+
+def productRangeQuery(start_key=None, end_key=None):
+    """A key-ordered query for the products in the key range [start_key,
+    end_key)."""
+    query = BestBuyProduct.query()
+    if start_key is not None:
+        query = query.filter(BestBuyProduct.key >= start_key)
+    if end_key is not None:
+        query = query.filter(BestBuyProduct.key < end_key)
+    return query.order(BestBuyProduct.key)
+
+
+def IndexProjection():
+    """The projection to fetch products with for indexing: just the names,
+    unless the documents hold the display fields too."""
+    if _DENORMALIZED_DOCS:
+        return None
+    return [BestBuyProduct.name]
+
+
+def IndexProductsAsync(index, products):
+    """Start putting the documents of the given products, _INDEX_BATCH at a
+    time, and return the put rpcs.  The products' cached display fields are
+    dropped, as the new documents have the current ones."""
+    rpcs = [index.put_async([ProductDocument(product)
+                             for product in productchunk])
+            for productchunk in chunks(products, _INDEX_BATCH)]
+    if products:
+        memcache.delete_multi([str(product.key.id()) for product in products],
+                              key_prefix=_HYDRATION_PREFIX)
+    return rpcs
+
+
+def splitKeySpace(num_shards):
+    """Pick up to num_shards - 1 keys that split the product keys into ranges
+    of similar size, from a sample of keys ordered by the __scatter__
+    property (which the datastore sets on a random subset of entities).
+
+    This is the same sampling as product_search_python's reset._splitKeys;
+    the two apps are deployed separately and share no modules, so each keeps
+    its own copy."""
+    if num_shards < 2:
+        return []
+    sample = BestBuyProduct.query().order(
+        ndb.GenericProperty('__scatter__')).fetch(
+            num_shards * _SHARD_OVERSAMPLE, keys_only=True)
+    sample.sort(key=lambda key: key.pairs())
+    if len(sample) > num_shards:
+        step = len(sample) / float(num_shards)
+        sample = [sample[int(step * i)] for i in xrange(1, num_shards)]
+    splits = []
+    for key in sample:
+        if not splits or splits[-1] != key:
+            splits.append(key)
+    return splits
+
+
+def StartBulkIndex(num_shards=_INDEX_SHARDS):
+    """Start indexing all the products, split into (up to) num_shards key
+    ranges, each indexed by its own chain of deferred tasks."""
+    bounds = [None] + splitKeySpace(num_shards) + [None]
+    ranges = zip(bounds[:-1], bounds[1:])
+    job = BulkIndexJob(num_shards=len(ranges))
+    job.put()
+    job_id = job.key.id()
+    ndb.put_multi([
+        BulkIndexShard(key=BulkIndexShard.shardKey(job_id, n),
+                       start_key=start_key, end_key=end_key)
+        for n, (start_key, end_key) in enumerate(ranges)])
+    for n in xrange(len(ranges)):
+        deferred.defer(IndexShard, job_id, n)
+    logging.info('bulk index %s: started %s shards', job_id, len(ranges))
+    return job
+
+
+def IndexShard(job_id, shard_num):
+    """Index (the rest of) one shard of a bulk index run, a page of NDB_FETCH
+    products at a time, from its checkpointed cursor.  Each page is indexed
+    in _INDEX_BATCH chunks with parallel async puts, while the next page is
+    fetched, and the cursor is checkpointed after every page, so that a
+    failed or chained task picks up where this one stopped."""
+    shard = BulkIndexShard.shardKey(job_id, shard_num).get()
+    if not shard or shard.done:
+        return
+    started = time.time()
+    index = search.Index(name=_INDEX_NAME)
+    query = productRangeQuery(shard.start_key, shard.end_key)
+    cursor = None
+    if shard.cursor:
+        cursor = ndb.Cursor(urlsafe=shard.cursor)
+    page = query.fetch_page_async(NDB_FETCH, start_cursor=cursor,
+                                  projection=IndexProjection())
+    while True:
+        products, cursor, more = page.get_result()
+        more = more and cursor is not None
+        puts = IndexProductsAsync(index, products)
+        if more:
+            page = query.fetch_page_async(NDB_FETCH, start_cursor=cursor,
+                                          projection=IndexProjection())
+        # a failed put fails the task, which is retried from the checkpoint
+        for rpc in puts:
+            rpc.get_result()
+        shard.indexed += len(products)
+        if not more:
+            break
+        shard.cursor = cursor.urlsafe()
+        shard.put()
+        if time.time() - started > _TASK_TIME_LIMIT:
+            logging.info('bulk index %s: shard %s continuing in a new task '
+                         'after %s products', job_id, shard_num,
+                         shard.indexed)
+            deferred.defer(IndexShard, job_id, shard_num)
+            return
+    FinishShard(job_id, shard_num, shard.indexed)
+
+
+@ndb.transactional(xg=True, retries=10)
+def FinishShard(job_id, shard_num, indexed):
+    """Mark a shard done, and count it towards its job."""
+    job, shard = ndb.get_multi([ndb.Key(BulkIndexJob, job_id),
+                                BulkIndexShard.shardKey(job_id, shard_num)])
+    if not job or shard.done:
+        return
+    shard.done = True
+    shard.cursor = None
+    shard.indexed = indexed
+    job.shards_done += 1
+    if job.done:
+        job.finished = datetime.now()
+    ndb.put_multi([job, shard])
+
+
+def GetBulkIndexStatus():
+    """Return (job, number of products indexed) for the latest bulk index
+    run, or (None, 0) if there hasn't been one."""
+    job = BulkIndexJob.query().order(-BulkIndexJob.created).get()
+    if not job:
+        return None, 0
+    shards = ndb.get_multi(job.shardKeys())
+    return job, sum(shard.indexed for shard in shards if shard)
+
+
+class IndexSyncState(ndb.Model):
+    """The watermark and the monitoring stats of the incremental
+    datastore-to-index sync (see SyncChanges).  There is one, whose id is
+    the index name.  A run holds a lease on it, so that runs don't overlap."""
+    # the modified time of the newest product synced so far
+    watermark = ndb.DateTimeProperty(indexed=False)
+    last_run = ndb.DateTimeProperty(indexed=False)
+    # documents written, and seconds taken, by the last run
+    last_synced = ndb.IntegerProperty(default=0, indexed=False)
+    last_elapsed = ndb.FloatProperty(default=0, indexed=False)
+    # seconds from the oldest change picked up by the last run to its reindex
+    last_lag = ndb.FloatProperty(default=0, indexed=False)
+    total_synced = ndb.IntegerProperty(default=0, indexed=False)
+    # the run holding the lease, and when the lease expires
+    lease_owner = ndb.StringProperty(indexed=False)
+    lease_expires = ndb.DateTimeProperty(indexed=False)
+
+    @property
+    def throughput(self):
+        if not self.last_elapsed:
+            return 0
+        return self.last_synced / self.last_elapsed
+
+
+@ndb.transactional
+def _AcquireSyncLease(owner):
+    """Take the sync lease for the given run, and return the sync state; or
+    return None if another run holds an unexpired lease.  The lease outlasts
+    the longest run, so it only expires if a run dies without releasing
+    it."""
+    state = IndexSyncState.get_by_id(_INDEX_NAME)
+    if not state:
+        state = IndexSyncState(id=_INDEX_NAME)
+    now = datetime.now()
+    if state.lease_owner and state.lease_expires > now:
+        return None
+    state.lease_owner = owner
+    state.lease_expires = now + timedelta(seconds=_TASK_TIME_LIMIT + 60)
+    state.put()
+    return state
+
+
+@ndb.transactional
+def _CheckpointSync(owner, watermark, synced, finish=None):
+    """Advance the sync watermark (never moving it back) and add to the
+    total synced, if the given run still holds the lease.  If finish is
+    given, it is a dict of the run's stats to record, and the lease is
+    released.  Returns the sync state, or None if the lease was lost."""
+    state = IndexSyncState.get_by_id(_INDEX_NAME)
+    if not state or state.lease_owner != owner:
+        return None
+    if watermark and (not state.watermark or watermark > state.watermark):
+        state.watermark = watermark
+    state.total_synced += synced
+    if finish:
+        state.populate(**finish)
+        state.lease_owner = None
+        state.lease_expires = None
+    state.put()
+    return state
+
+
+def SyncChanges():
+    """Reindex the products that have changed since the last sync's
+    watermark, a page at a time in modified order, with async puts, for up
+    to _TASK_TIME_LIMIT seconds, advancing the watermark after each page;
+    then record the sync lag and throughput.  Any changes left over are
+    picked up by the next run.  A run holds a lease on the sync state, and
+    if another run holds it, does nothing, so that runs don't sync the same
+    changes or overwrite each other's watermark.  Only the products whose
+    writers set their modified time are seen (see BestBuyProduct.modified).
+    Returns the IndexSyncState, or None if another run holds the lease."""
+    owner = '%s-%s' % (os.environ.get('REQUEST_LOG_ID', ''), time.time())
+    state = _AcquireSyncLease(owner)
+    if not state:
+        logging.info('sync: another run is in progress')
+        return None
+    started = time.time()
+    now = datetime.now()
+    old_watermark = state.watermark
+    if old_watermark:
+        since = old_watermark - timedelta(seconds=_SYNC_OVERLAP)
+    else:
+        # products without a modified time predate the sync, and are covered
+        # by the bulk index
+        since = datetime(1970, 1, 1)
+    query = BestBuyProduct.query(BestBuyProduct.modified >= since).order(
+        BestBuyProduct.modified)
+    index = search.Index(name=_INDEX_NAME)
+    synced = 0
+    oldest_change = None
+    page = query.fetch_page_async(NDB_FETCH)
+    while True:
+        products, cursor, more = page.get_result()
+        more = (more and cursor is not None and
+                time.time() - started < _TASK_TIME_LIMIT)
+        puts = IndexProductsAsync(index, products)
+        if more:
+            page = query.fetch_page_async(NDB_FETCH, start_cursor=cursor)
+        for rpc in puts:
+            rpc.get_result()
+        if oldest_change is None:
+            # the rows in the overlap were synced already, so don't count
+            # them towards the lag
+            for product in products:
+                if not old_watermark or product.modified > old_watermark:
+                    oldest_change = product.modified
+                    break
+        synced += len(products)
+        watermark = products[-1].modified if products else None
+        if not more:
+            break
+        if not _CheckpointSync(owner, watermark, len(products)):
+            logging.warning('sync: lost the lease after %s products', synced)
+            return None
+
+    lag = 0
+    if oldest_change:
+        lag = max((datetime.now() - oldest_change).total_seconds(), 0)
+    state = _CheckpointSync(owner, watermark, len(products), finish=dict(
+        last_run=now, last_synced=synced, last_elapsed=time.time() - started,
+        last_lag=lag))
+    if not state:
+        logging.warning('sync: lost the lease after %s products', synced)
+        return None
+    logging.info('sync: reindexed %s products in %.1fs (%.1f/sec), lag %.1fs, '
+                 'watermark %s', synced, state.last_elapsed, state.throughput,
+                 state.last_lag, state.watermark)
+    return state
+
 
 class BaseHandler(webapp2.RequestHandler):
     """The other handlers inherit from this class.  Provides some helper methods
@@ -84,11 +420,13 @@ class MainPage(BaseHandler):
             query = parse_qs(uri.query)
             query = query['query'][0]
 
-            # sort results by salesRankMediumTerm and bestSellingRank descending
+            # sort results by salesRankMediumTerm and bestSellingRank
+            # descending.  They are number fields, so the defaults (for the
+            # documents that don't have them) must be numbers too.
             expr_list = [search.SortExpression(
-                expression='salesRankMediumTerm', default_value='',
+                expression='salesRankMediumTerm', default_value=0,
                 direction=search.SortExpression.DESCENDING), search.SortExpression(
-                expression='bestSellingRank', default_value='',
+                expression='bestSellingRank', default_value=0,
                 direction=search.SortExpression.DESCENDING)]
 
             # construct the sort options
@@ -96,16 +434,15 @@ class MainPage(BaseHandler):
                  expressions=expr_list)
             query_options = search.QueryOptions(
                 limit=10,
-                sort_options=sort_opts)
+                sort_options=sort_opts,
+                returned_fields=_DISPLAY_FIELDS + ['docVersion'])
             query_obj = search.Query(query_string=query, options=query_options)
             results = search.Index(name=_INDEX_NAME).search(query=query_obj)
             number_returned = len(results.results)
 
-        # use magic python incantations to extract and filter on returned doc IDs
-        dsids = iterattr(results,'doc_id')
-        # dammit, remember that you have to int() your keys
-        dskeys = [ndb.Key(BestBuyProduct, int(k)) for k in dsids]
-        dsresults = ndb.get_multi(dskeys)
+        # render from the documents' fields; only the results whose documents
+        # don't have the display fields are loaded from memcache/the datastore
+        dsresults = DisplayResults(results)
 
         template_values = {
             'results': results,
@@ -116,9 +453,13 @@ class MainPage(BaseHandler):
         self.render_template('index.html', template_values)
 
 
-def CreateDocument(name, product_id=None):
-    """Creates a search.Document from the named product."""
+def CreateDocument(name, product_id=None, product=None):
+    """Creates a search.Document from the named product.  If the product
+    entity is given, its display fields are stored in the document too, so
+    that the search results can be shown without loading the products."""
     nameFields = [search.TextField(name='name', value=name)]
+    if product is not None:
+        nameFields.extend(DisplayFields(product))
 
     if product_id:
         # Specify using the product_id we want
@@ -130,6 +471,84 @@ def CreateDocument(name, product_id=None):
         return search.Document(fields=nameFields)
 
 
+def DisplayFields(product):
+    """The document fields for the given product's display fields (other
+    than its name).  Unless a value is too long to store, the fields are
+    marked with the document version, so that the search results know not to
+    load the product."""
+    fields = []
+    for name in ['regularPrice', 'salePrice', 'salesRankMediumTerm',
+                 'bestSellingRank']:
+        value = getattr(product, name)
+        if value is not None:
+            fields.append(search.NumberField(name=name, value=value))
+    if product.onSale is not None:
+        fields.append(search.AtomField(
+            name='onSale', value='true' if product.onSale else 'false'))
+    complete = True
+    for name in ['url', 'image']:
+        value = getattr(product, name)
+        if value and len(value) > _MAX_ATOM_LENGTH:
+            complete = False
+        elif value:
+            fields.append(search.AtomField(name=name, value=value))
+    if complete:
+        fields.append(search.NumberField(name='docVersion', value=_DOC_VERSION))
+    return fields
+
+
+def ProductDocument(product):
+    """The document to index for the given product entity."""
+    if _DENORMALIZED_DOCS:
+        return CreateDocument(product.name, str(product.key.id()), product)
+    return CreateDocument(product.name, str(product.key.id()))
+
+
+def ProductDisplay(product):
+    """A dict of the display fields of the given product entity."""
+    return dict((name, getattr(product, name)) for name in _DISPLAY_FIELDS)
+
+
+def HydrateProducts(doc_ids):
+    """Return a dict of the display fields of the products with the given doc
+    ids, keyed by doc id, from memcache or else the datastore."""
+    found = memcache.get_multi(doc_ids, key_prefix=_HYDRATION_PREFIX)
+    missing = [doc_id for doc_id in doc_ids
+               if doc_id not in found and doc_id.isdigit()]
+    if missing:
+        # remember that you have to int() your keys
+        products = ndb.get_multi(
+            [ndb.Key(BestBuyProduct, int(doc_id)) for doc_id in missing])
+        loaded = dict((doc_id, ProductDisplay(product))
+                      for doc_id, product in zip(missing, products) if product)
+        if loaded:
+            memcache.set_multi(loaded, key_prefix=_HYDRATION_PREFIX,
+                               time=_HYDRATION_TTL)
+        found.update(loaded)
+    return found
+
+
+def DisplayResults(results):
+    """Return a dict of display fields for each search result, from its
+    document's returned fields if it has all of them, or else from its
+    (cached) product entity."""
+    displays = []
+    for scored_document in results:
+        display = None
+        fields = dict((f.name, f.value) for f in scored_document.fields)
+        if fields.pop('docVersion', None) == _DOC_VERSION:
+            display = dict.fromkeys(_DISPLAY_FIELDS)
+            display.update(fields)
+            display['onSale'] = fields.get('onSale') == 'true'
+        displays.append((scored_document.doc_id, display))
+    missing = [doc_id for doc_id, display in displays if display is None]
+    if missing:
+        hydrated = HydrateProducts(missing)
+        displays = [(doc_id, display or hydrated.get(doc_id))
+                    for doc_id, display in displays]
+    return [display for doc_id, display in displays if display]
+
+
 class AddIndex(BaseHandler):
     """Handles requests to index products."""
 
@@ -150,48 +569,53 @@ class AddIndex(BaseHandler):
 class BulkIndex(BaseHandler):
     """Handles a bulk update of the search index from GCDS/NDB"""
 
-    def getNextProducts(self, fetchnum=200, offsetnum=0):
-        prodquery = BestBuyProduct.query().order(BestBuyProduct.key)
-        products = prodquery.fetch(fetchnum, offset=offsetnum, projection=[BestBuyProduct.name])
-        return products
+    def getNextProducts(self, fetchnum=200, cursor=None):
+        """Return (products, next cursor) for a key-ordered page of products
+        starting at the given web-safe cursor; the next cursor is None after
+        the last page."""
+        start_cursor = None
+        if cursor:
+            start_cursor = ndb.Cursor(urlsafe=cursor)
+        products, next_cursor, more = productRangeQuery().fetch_page(
+            fetchnum, start_cursor=start_cursor,
+            projection=IndexProjection())
+        if more and next_cursor:
+            return products, next_cursor.urlsafe()
+        return products, None
 
     def indexProductBatch(self, products):
-        # split our data into batches...
-        for productchunk in chunks(products, _INDEX_BATCH):
-            # make some noise for the next product we'll touch
-            loggedprod=productchunk[0];
-            logging.warning('CHUNK! About to create %s index entries, next will be: %s: %s', len(productchunk), loggedprod.key.id(), loggedprod.name)
-
-            # batch index our searchable data
-            proddocs = []
-            for product in productchunk:
-                proddocs.append(CreateDocument(product.name, str(product.key.id())))
-            search.Index(name=_INDEX_NAME).put(proddocs)
+        # split our data into batches, and put them all in parallel
+        puts = IndexProductsAsync(search.Index(name=_INDEX_NAME), products)
+        for rpc in puts:
+            rpc.get_result()
+        logging.info('indexed %s products', len(products))
 
+    def getFetch(self):
+        try:
+            return int(self.request.get('fetch'))
+        except ValueError:
+            return NDB_FETCH
 
     def get(self):
 
         # query NDB for some items that we want to index and display them.
-        # Using key order for "random" sampling
+        # Using key order for "random" sampling, paged with cursors
 
-        logging.info('GET: fetch %s, offset %s', self.request.get('fetch'), self.request.get('offset'))
+        fetch = self.getFetch()
+        cursor = self.request.get('cursor')
+        logging.info('GET: fetch %s, cursor %s', fetch, cursor)
 
-        try:
-            fetch = int(self.request.get('fetch'))
-        except:
-            fetch = NDB_FETCH
-        try:
-            offset = int(self.request.get('offset'))
-        except:
-            offset = NDB_OFFSET
+        products, next_cursor = self.getNextProducts(fetch, cursor)
+        job, indexed = GetBulkIndexStatus()
 
-        products = self.getNextProducts(fetch, offset)
-        
         template_values = {
             'products': products,
             'fetch': fetch,
-            'offset': offset,
+            'cursor': cursor,
+            'next_cursor': next_cursor,
             'number_returned': len(products),
+            'job': job,
+            'indexed': indexed,
         }
 
         self.render_template('bulk.html', template_values)
@@ -200,49 +624,82 @@ class BulkIndex(BaseHandler):
     def post(self):
         confirm = self.request.get('confirm')
         superconfirm = self.request.get('superconfirm')
+        fetch = self.getFetch()
+        cursor = self.request.get('cursor')
 
-        # run the query and also GAE index the items, then return to display what we just did
+        # run the query and also GAE index the items, then return to display
+        # the next page
         if confirm:
-    
-            ### REPEATABILITY-SAFE VERSION:
-            ### Starts with the "weird" names that we don't care about messing up,
-            ### And only does a few of them... use this when it's broken
-            ####################
-            # prodquery = BestBuyProduct.query(BestBuyProduct.name != None)
-            # products = prodquery.fetch(20, projection=[BestBuyProduct.name])
-            ####################
-
-            logging.info('POST: fetch %s, offset %s', self.request.get('fetch'), self.request.get('offset'))
+            logging.info('POST: fetch %s, cursor %s', fetch, cursor)
+            products, cursor = self.getNextProducts(fetch, cursor)
+            self.indexProductBatch(products)
 
+        if superconfirm:
+            # index everything, in parallel, resumable shard tasks
             try:
-                fetch = int(self.request.get('fetch'))
-            except:
-                fetch = NDB_FETCH
-            try:
-                offset = int(self.request.get('offset'))
-            except:
-                offset = NDB_OFFSET
+                shards = int(self.request.get('shards'))
+            except ValueError:
+                shards = _INDEX_SHARDS
+            StartBulkIndex(max(1, min(shards, 100)))
 
-            products = self.getNextProducts(NDB_FETCH, NDB_OFFSET)            
-            self.indexProductBatch(products)
+        params = {'fetch': fetch}
+        if cursor:
+            params['cursor'] = cursor
+        self.redirect('/bulkindex?' + urllib.urlencode(params))
 
-        if superconfirm:
-            # ridiculously large batch update
-            logging.warning('SUPERCONFIRM:  All right, you asked for it...')
 
-            for massoffset in xrange(0, _NDB_TOTAL_SIZE, NDB_FETCH):
-                logging.warning('YOWZAH! Here comes another %s products, offset %s ...', NDB_FETCH, massoffset)
-                products = self.getNextProducts(NDB_FETCH, massoffset)
-                self.indexProductBatch(products)
+class BulkIndexStatus(BaseHandler):
+    """Reports the progress of the latest bulk index run, as plain text whose
+    first word is 'done' or 'running' (see bin/index-all.sh)."""
+
+    def get(self):
+        job, indexed = GetBulkIndexStatus()
+        self.response.headers['Content-Type'] = 'text/plain'
+        if not job:
+            self.response.write('none: no bulk index run\n')
+            return
+        self.response.write('%s: %s of %s shards done, %s products indexed\n' % (
+            'done' if job.done else 'running', job.shards_done,
+            job.num_shards, indexed))
+
+
+def SyncStatusText(state):
+    return ('watermark %s, last run %s: %s products in %.1fs (%.1f/sec), '
+            'lag %.1fs; %s synced in all\n' % (
+                state.watermark, state.last_run, state.last_synced,
+                state.last_elapsed, state.throughput, state.last_lag,
+                state.total_synced))
+
 
-            logging.warning('SUPERCONFIRM:  All done... go to bed already!')
+class SyncIndex(BaseHandler):
+    """Run by cron to reindex the products changed since the last sync."""
+
+    def get(self):
+        state = SyncChanges()
+        self.response.headers['Content-Type'] = 'text/plain'
+        if not state:
+            self.response.write('another sync is in progress\n')
+            return
+        self.response.write(SyncStatusText(state))
+
+
+class SyncStatus(BaseHandler):
+    """Reports the incremental sync's watermark, lag and throughput."""
+
+    def get(self):
+        state = IndexSyncState.get_by_id(_INDEX_NAME)
+        self.response.headers['Content-Type'] = 'text/plain'
+        if not state:
+            self.response.write('no sync has run\n')
+            return
+        self.response.write(SyncStatusText(state))
 
-        self.redirect('/bulkindex?'+urllib.urlencode(
-            {'fetch': fetch, 'offset': offset}))
-                
 
 application = webapp2.WSGIApplication(
     [('/', MainPage),
      ('/add', AddIndex),
-     ('/bulkindex' , BulkIndex)],
+     ('/bulkindex' , BulkIndex),
+     ('/bulkindex/status', BulkIndexStatus),
+     ('/sync', SyncIndex),
+     ('/sync/status', SyncStatus)],
     debug=True)